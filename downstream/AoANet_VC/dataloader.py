@@ -8,17 +8,19 @@ import lmdb
 import os
 import numpy as np
 import random
+from functools import partial
 
 import torch
 import torch.utils.data as data
 
-import multiprocessing
 import six
 
 class HybridLoader:
     """
     If db_path is a director, then use normal file loading
     If lmdb, then load from lmdb
+    If a flat feature store (a directory with features.bin, see
+    vc_rcnn.tools.featstore), then return views of the memory-mapped features
     The loading method depend on extention.
     """
     def __init__(self, db_path, ext):
@@ -38,11 +40,29 @@ class HybridLoader:
             self.feat_file = torch.load(db_path)
             self.loader = lambda x: x
             print('HybridLoader: ext is ignored')
+        elif os.path.exists(os.path.join(db_path, 'features.bin')):
+            self.db_type = 'flat'
+            with open(os.path.join(db_path, 'meta.json')) as f:
+                self.meta = meta = json.load(f)
+            with open(os.path.join(db_path, 'names.json')) as f:
+                self.name2idx = {name: i for i, name in enumerate(json.load(f))}
+            self.index = np.load(os.path.join(db_path, 'index.npy'))
+            # the pages are shared by all the dataloader workers
+            self.feat_file = np.memmap(os.path.join(db_path, 'features.bin'),
+                                       dtype=meta['dtype'], mode='r',
+                                       shape=(meta['num_boxes'], meta['dim']))
+            print('HybridLoader: ext is ignored')
         else:
             self.db_type = 'dir'
     
     def get(self, key):
 
+        if self.db_type == 'flat':
+            offset, count = self.index[self.name2idx[key]]
+            feat = self.feat_file[offset:offset + count]
+            # fp16 stores are cast, fp32 ones are returned without a copy
+            return feat.astype(np.float32) if feat.dtype == np.float16 else feat
+
         if self.db_type == 'lmdb':
             env = self.env
             with env.begin(write=False) as txn:
@@ -62,9 +82,10 @@ class HybridLoader:
 class DataLoader(data.Dataset):
 
     def reset_iterator(self, split):
-        del self._prefetch_process[split]
-        self._prefetch_process[split] = BlobFetcher(split, self, split=='train')
+        self._samplers[split].load_state_dict({'epoch': 0, 'position': 0})
+        self._iters.pop(split, None)
         self.iterators[split] = 0
+        self._epochs[split] = 0
 
     def get_vocab_size(self):
         return self.vocab_size
@@ -79,7 +100,7 @@ class DataLoader(data.Dataset):
         self.opt = opt
         self.batch_size = self.opt.batch_size
         self.seq_per_img = opt.seq_per_img
-        
+
         # feature related options
         self.use_fc = getattr(opt, 'use_fc', True)
         self.use_att = getattr(opt, 'use_att', True)
@@ -94,7 +115,7 @@ class DataLoader(data.Dataset):
             self.ix_to_word = self.info['ix_to_word']
             self.vocab_size = len(self.ix_to_word)
             print('vocab size is ', self.vocab_size)
-        
+
         # open the hdf5 file
         print('DataLoader loading h5 file: ', opt.input_fc_dir, opt.input_att_dir, opt.input_box_dir, opt.input_label_h5)
         if self.opt.input_label_h5 != 'none':
@@ -139,18 +160,66 @@ class DataLoader(data.Dataset):
         print('assigned %d images to split val' %len(self.split_ix['val']))
         print('assigned %d images to split test' %len(self.split_ix['test']))
 
+        # the attention features prebuilt by scripts/build_att_store.py, one
+        # flat store per split
+        self.att_stores = {}
+        self.att_store_split = {}
+        if getattr(opt, 'input_att_store', ''):
+            for split in self.split_ix.keys():
+                if not self.split_ix[split]:
+                    continue
+                split_dir = os.path.join(opt.input_att_store, split)
+                if not os.path.exists(os.path.join(split_dir, 'features.bin')):
+                    raise IOError('--input_att_store: no flat store for the %s split in %s '
+                                  '(build it with scripts/build_att_store.py --splits %s)'
+                                  % (split, split_dir, split))
+                self.att_stores[split] = HybridLoader(split_dir, '.npy')
+                options = self.att_stores[split].meta.get('att_options', {})
+                for k in ['use_box', 'norm_att_feat', 'norm_box_feat']:
+                    assert options.get(k, 0) == getattr(self, k), \
+                        '%s: built with %s=%s' % (split_dir, k, options.get(k, 0))
+                for ix in self.split_ix[split]:
+                    self.att_store_split.setdefault(ix, split)
+
+        # position of the next image of each split, as consumed by get_batch
+        # (the workers run ahead of it)
         self.iterators = {'train': 0, 'val': 0, 'test': 0}
-        
-        self._prefetch_process = {} # The three prefetch process
+        self._epochs = {'train': 0, 'val': 0, 'test': 0}
+
+        # the images are loaded and the batches collated by the workers; the
+        # iterators (and their workers) are started by the first get_batch
+        self._samplers = {}
+        self._loaders = {}
+        self._iters = {}
         for split in self.iterators.keys():
-            self._prefetch_process[split] = BlobFetcher(split, self, split=='train')
-            # Terminate the child process when the parent exists
-        def cleanup():
-            print('Terminating BlobFetcher')
-            for split in self.iterators.keys():
-                del self._prefetch_process[split]
-        import atexit
-        atexit.register(cleanup)
+            self._samplers[split] = SplitSampler(self.split_ix[split], shuffle=split=='train')
+            self._loaders[split] = data.DataLoader(dataset=self,
+                                            batch_size=self.batch_size,
+                                            sampler=self._samplers[split],
+                                            pin_memory=True,
+                                            num_workers=getattr(opt, 'num_workers', 4),
+                                            collate_fn=partial(self.collate_func, split=split))
+
+    def state_dict(self):
+        """
+        The sampler states of the splits, at the last batch returned by
+        get_batch. Saved in the infos, and restored by load_state_dict.
+        """
+        state_dict = {}
+        for split, sampler in self._samplers.items():
+            state_dict[split] = sampler.state_dict(self._epochs[split], self.iterators[split])
+        return state_dict
+
+    def load_state_dict(self, state_dict=None):
+        if state_dict is None:
+            return
+        for split, sampler in self._samplers.items():
+            if split not in state_dict:
+                continue
+            sampler.load_state_dict(state_dict[split])
+            self._iters.pop(split, None)
+            self._epochs[split] = sampler.epoch
+            self.iterators[split] = sampler.position
 
     def get_captions(self, ix, seq_per_img):
         # fetch the sequence labels
@@ -172,39 +241,42 @@ class DataLoader(data.Dataset):
         return seq
 
     def get_batch(self, split, batch_size=None):
-        batch_size = batch_size or self.batch_size
-        seq_per_img = self.seq_per_img
+        """
+        Returns the next batch of the split. The features are given once per
+        image (batch_size rows), the labels and masks are
+        batch_size x seq_per_img x (seq_length + 2): the features are only
+        repeated seq_per_img times on the GPU, by the model wrapper.
+        """
+        assert batch_size is None or batch_size == self.batch_size, \
+            'the batch size is fixed by the split loaders'
+        if split not in self._iters:
+            self._iters[split] = iter(self._loaders[split])
+        data = next(self._iters[split])
 
-        fc_batch = [] # np.ndarray((batch_size * seq_per_img, self.opt.fc_feat_size), dtype = 'float32')
-        att_batch = [] # np.ndarray((batch_size * seq_per_img, 14, 14, self.opt.att_feat_size), dtype = 'float32')
-        label_batch = [] #np.zeros([batch_size * seq_per_img, self.seq_length + 2], dtype = 'int')
+        # the batch may end with the last image of a pass
+        bounds = data['bounds']
+        self._epochs[split] = bounds['epoch'] + bounds['it_pos_now'] // bounds['it_max']
+        self.iterators[split] = bounds['it_pos_now'] % bounds['it_max']
 
-        wrapped = False
+        return data
 
-        infos = []
-        gts = []
+    def collate_func(self, batch, split):
+        """
+        Merges the images of a batch, in the dataloader workers.
+        """
+        seq_per_img = self.seq_per_img
 
-        for i in range(batch_size):
-            # fetch image
-            tmp_fc, tmp_att, tmp_seq, \
-                ix, tmp_wrapped = self._prefetch_process[split].get()
-            if tmp_wrapped:
-                wrapped = True
-
-            fc_batch.append(tmp_fc)
-            att_batch.append(tmp_att)
-            
-            tmp_label = np.zeros([seq_per_img, self.seq_length + 2], dtype = 'int')
-            if hasattr(self, 'h5_label_file'):
-                tmp_label[:, 1 : self.seq_length + 1] = tmp_seq
-            label_batch.append(tmp_label)
+        fc_batch, att_batch, seq_batch, ixs, positions, epochs, wrappeds = zip(*batch)
 
+        infos = []
+        gts = []
+        for ix in ixs:
             # Used for reward evaluation
             if hasattr(self, 'h5_label_file'):
                 gts.append(self.label[self.label_start_ix[ix] - 1: self.label_end_ix[ix]])
             else:
                 gts.append([])
-        
+
             # record associated info as well
             info_dict = {}
             info_dict['ix'] = ix
@@ -212,35 +284,31 @@ class DataLoader(data.Dataset):
             info_dict['file_path'] = self.info['images'][ix].get('file_path', '')
             infos.append(info_dict)
 
-        # #sort by att_feat length
-        # fc_batch, att_batch, label_batch, gts, infos = \
-        #     zip(*sorted(zip(fc_batch, att_batch, np.vsplit(label_batch, batch_size), gts, infos), key=lambda x: len(x[1]), reverse=True))
-        fc_batch, att_batch, label_batch, gts, infos = \
-            zip(*sorted(zip(fc_batch, att_batch, label_batch, gts, infos), key=lambda x: 0, reverse=True))
         data = {}
-        data['fc_feats'] = np.stack(sum([[_]*seq_per_img for _ in fc_batch], []))
+        data['fc_feats'] = np.stack(fc_batch)
         # merge att_feats
-        max_att_len = max([_.shape[0] for _ in att_batch])
-        data['att_feats'] = np.zeros([len(att_batch)*seq_per_img, max_att_len, att_batch[0].shape[1]], dtype = 'float32')
-        for i in range(len(att_batch)):
-            data['att_feats'][i*seq_per_img:(i+1)*seq_per_img, :att_batch[i].shape[0]] = att_batch[i]
-        data['att_masks'] = np.zeros(data['att_feats'].shape[:2], dtype='float32')
-        for i in range(len(att_batch)):
-            data['att_masks'][i*seq_per_img:(i+1)*seq_per_img, :att_batch[i].shape[0]] = 1
+        att_lens = np.array([_.shape[0] for _ in att_batch])
+        max_att_len = att_lens.max()
+        data['att_feats'] = np.zeros((len(att_batch), max_att_len) + att_batch[0].shape[1:], dtype = 'float32')
+        for i, att_feat in enumerate(att_batch):
+            data['att_feats'][i, :att_feat.shape[0]] = att_feat
         # set att_masks to None if attention features have same length
-        if data['att_masks'].sum() == data['att_masks'].size:
+        if (att_lens == max_att_len).all():
             data['att_masks'] = None
+        else:
+            data['att_masks'] = (np.arange(max_att_len) < att_lens[:, None]).astype('float32')
 
-        data['labels'] = np.vstack(label_batch)
+        data['labels'] = np.zeros([len(batch), seq_per_img, self.seq_length + 2], dtype = 'int')
+        if hasattr(self, 'h5_label_file'):
+            data['labels'][:, :, 1 : self.seq_length + 1] = np.stack(seq_batch)
         # generate mask
-        nonzeros = np.array(list(map(lambda x: (x != 0).sum()+2, data['labels'])))
-        mask_batch = np.zeros([data['labels'].shape[0], self.seq_length + 2], dtype = 'float32')
-        for ix, row in enumerate(mask_batch):
-            row[:nonzeros[ix]] = 1
-        data['masks'] = mask_batch
+        nonzeros = (data['labels'] != 0).sum(2) + 2
+        data['masks'] = (np.arange(self.seq_length + 2) < nonzeros[:, :, None]).astype('float32')
 
         data['gts'] = gts # all ground truth captions of each images
-        data['bounds'] = {'it_pos_now': self.iterators[split], 'it_max': len(self.split_ix[split]), 'wrapped': wrapped}
+        # the position and epoch of the last image
+        data['bounds'] = {'it_pos_now': positions[-1], 'it_max': len(self.split_ix[split]),
+                          'wrapped': any(wrappeds), 'epoch': epochs[-1]}
         data['infos'] = infos
 
         data = {k:torch.from_numpy(v) if type(v) is np.ndarray else v for k,v in data.items()} # Turn all ndarray to torch tensor
@@ -250,30 +318,43 @@ class DataLoader(data.Dataset):
     # It's not coherent to make DataLoader a subclass of Dataset, but essentially, we only need to implement the following to functions,
     # so that the torch.utils.data.DataLoader can load the data according the index.
     # However, it's minimum change to switch to pytorch data loading.
+    def load_att_feat(self, ix):
+        """
+        The attention features of an image: the bottom-up and VC features
+        side by side, then (use_box) its box features, the rows sorted by
+        box size. This is what build_att_store precomputes.
+        """
+        att_feat = self.att_loader.get(str(self.info['images'][ix]['id']))
+        att_feat_vc = self.att_loader_vc.get(str(self.info['images'][ix]['id']))
+        assert att_feat.shape[0] == att_feat_vc.shape[0]
+        att_feat = np.hstack((att_feat, att_feat_vc))
+        # Reshape to K x C
+        att_feat = att_feat.reshape(-1, att_feat.shape[-1])
+        if self.norm_att_feat:
+            att_feat = att_feat / np.linalg.norm(att_feat, 2, 1, keepdims=True)
+        if self.use_box:
+            box_feat = self.box_loader.get(str(self.info['images'][ix]['id']))
+            # devided by image width and height
+            x1,y1,x2,y2 = np.hsplit(box_feat, 4)
+            h,w = self.info['images'][ix]['height'], self.info['images'][ix]['width']
+            box_feat = np.hstack((x1/w, y1/h, x2/w, y2/h, (x2-x1)*(y2-y1)/(w*h))) # question? x2-x1+1??
+            if self.norm_box_feat:
+                box_feat = box_feat / np.linalg.norm(box_feat, 2, 1, keepdims=True)
+            att_feat = np.hstack([att_feat, box_feat])
+            # sort the features by the size of boxes (stable, as sorted)
+            att_feat = att_feat[np.argsort(-att_feat[:, -1], kind='stable')]
+        return att_feat
+
     def __getitem__(self, index):
         """This function returns a tuple that is further passed to collate_fn
         """
-        ix = index #self.split_ix[index]
+        ix, it_pos_now, epoch, wrapped = index
         if self.use_att:
-            att_feat = self.att_loader.get(str(self.info['images'][ix]['id']))
-            att_feat_vc = self.att_loader_vc.get(str(self.info['images'][ix]['id']))
-            assert att_feat.shape[0] == att_feat_vc.shape[0]
-            att_feat = np.hstack((att_feat, att_feat_vc))
-            # Reshape to K x C
-            att_feat = att_feat.reshape(-1, att_feat.shape[-1])
-            if self.norm_att_feat:
-                att_feat = att_feat / np.linalg.norm(att_feat, 2, 1, keepdims=True)
-            if self.use_box:
-                box_feat = self.box_loader.get(str(self.info['images'][ix]['id']))
-                # devided by image width and height
-                x1,y1,x2,y2 = np.hsplit(box_feat, 4)
-                h,w = self.info['images'][ix]['height'], self.info['images'][ix]['width']
-                box_feat = np.hstack((x1/w, y1/h, x2/w, y2/h, (x2-x1)*(y2-y1)/(w*h))) # question? x2-x1+1??
-                if self.norm_box_feat:
-                    box_feat = box_feat / np.linalg.norm(box_feat, 2, 1, keepdims=True)
-                att_feat = np.hstack([att_feat, box_feat])
-                # sort the features by the size of boxes
-                att_feat = np.stack(sorted(att_feat, key=lambda x:x[-1], reverse=True))
+            if self.att_stores:
+                # one slice of the prebuilt features
+                att_feat = self.att_stores[self.att_store_split[ix]].get(str(self.info['images'][ix]['id']))
+            else:
+                att_feat = self.load_att_feat(ix)
         else:
             att_feat = np.zeros((1,1,1), dtype='float32')
         if self.use_fc:
@@ -287,78 +368,65 @@ class DataLoader(data.Dataset):
             seq = None
         return (fc_feat,
                 att_feat, seq,
-                ix)
+                ix, it_pos_now, epoch, wrapped)
 
     def __len__(self):
         return len(self.info['images'])
 
-class SubsetSampler(torch.utils.data.sampler.Sampler):
-    r"""Samples elements randomly from a given list of indices, without replacement.
+class SplitSampler(torch.utils.data.sampler.Sampler):
+    r"""Endless sampler of the images of a split, pass after pass.
+    Every element is (ix, it_pos_now, epoch, wrapped): the image index, the
+    position after it in its pass, the pass number and whether it is the last
+    image of the pass. When shuffling, the order of a pass only depends on the
+    seed and the pass number, so (seed, epoch, position) is the whole state.
     Arguments:
         indices (list): a list of indices
+        shuffle (bool): shuffle every pass
     """
 
-    def __init__(self, indices):
+    def __init__(self, indices, shuffle=False):
         self.indices = indices
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2 ** 31)
+        self.epoch = 0
+        self.position = 0
+        # explicit orders of some passes (resumed from old infos)
+        self._orders = {}
+
+    def order(self, epoch):
+        if epoch in self._orders:
+            return self._orders[epoch]
+        if not self.shuffle:
+            return self.indices
+        perm = np.random.RandomState((self.seed + epoch) % 2 ** 32).permutation(len(self.indices))
+        return [self.indices[i] for i in perm]
 
     def __iter__(self):
-        return (self.indices[i] for i in range(len(self.indices)))
+        epoch, position = self.epoch, self.position
+        while len(self.indices) > 0:
+            order = self.order(epoch)
+            for pos in range(position, len(order)):
+                yield order[pos], pos + 1, epoch, pos + 1 == len(order)
+            epoch, position = epoch + 1, 0
 
     def __len__(self):
         return len(self.indices)
 
-class BlobFetcher():
-    """Experimental class for prefetching blobs in a separate process."""
-    def __init__(self, split, dataloader, if_shuffle=False):
-        """
-        db is a list of tuples containing: imcrop_name, caption, bbox_feat of gt box, imname
-        """
-        self.split = split
-        self.dataloader = dataloader
-        self.if_shuffle = if_shuffle
+    def state_dict(self, epoch, position):
+        state_dict = {'seed': self.seed, 'epoch': epoch, 'position': position}
+        if epoch in self._orders:
+            state_dict['order'] = self._orders[epoch]
+        return state_dict
 
-    # Add more in the queue
-    def reset(self):
+    def load_state_dict(self, state_dict):
         """
-        Two cases for this function to be triggered:
-        1. not hasattr(self, 'split_loader'): Resume from previous training. Create the dataset given the saved split_ix and iterator
-        2. wrapped: a new epoch, the split_ix and iterator have been updated in the get_minibatch_inds already.
+        Restarts at the given position of the given pass. Without an epoch,
+        the state is the order and position of an old BlobFetcher (the
+        iterators and split_ix of old infos).
         """
-        # batch_size is 1, the merge is done in DataLoader class
-        self.split_loader = iter(data.DataLoader(dataset=self.dataloader,
-                                            batch_size=1,
-                                            sampler=SubsetSampler(self.dataloader.split_ix[self.split][self.dataloader.iterators[self.split]:]),
-                                            shuffle=False,
-                                            pin_memory=True,
-                                            num_workers=4, # 4 is usually enough
-                                            collate_fn=lambda x: x[0]))
-
-    def _get_next_minibatch_inds(self):
-        max_index = len(self.dataloader.split_ix[self.split])
-        wrapped = False
-
-        ri = self.dataloader.iterators[self.split]
-        ix = self.dataloader.split_ix[self.split][ri]
-
-        ri_next = ri + 1
-        if ri_next >= max_index:
-            ri_next = 0
-            if self.if_shuffle:
-                random.shuffle(self.dataloader.split_ix[self.split])
-            wrapped = True
-        self.dataloader.iterators[self.split] = ri_next
-
-        return ix, wrapped
-    
-    def get(self):
-        if not hasattr(self, 'split_loader'):
-            self.reset()
-
-        ix, wrapped = self._get_next_minibatch_inds()
-        tmp = self.split_loader.next()
-        if wrapped:
-            self.reset()
-
-        assert tmp[-1] == ix, "ix not equal"
-
-        return tmp + [wrapped]
+        self.seed = state_dict.get('seed', self.seed)
+        self.epoch = state_dict.get('epoch', 0)
+        self.position = state_dict.get('position', 0)
+        self._orders = {}
+        if 'order' in state_dict:
+            self._orders[self.epoch] = list(state_dict['order'])
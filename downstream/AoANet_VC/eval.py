@@ -36,7 +36,7 @@ with open(opt.infos_path, 'rb') as f:
     infos = utils.pickle_load(f)
 
 # override and collect parameters
-replace = ['input_fc_dir', 'input_att_dir', 'input_box_dir', 'input_label_h5', 'input_json', 'batch_size', 'id']
+replace = ['input_fc_dir', 'input_att_dir', 'input_box_dir', 'input_att_store', 'input_label_h5', 'input_json', 'batch_size', 'id']
 ignore = ['start_from']
 
 for k in vars(infos['opt']).keys():
@@ -103,16 +103,21 @@ def eval_split(model, crit, loader, eval_kwargs={}):
             tmp = [_.cuda() if _ is not None else _ for _ in tmp]
             fc_feats, att_feats, labels, masks, att_masks = tmp
 
+            # one row per caption
+            seq_per_img = labels.size(1)
+            labels = labels.reshape(-1, labels.size(2))
+            masks = masks.reshape(-1, masks.size(2))
+            fc_feats, att_feats, att_masks = utils.repeat_tensors(seq_per_img,
+                [fc_feats, att_feats, att_masks])
+
             with torch.no_grad():
                 loss = crit(model(fc_feats, att_feats, labels, att_masks), labels[:,1:], masks[:,1:]).item()
             loss_sum = loss_sum + loss
             loss_evals = loss_evals + 1
 
         # forward the model to also get generated samples for each image
-        # Only leave one feature for each image, in case duplicate sample
-        tmp = [data['fc_feats'][np.arange(loader.batch_size) * loader.seq_per_img], 
-            data['att_feats'][np.arange(loader.batch_size) * loader.seq_per_img],
-            data['att_masks'][np.arange(loader.batch_size) * loader.seq_per_img] if data['att_masks'] is not None else None]
+        # (the features are given once per image)
+        tmp = [data['fc_feats'], data['att_feats'], data['att_masks']]
         tmp = [_.cuda() if _ is not None else _ for _ in tmp]
         fc_feats, att_feats, att_masks = tmp
         # forward the model to also get generated samples for each image
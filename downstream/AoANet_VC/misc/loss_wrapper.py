@@ -16,13 +16,23 @@ class LossWrapper(torch.nn.Module):
     def forward(self, fc_feats, att_feats, labels, masks, att_masks, gts, gt_indices,
                 sc_flag):
         out = {}
+        # the features come once per image, the labels and masks are
+        # batch x seq_per_img x length
+        seq_per_img = labels.size(1)
+        labels = labels.reshape(-1, labels.size(2))
+        masks = masks.reshape(-1, masks.size(2))
         if not sc_flag:
+            fc_feats, att_feats, att_masks = utils.repeat_tensors(seq_per_img,
+                [fc_feats, att_feats, att_masks])
             loss = self.crit(self.model(fc_feats, att_feats, labels, att_masks), labels[:,1:], masks[:,1:])
         else:
+            # a single greedy baseline per image
             self.model.eval()
             with torch.no_grad():
                 greedy_res, _ = self.model(fc_feats, att_feats, att_masks, mode='sample')
             self.model.train()
+            fc_feats, att_feats, att_masks = utils.repeat_tensors(seq_per_img,
+                [fc_feats, att_feats, att_masks])
             gen_result, sample_logprobs = self.model(fc_feats, att_feats, att_masks, opt={'sample_method':'sample'}, mode='sample')
             gts = [gts[_] for _ in gt_indices.tolist()]
             reward = get_self_critical_reward(greedy_res, gts, gen_result, self.opt)
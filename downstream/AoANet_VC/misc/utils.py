@@ -173,6 +173,21 @@ def build_optimizer(params, opt):
         raise Exception("bad option opt.optim: {}".format(opt.optim))
     
 
+def repeat_tensors(n, x):
+    """
+    For a tensor of size Bx..., repeat every row n times (Bnx..., the copies
+    of a row being contiguous). Lists and tuples are repeated elementwise,
+    None is kept.
+    """
+    if torch.is_tensor(x):
+        x = x.unsqueeze(1) # Bx1x...
+        x = x.expand(-1, n, *([-1]*len(x.shape[2:]))) # Bxnx...
+        x = x.reshape(x.shape[0]*n, *x.shape[2:]) # Bnx...
+    elif type(x) is list or type(x) is tuple:
+        x = [repeat_tensors(n, _) for _ in x]
+    return x
+
+
 def penalty_builder(penalty_config):
     if penalty_config == '':
         return lambda x,y: y
@@ -126,22 +126,21 @@ class FCModel(CaptionModel):
         assert beam_size <= self.vocab_size + 1, 'lets assume this for now, otherwise this corner case causes a few headaches down the road. can be dealt with in future if needed'
         seq = torch.LongTensor(self.seq_length, batch_size).zero_()
         seqLogprobs = torch.FloatTensor(self.seq_length, batch_size)
-        # lets process every image independently for now, for simplicity
+        # all the images are searched at once, with beam_size rows per image
 
-        self.done_beams = [[] for _ in range(batch_size)]
+        state = self.init_hidden(batch_size * beam_size)
+        for t in range(2):
+            if t == 0:
+                xt = utils.repeat_tensors(beam_size, self.img_embed(fc_feats))
+            elif t == 1: # input <bos>
+                it = fc_feats.data.new(batch_size * beam_size).long().zero_()
+                xt = self.embed(it)
+
+            output, state = self.core(xt, state)
+            logprobs = F.log_softmax(self.logit(output), dim=1)
+
+        self.done_beams = self.beam_search(state, logprobs, opt=opt)
         for k in range(batch_size):
-            state = self.init_hidden(beam_size)
-            for t in range(2):
-                if t == 0:
-                    xt = self.img_embed(fc_feats[k:k+1]).expand(beam_size, self.input_encoding_size)
-                elif t == 1: # input <bos>
-                    it = fc_feats.data.new(beam_size).long().zero_()
-                    xt = self.embed(it)
-
-                output, state = self.core(xt, state)
-                logprobs = F.log_softmax(self.logit(output), dim=1)
-
-            self.done_beams[k] = self.beam_search(state, logprobs, opt=opt)
             seq[:, k] = self.done_beams[k][0]['seq'] # the first beam has highest cumulative score
             seqLogprobs[:, k] = self.done_beams[k][0]['logps']
         # return the samples and their log likelihoods
@@ -101,28 +101,22 @@ class OldModel(CaptionModel):
         assert beam_size <= self.vocab_size + 1, 'lets assume this for now, otherwise this corner case causes a few headaches down the road. can be dealt with in future if needed'
         seq = torch.LongTensor(self.seq_length, batch_size).zero_()
         seqLogprobs = torch.FloatTensor(self.seq_length, batch_size)
-        # lets process every image independently for now, for simplicity
+        # all the images are searched at once, with beam_size rows per image
 
-        self.done_beams = [[] for _ in range(batch_size)]
+        tmp_fc_feats, tmp_att_feats = utils.repeat_tensors(beam_size, [fc_feats, att_feats])
+
+        state = self.init_hidden(tmp_fc_feats)
+
+        for t in range(1):
+            if t == 0: # input <bos>
+                it = fc_feats.data.new(batch_size * beam_size).long().zero_()
+                xt = self.embed(it)
+
+            output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state)
+            logprobs = F.log_softmax(self.logit(self.dropout(output)), dim=1)
+
+        self.done_beams = self.beam_search(state, logprobs, tmp_fc_feats, tmp_att_feats, opt=opt)
         for k in range(batch_size):
-            tmp_fc_feats = fc_feats[k:k+1].expand(beam_size, self.fc_feat_size)
-            tmp_att_feats = att_feats[k:k+1].expand(*((beam_size,)+att_feats.size()[1:])).contiguous()
-            
-            state = self.init_hidden(tmp_fc_feats)
-
-            beam_seq = torch.LongTensor(self.seq_length, beam_size).zero_()
-            beam_seq_logprobs = torch.FloatTensor(self.seq_length, beam_size).zero_()
-            beam_logprobs_sum = torch.zeros(beam_size) # running sum of logprobs for each beam
-            done_beams = []
-            for t in range(1):
-                if t == 0: # input <bos>
-                    it = fc_feats.data.new(beam_size).long().zero_()
-                    xt = self.embed(it)
-
-                output, state = self.core(xt, tmp_fc_feats, tmp_att_feats, state)
-                logprobs = F.log_softmax(self.logit(self.dropout(output)), dim=1)
-
-            self.done_beams[k] = self.beam_search(state, logprobs, tmp_fc_feats, tmp_att_feats, opt=opt)
             seq[:, k] = self.done_beams[k][0]['seq'] # the first beam has highest cumulative score
             seqLogprobs[:, k] = self.done_beams[k][0]['logps']
         # return the samples and their log likelihoods
@@ -47,6 +47,12 @@ class EncoderDecoder(nn.Module):
     def decode(self, memory, src_mask, tgt, tgt_mask):
         return self.decoder(self.tgt_embed(tgt), memory, src_mask, tgt_mask)
 
+    def decode_step(self, memory_kv, src_mask, tgt, keys, values):
+        "Decode the next token tgt, given the keys/values cached for the previous ones."
+        x = self.tgt_embed[0](tgt.unsqueeze(1))
+        x = self.tgt_embed[1](x, keys.size(3))
+        return self.decoder.step(x, memory_kv, src_mask, keys, values)
+
 class Generator(nn.Module):
     "Define standard linear + softmax generation step."
     def __init__(self, d_model, vocab):
@@ -126,6 +132,28 @@ class Decoder(nn.Module):
             x = layer(x, memory, src_mask, tgt_mask)
         return self.norm(x)
 
+    def project_memory(self, memory):
+        """
+        Projects the memory to the keys/values of the source attention of
+        every layer, once per image: batch x N x 2 x h x L x d_k.
+        """
+        return torch.stack([torch.stack(layer.src_attn.project_kv(memory, memory), 1)
+                            for layer in self.layers], 1)
+
+    def step(self, x, memory_kv, src_mask, keys, values):
+        """
+        Decodes the newest token x (batch x 1 x d_model). keys/values hold
+        the self-attention keys/values of the previous tokens
+        (N x batch x h x t x d_k) and are returned extended with x.
+        """
+        new_keys, new_values = [], []
+        for i, layer in enumerate(self.layers):
+            x, key, value = layer.step(x, memory_kv[:, i, 0], memory_kv[:, i, 1],
+                                       src_mask, keys[i], values[i])
+            new_keys.append(key)
+            new_values.append(value)
+        return self.norm(x), torch.stack(new_keys), torch.stack(new_values)
+
 class DecoderLayer(nn.Module):
     "Decoder is made of self-attn, src-attn, and feed forward (defined below)"
     def __init__(self, size, self_attn, src_attn, feed_forward, dropout):
@@ -143,6 +171,16 @@ class DecoderLayer(nn.Module):
         x = self.sublayer[1](x, lambda x: self.src_attn(x, m, m, src_mask))
         return self.sublayer[2](x, self.feed_forward)
 
+    def step(self, x, memory_key, memory_value, src_mask, key, value):
+        "Same as forward for the newest token only, see Decoder.step."
+        y = self.sublayer[0].norm(x)
+        new_key, new_value = self.self_attn.project_kv(y, y)
+        key = torch.cat([key, new_key], 2)
+        value = torch.cat([value, new_value], 2)
+        x = x + self.sublayer[0].dropout(self.self_attn.attend(y, key, value))
+        x = self.sublayer[1](x, lambda x: self.src_attn.attend(x, memory_key, memory_value, src_mask))
+        return self.sublayer[2](x, self.feed_forward), key, value
+
 def subsequent_mask(size):
     "Mask out subsequent positions."
     attn_shape = (1, size, size)
@@ -194,6 +232,26 @@ class MultiHeadedAttention(nn.Module):
              .view(nbatches, -1, self.h * self.d_k)
         return self.linears[-1](x)
 
+    def _split_heads(self, l, x):
+        return l(x).view(x.size(0), -1, self.h, self.d_k).transpose(1, 2)
+
+    def project_kv(self, key, value):
+        "Projects key and value to batch x h x len x d_k, for attend."
+        return (self._split_heads(self.linears[1], key),
+                self._split_heads(self.linears[2], value))
+
+    def attend(self, query, key, value, mask=None):
+        "Same as forward, with key and value already projected by project_kv."
+        if mask is not None:
+            mask = mask.unsqueeze(1)
+        nbatches = query.size(0)
+        query = self._split_heads(self.linears[0], query)
+        x, self.attn = attention(query, key, value, mask=mask,
+                                 dropout=self.dropout)
+        x = x.transpose(1, 2).contiguous() \
+             .view(nbatches, -1, self.h * self.d_k)
+        return self.linears[-1](x)
+
 class PositionwiseFeedForward(nn.Module):
     "Implements FFN equation."
     def __init__(self, d_model, d_ff, dropout=0.1):
@@ -230,8 +288,8 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
         
-    def forward(self, x):
-        x = x + self.pe[:, :x.size(1)]
+    def forward(self, x, start=0):
+        x = x + self.pe[:, start:start + x.size(1)]
         return self.dropout(x)
 
 class TransformerModel(AttModel):
@@ -295,8 +353,11 @@ class TransformerModel(AttModel):
 
         att_feats, seq, att_masks, seq_mask = self._prepare_feature_forward(att_feats, att_masks)
         memory = self.model.encode(att_feats, att_masks)
+        # the source attention keys/values are computed once, core only
+        # decodes the newest token
+        memory_kv = self.model.decoder.project_memory(memory)
 
-        return fc_feats[...,:1], att_feats[...,:1], memory, att_masks
+        return fc_feats[...,:1], memory_kv, memory, att_masks
 
     def _prepare_feature_forward(self, att_feats, att_masks=None, seq=None):
         att_feats, att_masks = self.clip_att(att_feats, att_masks)
@@ -329,16 +390,15 @@ class TransformerModel(AttModel):
         return outputs
         # return torch.cat([_.unsqueeze(1) for _ in outputs], 1)
 
-    def core(self, it, fc_feats_ph, att_feats_ph, memory, state, mask):
+    def core(self, it, fc_feats_ph, memory_kv, memory, state, mask):
         """
-        state = [ys.unsqueeze(0)]
+        state = [keys, values], the self-attention keys/values of the
+        previous tokens, num_layers x batch x h x t x d_k (the batch is the
+        dimension 1, so beam_search reorders them with the beams)
         """
         if len(state) == 0:
-            ys = it.unsqueeze(1)
-        else:
-            ys = torch.cat([state[0][0], it.unsqueeze(1)], dim=1)
-        out = self.model.decode(memory, mask, 
-                               ys, 
-                               subsequent_mask(ys.size(1))
-                                        .to(memory.device))
-        return out[:, -1], [ys.unsqueeze(0)]
\ No newline at end of file
+            batch_size, num_layers, _, h, _, d_k = memory_kv.shape
+            empty = memory_kv.new_zeros((num_layers, batch_size, h, 0, d_k))
+            state = [empty, empty]
+        out, keys, values = self.model.decode_step(memory_kv, mask, it, state[0], state[1])
+        return out[:, -1], [keys, values]
\ No newline at end of file
@@ -88,6 +88,7 @@ class Cfgs(PATH):
 
         # Max length of extracted faster-rcnn 2048D features
         # (bottom-up and Top-down: https://github.com/peteanderson80/bottom-up-attention)
+        # (the batches are only padded to their most boxes, up to this size)
         self.IMG_FEAT_PAD_SIZE = 100
 
         # Faster-rcnn 2048D features
@@ -111,6 +112,8 @@ class Cfgs(PATH):
 
         # Set 'external': use external shuffle method to implement training shuffle
         # Set 'internal': use pytorch dataloader default shuffle method
+        # Set 'bucket': shuffle, then batch the samples with close numbers of
+        # boxes together (less padding with adaptive 10-100 box features)
         self.SHUFFLE_MODE = 'external'
 
 
@@ -42,6 +42,10 @@ class PATH:
             'vg': self.DATASET_PATH + 'VG_annotations.json',
         }
 
+        # Precompiled question/answer tensors (utils/proc_qa_cache.py),
+        # used instead of the json files above when present
+        self.QA_CACHE_PATH = self.DATASET_PATH + 'qa_cache/'
+
         self.RESULT_PATH = './results/result_test/'
         self.PRED_PATH = './results/pred/'
         self.CACHE_PATH = './results/cache/'
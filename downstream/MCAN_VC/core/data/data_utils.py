@@ -6,7 +6,11 @@
 
 from core.data.ans_punct import prep_ans
 import numpy as np
-import en_vectors_web_lg, random, re, json
+import en_vectors_web_lg, random, re, json, os, torch
+
+
+# Max number of distinct answers of a question (10 annotators in VQA)
+MAX_ANS_NUM = 10
 
 
 def shuffle_list(ans_list):
@@ -40,6 +44,59 @@ def img_feat_load(path_list):
     return iid_to_feat
 
 
+class FlatFeatStore:
+    """
+    Memory-mapped flat feature store (vc_rcnn.tools.featstore, flat format):
+    the box features of all images in one features.bin, an (offset, count)
+    row per image in index.npy. get() returns a view of the mapped file, the
+    pages are shared by all the DataLoader workers.
+    """
+    def __init__(self, path):
+        meta = json.load(open(os.path.join(path, 'meta.json'), 'r'))
+        names = json.load(open(os.path.join(path, 'names.json'), 'r'))
+        self.name_to_ix = {name: ix for ix, name in enumerate(names)}
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self.feat = np.memmap(os.path.join(path, 'features.bin'),
+                              dtype=meta['dtype'], mode='r',
+                              shape=(meta['num_boxes'], meta['dim']))
+
+    def get(self, iid):
+        offset, count = self.index[self.name_to_ix[iid]]
+        return self.feat[offset:offset + count]
+
+    def count(self, iid):
+        return int(self.index[self.name_to_ix[iid], 1])
+
+
+def is_flat_feat_store(path):
+    return os.path.exists(os.path.join(path, 'features.bin'))
+
+
+def is_qa_cache(path):
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def qa_cache_load(path, split_list):
+    """
+    Load the question/answer tensors written by utils/proc_qa_cache.py:
+    the vocabulary and the embedding matrix, and per split the token ids and
+    image ids of the questions and the sparse (index, score) answers of the
+    annotations, memory-mapped.
+    """
+    meta = json.load(open(os.path.join(path, 'meta.json'), 'r'))
+    token_to_ix = json.load(open(os.path.join(path, 'token_to_ix.json'), 'r'))
+    pretrained_emb = np.load(os.path.join(path, 'pretrained_emb.npy'))
+
+    splits = []
+    for split in split_list:
+        splits.append({
+            name: np.load(os.path.join(path, split + '_' + name + '.npy'), mmap_mode='r')
+            for name in meta['splits'][split]
+        })
+
+    return meta, token_to_ix, pretrained_emb, splits
+
+
 def ques_load(ques_list):
     qid_to_ques = {}
 
@@ -116,17 +173,11 @@ def ans_stat(json_file):
 # ------------------------------------
 
 def proc_img_feat(img_feat, img_feat_pad_size):
+    # Only truncated, pad_collate pads to the most boxes of the batch
     if img_feat.shape[0] > img_feat_pad_size:
         img_feat = img_feat[:img_feat_pad_size]
 
-    img_feat = np.pad(
-        img_feat,
-        ((0, img_feat_pad_size - img_feat.shape[0]), (0, 0)),
-        mode='constant',
-        constant_values=0
-    )
-
-    return img_feat
+    return np.ascontiguousarray(img_feat)
 
 
 def proc_ques(ques, token_to_ix, max_token):
@@ -164,7 +215,13 @@ def get_score(occur):
 
 
 def proc_ans(ans, ans_to_ix):
-    ans_score = np.zeros(ans_to_ix.__len__(), np.float32)
+    """
+    Sparse answer target: the indices and scores of the (at most
+    MAX_ANS_NUM) answers in the vocabulary, padded with score 0,
+    scatter_ans() makes the dense target on the GPU
+    """
+    ans_ix = np.zeros(MAX_ANS_NUM, np.int64)
+    ans_score = np.zeros(MAX_ANS_NUM, np.float32)
     ans_prob_dict = {}
 
     for ans_ in ans['answers']:
@@ -174,9 +231,19 @@ def proc_ans(ans, ans_to_ix):
         else:
             ans_prob_dict[ans_proc] += 1
 
+    ix = 0
     for ans_ in ans_prob_dict:
         if ans_ in ans_to_ix:
-            ans_score[ans_to_ix[ans_]] = get_score(ans_prob_dict[ans_])
+            ans_ix[ix] = ans_to_ix[ans_]
+            ans_score[ix] = get_score(ans_prob_dict[ans_])
+            ix += 1
+
+    return ans_ix, ans_score
+
 
-    return ans_score
+def scatter_ans(ans_ix, ans_score, ans_size):
+    return torch.zeros(
+        ans_ix.size(0), ans_size,
+        dtype=ans_score.dtype, device=ans_score.device
+    ).scatter_add_(1, ans_ix, ans_score)
 
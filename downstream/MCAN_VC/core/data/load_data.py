@@ -5,10 +5,12 @@
 # --------------------------------------------------------
 
 from core.data.data_utils import img_feat_path_load, img_feat_load, ques_load, tokenize, ans_stat
+from core.data.data_utils import FlatFeatStore, is_flat_feat_store
+from core.data.data_utils import qa_cache_load, is_qa_cache
 from core.data.data_utils import proc_img_feat, proc_ques, proc_ans
 
 import numpy as np
-import glob, json, torch, time
+import glob, json, random, torch, time
 import torch.utils.data as Data
 
 
@@ -18,6 +20,13 @@ class DataSet(Data.Dataset):
         self.feature_path_vc = __C.FEATURE_PATH_VC
         self.feature_path_bu = __C.FEATURE_PATH_BU
 
+        # Flat feature stores (converted with vc_rcnn.tools.featstore) are
+        # memory-mapped instead of loading one file per image
+        self.flat_vc = FlatFeatStore(self.feature_path_vc) \
+            if is_flat_feat_store(self.feature_path_vc) else None
+        self.flat_bu = FlatFeatStore(self.feature_path_bu) \
+            if is_flat_feat_store(self.feature_path_bu) else None
+
         # --------------------------
         # ---- Raw data loading ----
         # --------------------------
@@ -39,6 +48,73 @@ class DataSet(Data.Dataset):
         #         glob.glob(__C.IMG_FEAT_PATH['val'] + '*.npz') + \
         #         glob.glob(__C.IMG_FEAT_PATH['test'] + '*.npz')
 
+        # Precompiled question/answer tensors (utils/proc_qa_cache.py) replace
+        # the json question/answer lists and the tokenization
+        self.qa_cache = is_qa_cache(__C.QA_CACHE_PATH)
+        if self.qa_cache:
+            self.init_qa_cache()
+        else:
+            self.init_qa_json()
+
+        print('== Dataset size:', self.data_size)
+        print('== Question token vocab size:', self.token_size)
+
+        # {image id} -> {image feature absolutely path}
+        if self.__C.PRELOAD:
+            print('==== Pre-Loading features ...')
+            time_start = time.time()
+            self.iid_to_img_feat = img_feat_load(self.img_feat_path_list)
+            time_end = time.time()
+            print('==== Finished in {}s'.format(int(time_end-time_start)))
+        else:
+            self.iid_to_img_feat_path = img_feat_path_load(self.img_feat_path_list)
+
+        # Answers statistic
+        # Make answer dict during training does not guarantee
+        # the same order of {ans_to_ix}, so we published our
+        # answer dict to ensure that our pre-trained model
+        # can be adapted on each machine.
+
+        # Thanks to Licheng Yu (https://github.com/lichengunc)
+        # for finding this bug and providing the solutions.
+
+        # self.ans_to_ix, self.ix_to_ans = ans_stat(self.stat_ans_list, __C.ANS_FREQ)
+        self.ans_to_ix, self.ix_to_ans = ans_stat('core/data/answer_dict.json')
+        self.ans_size = self.ans_to_ix.__len__()
+
+        # {image id} -> {number of boxes}, filled by img_feat_lens()
+        self.iid_to_img_feat_num = {}
+        if self.qa_cache:
+            assert self.qa_meta['ans_size'] == self.ans_size
+        print('== Answer vocab size (occurr more than {} times):'.format(8), self.ans_size)
+        print('Finished!')
+        print('')
+
+
+    def init_qa_cache(self):
+        split_list = self.__C.SPLIT[self.__C.RUN_MODE].split('+')
+        self.qa_meta, self.token_to_ix, self.pretrained_emb, self.qa_splits = \
+            qa_cache_load(self.__C.QA_CACHE_PATH, split_list)
+        assert self.qa_meta['max_token'] >= self.__C.MAX_TOKEN
+        assert self.qa_meta['use_glove'] or not self.__C.USE_GLOVE
+        self.token_size = self.token_to_ix.__len__()
+
+        # The splits are concatenated, a row is found from the offsets
+        self.ques_offsets = np.cumsum([0] + [split['ques_ix'].shape[0] for split in self.qa_splits])
+        self.qid_list = np.concatenate([split['qid'] for split in self.qa_splits]).tolist()
+
+        if self.__C.RUN_MODE in ['train']:
+            self.ans_offsets = np.cumsum([0] + [split['ans_ix'].shape[0] for split in self.qa_splits])
+            # Annotation rows, shuffled in place for the external shuffle
+            self.ans_list = list(range(self.ans_offsets[-1]))
+            self.data_size = self.ans_list.__len__()
+        else:
+            self.data_size = self.qid_list.__len__()
+
+
+    def init_qa_json(self):
+        __C = self.__C
+
         # Loading question word list
         self.stat_ques_list = \
             json.load(open(__C.QUESTION_PATH['train'], 'r'))['questions'] + \
@@ -67,22 +143,7 @@ class DataSet(Data.Dataset):
         else:
             self.data_size = self.ques_list.__len__()
 
-        print('== Dataset size:', self.data_size)
-
-
-        # ------------------------
-        # ---- Data statistic ----
-        # ------------------------
-
-        # {image id} -> {image feature absolutely path}
-        if self.__C.PRELOAD:
-            print('==== Pre-Loading features ...')
-            time_start = time.time()
-            self.iid_to_img_feat = img_feat_load(self.img_feat_path_list)
-            time_end = time.time()
-            print('==== Finished in {}s'.format(int(time_end-time_start)))
-        else:
-            self.iid_to_img_feat_path = img_feat_path_load(self.img_feat_path_list)
+        self.qid_list = [ques['question_id'] for ques in self.ques_list]
 
         # {question id} -> {question}
         self.qid_to_ques = ques_load(self.ques_list)
@@ -90,23 +151,72 @@ class DataSet(Data.Dataset):
         # Tokenize
         self.token_to_ix, self.pretrained_emb = tokenize(self.stat_ques_list, __C.USE_GLOVE)
         self.token_size = self.token_to_ix.__len__()
-        print('== Question token vocab size:', self.token_size)
 
-        # Answers statistic
-        # Make answer dict during training does not guarantee
-        # the same order of {ans_to_ix}, so we published our
-        # answer dict to ensure that our pre-trained model
-        # can be adapted on each machine.
 
-        # Thanks to Licheng Yu (https://github.com/lichengunc)
-        # for finding this bug and providing the solutions.
+    def load_img_feat(self, iid):
+        if self.__C.PRELOAD:
+            return self.iid_to_img_feat[iid]
 
-        # self.ans_to_ix, self.ix_to_ans = ans_stat(self.stat_ans_list, __C.ANS_FREQ)
-        self.ans_to_ix, self.ix_to_ans = ans_stat('core/data/answer_dict.json')
-        self.ans_size = self.ans_to_ix.__len__()
-        print('== Answer vocab size (occurr more than {} times):'.format(8), self.ans_size)
-        print('Finished!')
-        print('')
+        # modified by Tan Wang
+        if self.flat_vc is not None:
+            img_feat_vc = self.flat_vc.get(iid)
+        else:
+            img_feat_vc = np.load(self.feature_path_vc + '/' + iid + '.npy')
+        if self.flat_bu is not None:
+            img_feat_x = self.flat_bu.get(iid)[:img_feat_vc.shape[0], :]
+            assert img_feat_x.shape[0] == img_feat_vc.shape[0]
+        else:
+            img_feat = np.load(self.iid_to_img_feat_path[iid])
+            img_feat_x = img_feat['x'].transpose((1, 0))
+            try:
+                assert img_feat_x.shape[0] == img_feat_vc.shape[0]
+            except:
+                print(iid)
+                img_feat = np.load(self.feature_path_bu + '/' + iid + '.npy')
+                img_feat_x = img_feat[:img_feat_vc.shape[0],:]
+                assert img_feat_x.shape[0] == img_feat_vc.shape[0]
+        # fp16 stores are cast back to float32
+        return np.hstack((img_feat_x, img_feat_vc)).astype(np.float32, copy=False)
+
+
+    def img_feat_num(self, iid):
+        if self.__C.PRELOAD:
+            return self.iid_to_img_feat[iid].shape[0]
+
+        # The bottom-up features are cut to the VC boxes in load_img_feat
+        if self.flat_vc is not None:
+            return self.flat_vc.count(iid)
+        return np.load(self.feature_path_vc + '/' + iid + '.npy', mmap_mode='r').shape[0]
+
+
+    def sample_iid(self, idx):
+        if self.qa_cache:
+            if self.__C.RUN_MODE in ['train']:
+                split, row = self.qa_cache_row(self.ans_offsets, self.ans_list[idx])
+                return str(split['iid'][split['ans_ques'][row]])
+            split, ques_row = self.qa_cache_row(self.ques_offsets, idx)
+            return str(split['iid'][ques_row])
+
+        if self.__C.RUN_MODE in ['train']:
+            return str(self.ans_list[idx]['image_id'])
+        return str(self.ques_list[idx]['image_id'])
+
+
+    def img_feat_lens(self):
+        # Number of boxes of every sample (in the current ans_list order)
+        lens = np.zeros(self.data_size, np.int64)
+        for idx in range(self.data_size):
+            iid = self.sample_iid(idx)
+            if iid not in self.iid_to_img_feat_num:
+                self.iid_to_img_feat_num[iid] = self.img_feat_num(iid)
+            lens[idx] = min(self.iid_to_img_feat_num[iid], self.__C.IMG_FEAT_PAD_SIZE)
+
+        return lens
+
+
+    def qa_cache_row(self, offsets, row):
+        split = np.searchsorted(offsets, row, side='right') - 1
+        return self.qa_splits[split], row - offsets[split]
 
 
     def __getitem__(self, idx):
@@ -114,61 +224,44 @@ class DataSet(Data.Dataset):
         # For code safety
         img_feat_iter = np.zeros(1)
         ques_ix_iter = np.zeros(1)
-        ans_iter = np.zeros(1)
+        ans_ix_iter = np.zeros(1, np.int64)
+        ans_score_iter = np.zeros(1, np.float32)
 
         # Process ['train'] and ['val', 'test'] respectively
-        if self.__C.RUN_MODE in ['train']:
+        if self.qa_cache:
+            if self.__C.RUN_MODE in ['train']:
+                split, row = self.qa_cache_row(self.ans_offsets, self.ans_list[idx])
+                ans_ix_iter = split['ans_ix'][row].astype(np.int64)
+                ans_score_iter = np.array(split['ans_score'][row])
+                ques_row = split['ans_ques'][row]
+            else:
+                split, ques_row = self.qa_cache_row(self.ques_offsets, idx)
+
+            img_feat_x = self.load_img_feat(str(split['iid'][ques_row]))
+            img_feat_iter = proc_img_feat(img_feat_x, self.__C.IMG_FEAT_PAD_SIZE)
+            ques_ix_iter = split['ques_ix'][ques_row, :self.__C.MAX_TOKEN].astype(np.int64)
+
+        elif self.__C.RUN_MODE in ['train']:
             # Load the run data from list
             ans = self.ans_list[idx]
             ques = self.qid_to_ques[str(ans['question_id'])]
 
             # Process image feature from (.npz) file
-            if self.__C.PRELOAD:
-                img_feat_x = self.iid_to_img_feat[str(ans['image_id'])]
-            else:
-                # modified by Tan Wang
-                img_feat = np.load(self.iid_to_img_feat_path[str(ans['image_id'])])
-                img_feat_x = img_feat['x'].transpose((1, 0))
-                img_feat_vc = np.load(self.feature_path_vc + '/' + str(ans['image_id']) + '.npy')
-                try:
-                    assert img_feat_x.shape[0] == img_feat_vc.shape[0]
-                except:
-                    print(ans['image_id'])
-                    img_feat = np.load(self.feature_path_bu + '/' + str(ans['image_id']) + '.npy')
-                    img_feat_x = img_feat[:img_feat_vc.shape[0],:]
-                    assert img_feat_x.shape[0] == img_feat_vc.shape[0]
-                img_feat_x = np.hstack((img_feat_x, img_feat_vc))
+            img_feat_x = self.load_img_feat(str(ans['image_id']))
             img_feat_iter = proc_img_feat(img_feat_x, self.__C.IMG_FEAT_PAD_SIZE)
 
             # Process question
             ques_ix_iter = proc_ques(ques, self.token_to_ix, self.__C.MAX_TOKEN)
 
             # Process answer
-            ans_iter = proc_ans(ans, self.ans_to_ix)
+            ans_ix_iter, ans_score_iter = proc_ans(ans, self.ans_to_ix)
 
         else:
             # Load the run data from list
             ques = self.ques_list[idx]
 
-            # # Process image feature from (.npz) file
-            # img_feat = np.load(self.iid_to_img_feat_path[str(ques['image_id'])])
-            # img_feat_x = img_feat['x'].transpose((1, 0))
             # Process image feature from (.npz) file
-            if self.__C.PRELOAD:
-                img_feat_x = self.iid_to_img_feat[str(ques['image_id'])]
-            else:
-                # modified by Tan Wang
-                img_feat = np.load(self.iid_to_img_feat_path[str(ques['image_id'])])
-                img_feat_x = img_feat['x'].transpose((1, 0))
-                img_feat_vc = np.load(self.feature_path_vc + '/' + str(ques['image_id']) + '.npy')
-                try:
-                    assert img_feat_x.shape[0] == img_feat_vc.shape[0]
-                except:
-                    print(ques['image_id'])
-                    img_feat = np.load(self.feature_path_bu + '/' + str(ques['image_id']) + '.npy')
-                    img_feat_x = img_feat[:img_feat_vc.shape[0],:]
-                    assert img_feat_x.shape[0] == img_feat_vc.shape[0]
-                img_feat_x = np.hstack((img_feat_x, img_feat_vc))
+            img_feat_x = self.load_img_feat(str(ques['image_id']))
             img_feat_iter = proc_img_feat(img_feat_x, self.__C.IMG_FEAT_PAD_SIZE)
 
             # Process question
@@ -177,10 +270,67 @@ class DataSet(Data.Dataset):
 
         return torch.from_numpy(img_feat_iter), \
                torch.from_numpy(ques_ix_iter), \
-               torch.from_numpy(ans_iter)
+               torch.from_numpy(ans_ix_iter), \
+               torch.from_numpy(ans_score_iter)
 
 
     def __len__(self):
         return self.data_size
 
 
+def pad_collate(batch):
+    """
+    Pad the image features to the most boxes of the batch, the mask of the
+    padded boxes (as Net.make_mask) is returned after the features
+    """
+    img_feat_list, ques_ix, ans_ix, ans_score = zip(*batch)
+    img_feat_num = [img_feat.shape[0] for img_feat in img_feat_list]
+
+    img_feat = img_feat_list[0].new_zeros(
+        len(img_feat_list), max(img_feat_num), img_feat_list[0].shape[1])
+    img_feat_mask = torch.ones(len(img_feat_list), max(img_feat_num), dtype=torch.bool)
+    for ix, (feat, num) in enumerate(zip(img_feat_list, img_feat_num)):
+        img_feat[ix, :num] = feat
+        img_feat_mask[ix, :num] = False
+
+    return img_feat, \
+           img_feat_mask.unsqueeze(1).unsqueeze(2), \
+           torch.stack(ques_ix), \
+           torch.stack(ans_ix), \
+           torch.stack(ans_score)
+
+
+class BucketBatchSampler(Data.Sampler):
+    """
+    Shuffle the samples, sort them by number of boxes within buckets of
+    bucket_batches batches and shuffle the batches, so that a batch is only
+    padded to close numbers of boxes
+    """
+    def __init__(self, dataset, batch_size, bucket_batches=100, drop_last=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        lens = self.dataset.img_feat_lens()
+        ids = np.random.permutation(lens.shape[0])
+
+        batches = []
+        for start in range(0, ids.shape[0], self.bucket_size):
+            bucket = ids[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(lens[bucket], kind='stable')]
+            for batch_start in range(0, bucket.shape[0], self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if batch.shape[0] == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        random.shuffle(batches)
+
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.dataset.data_size // self.batch_size
+        return (self.dataset.data_size + self.batch_size - 1) // self.batch_size
+
+
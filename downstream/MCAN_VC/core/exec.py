@@ -4,10 +4,10 @@
 # Written by Yuhao Cui https://github.com/cuiyuhao1996
 # --------------------------------------------------------
 
-from core.data.load_data import DataSet
+from core.data.load_data import DataSet, BucketBatchSampler, pad_collate
 from core.model.net import Net
 from core.model.optim import get_optim, adjust_lr
-from core.data.data_utils import shuffle_list
+from core.data.data_utils import shuffle_list, scatter_ans
 from utils.vqa import VQA
 from utils.vqaEval import VQAEval
 
@@ -107,7 +107,16 @@ class Execution:
                 shuffle=False,
                 num_workers=self.__C.NUM_WORKERS,
                 pin_memory=self.__C.PIN_MEM,
-                drop_last=True
+                drop_last=True,
+                collate_fn=pad_collate
+            )
+        elif self.__C.SHUFFLE_MODE in ['bucket']:
+            dataloader = Data.DataLoader(
+                dataset,
+                batch_sampler=BucketBatchSampler(dataset, self.__C.BATCH_SIZE),
+                num_workers=self.__C.NUM_WORKERS,
+                pin_memory=self.__C.PIN_MEM,
+                collate_fn=pad_collate
             )
         else:
             dataloader = Data.DataLoader(
@@ -116,7 +125,8 @@ class Execution:
                 shuffle=True,
                 num_workers=self.__C.NUM_WORKERS,
                 pin_memory=self.__C.PIN_MEM,
-                drop_last=True
+                drop_last=True,
+                collate_fn=pad_collate
             )
 
         # Training script
@@ -147,21 +157,32 @@ class Execution:
             # Iteration
             for step, (
                     img_feat_iter,
+                    img_feat_mask_iter,
                     ques_ix_iter,
-                    ans_iter
+                    ans_ix_iter,
+                    ans_score_iter
             ) in enumerate(dataloader):
 
                 optim.zero_grad()
 
                 img_feat_iter = img_feat_iter.cuda()
+                img_feat_mask_iter = img_feat_mask_iter.cuda()
                 ques_ix_iter = ques_ix_iter.cuda()
-                ans_iter = ans_iter.cuda()
+                # The dense answer scores are built on the GPU
+                ans_iter = scatter_ans(
+                    ans_ix_iter.cuda(),
+                    ans_score_iter.cuda(),
+                    ans_size
+                )
 
                 for accu_step in range(self.__C.GRAD_ACCU_STEPS):
 
                     sub_img_feat_iter = \
                         img_feat_iter[accu_step * self.__C.SUB_BATCH_SIZE:
                                       (accu_step + 1) * self.__C.SUB_BATCH_SIZE]
+                    sub_img_feat_mask_iter = \
+                        img_feat_mask_iter[accu_step * self.__C.SUB_BATCH_SIZE:
+                                           (accu_step + 1) * self.__C.SUB_BATCH_SIZE]
                     sub_ques_ix_iter = \
                         ques_ix_iter[accu_step * self.__C.SUB_BATCH_SIZE:
                                      (accu_step + 1) * self.__C.SUB_BATCH_SIZE]
@@ -172,7 +193,8 @@ class Execution:
 
                     pred = net(
                         sub_img_feat_iter,
-                        sub_ques_ix_iter
+                        sub_ques_ix_iter,
+                        sub_img_feat_mask_iter
                     )
 
                     loss = loss_fn(pred, sub_ans_iter)
@@ -301,7 +323,7 @@ class Execution:
             print('Finish!')
 
         # Store the prediction list
-        qid_list = [ques['question_id'] for ques in dataset.ques_list]
+        qid_list = dataset.qid_list
         ans_ix_list = []
         pred_list = []
 
@@ -329,13 +351,16 @@ class Execution:
             batch_size=self.__C.EVAL_BATCH_SIZE,
             shuffle=False,
             num_workers=self.__C.NUM_WORKERS,
-            pin_memory=True
+            pin_memory=True,
+            collate_fn=pad_collate
         )
 
         for step, (
                 img_feat_iter,
+                img_feat_mask_iter,
                 ques_ix_iter,
-                ans_iter
+                ans_ix_iter,
+                ans_score_iter
         ) in enumerate(dataloader):
             print("\rEvaluation: [step %4d/%4d]" % (
                 step,
@@ -343,11 +368,13 @@ class Execution:
             ), end='          ')
 
             img_feat_iter = img_feat_iter.cuda()
+            img_feat_mask_iter = img_feat_mask_iter.cuda()
             ques_ix_iter = ques_ix_iter.cuda()
 
             pred = net(
                 img_feat_iter,
-                ques_ix_iter
+                ques_ix_iter,
+                img_feat_mask_iter
             )
             pred_np = pred.cpu().data.numpy()
             pred_argmax = np.argmax(pred_np, axis=1)
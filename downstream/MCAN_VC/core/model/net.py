@@ -92,11 +92,13 @@ class Net(nn.Module):
         self.proj = nn.Linear(__C.FLAT_OUT_SIZE, answer_size)
 
 
-    def forward(self, img_feat, ques_ix):
+    def forward(self, img_feat, ques_ix, img_feat_mask=None):
 
         # Make mask
+        # (the image mask is given by pad_collate)
         lang_feat_mask = self.make_mask(ques_ix.unsqueeze(2))
-        img_feat_mask = self.make_mask(img_feat)
+        if img_feat_mask is None:
+            img_feat_mask = self.make_mask(img_feat)
 
         # Pre-process Language Feature
         lang_feat = self.embedding(ques_ix)
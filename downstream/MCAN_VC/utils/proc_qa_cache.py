@@ -0,0 +1,84 @@
+# --------------------------------------------------------
+# mcan-vqa (Deep Modular Co-Attention Networks)
+# Licensed under The MIT License [see LICENSE for details]
+# Written by Yuhao Cui https://github.com/cuiyuhao1996
+# --------------------------------------------------------
+
+# Precompile the questions and answers once for the DataSet
+# (cfgs QA_CACHE_PATH): the vocabulary and the GloVe embedding matrix, and
+# per split the token ids and image ids of the questions and the sparse
+# (index, score) answers of the annotations, as .npy files.
+# Run from this directory, as proc_ansdict.py.
+
+import sys
+sys.path.append('../')
+from core.data.data_utils import tokenize, proc_ques, proc_ans, ans_stat
+import numpy as np
+import json, os
+
+DATASET_PATH = '../datasets/vqa/'
+OUTPUT_PATH = DATASET_PATH + 'qa_cache/'
+
+# As in cfgs/base_cfgs.py, the DataSet can use any MAX_TOKEN up to this one
+MAX_TOKEN = 14
+USE_GLOVE = True
+
+QUESTION_PATH = {
+    'train': DATASET_PATH + 'v2_OpenEnded_mscoco_train2014_questions.json',
+    'val': DATASET_PATH + 'v2_OpenEnded_mscoco_val2014_questions.json',
+    'test': DATASET_PATH + 'v2_OpenEnded_mscoco_test2015_questions.json',
+    'vg': DATASET_PATH + 'VG_questions.json',
+}
+
+ANSWER_PATH = {
+    'train': DATASET_PATH + 'v2_mscoco_train2014_annotations.json',
+    'val': DATASET_PATH + 'v2_mscoco_val2014_annotations.json',
+    'vg': DATASET_PATH + 'VG_annotations.json',
+}
+
+if not os.path.exists(OUTPUT_PATH):
+    os.makedirs(OUTPUT_PATH)
+
+ques_lists = {split: json.load(open(QUESTION_PATH[split], 'r'))['questions']
+              for split in QUESTION_PATH}
+
+# Same vocabulary as DataSet: all the questions, in this order
+token_to_ix, pretrained_emb = tokenize(
+    ques_lists['train'] + ques_lists['val'] + ques_lists['test'] + ques_lists['vg'],
+    USE_GLOVE
+)
+json.dump(token_to_ix, open(OUTPUT_PATH + 'token_to_ix.json', 'w'))
+np.save(OUTPUT_PATH + 'pretrained_emb.npy', pretrained_emb)
+
+ans_to_ix, ix_to_ans = ans_stat('../core/data/answer_dict.json')
+
+split_arrays = {}
+for split, ques_list in ques_lists.items():
+    arrays = {
+        'qid': np.array([ques['question_id'] for ques in ques_list], np.int64),
+        'iid': np.array([ques['image_id'] for ques in ques_list], np.int64),
+        'ques_ix': np.stack([proc_ques(ques, token_to_ix, MAX_TOKEN)
+                             for ques in ques_list]).astype(np.int32),
+    }
+
+    if split in ANSWER_PATH:
+        ans_list = json.load(open(ANSWER_PATH[split], 'r'))['annotations']
+        qid_to_row = {str(qid): row for row, qid in enumerate(arrays['qid'])}
+        ans = [proc_ans(ans_, ans_to_ix) for ans_ in ans_list]
+        arrays['ans_ques'] = np.array([qid_to_row[str(ans_['question_id'])]
+                                       for ans_ in ans_list], np.int64)
+        arrays['ans_ix'] = np.stack([ix for ix, _ in ans]).astype(np.int32)
+        arrays['ans_score'] = np.stack([score for _, score in ans])
+
+    for name, array in arrays.items():
+        np.save(OUTPUT_PATH + split + '_' + name + '.npy', array)
+    split_arrays[split] = sorted(arrays)
+    print('{}: {} questions'.format(split, arrays['qid'].shape[0]))
+
+# meta.json last, the DataSet uses the cache when it exists
+json.dump({
+    'max_token': MAX_TOKEN,
+    'use_glove': USE_GLOVE,
+    'ans_size': ans_to_ix.__len__(),
+    'splits': split_arrays,
+}, open(OUTPUT_PATH + 'meta.json', 'w'))
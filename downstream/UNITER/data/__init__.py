@@ -16,6 +16,7 @@ from .nlvr2 import (Nlvr2PairedDataset, Nlvr2PairedEvalDataset,
 from .itm import (TokenBucketSamplerForItm, ItmDataset,
                   itm_collate, itm_ot_collate,
                   ItmRankDataset, ItmValDataset, ItmEvalDataset,
+                  ItmRerankEvalDataset,
                   ItmRankDatasetHardNegFromImage,
                   ItmRankDatasetHardNegFromText,
                   itm_rank_collate, itm_val_collate, itm_eval_collate,
@@ -5,10 +5,14 @@ Licensed under the MIT license.
 Dataset interfaces
 """
 from collections import defaultdict
+from collections.abc import ItemsView, Mapping
 from contextlib import contextmanager
+import fcntl
 import io
 import json
-from os.path import exists
+import multiprocessing as mp
+import os
+from os.path import exists, join
 
 import numpy as np
 import torch
@@ -45,62 +49,209 @@ def _check_distributed():
     return dist
 
 
+class FlatFeatDb(object):
+    """ memory-mapped flat feature store (written by
+    `python -m vc_rcnn.tools.featstore convert ... --dst-format flat`):
+    the per-box arrays of all images concatenated in '<key>.bin' files,
+    an int64 (offset, count) row per image in 'index.npy'
+    """
+    def __init__(self, db_dir):
+        meta = json.load(open(f'{db_dir}/meta.json'))
+        names = json.load(open(f'{db_dir}/names.json'))
+        self.name2idx = {name: i for i, name in enumerate(names)}
+        self.index = np.load(f'{db_dir}/index.npy')
+        num_boxes = meta['num_boxes']
+        fields = {'features': {'dtype': meta['dtype'],
+                               'shape': [meta['dim']]}}
+        fields.update(meta.get('fields', {}))
+        # copy-on-write maps are writable for torch.from_numpy, the pages
+        # stay shared between the dataloader workers
+        self.arrays = {
+            key: np.memmap(join(db_dir, f'{key}.bin'),
+                           dtype=np.dtype(field['dtype']), mode='c',
+                           shape=(num_boxes, *field['shape']))
+            for key, field in fields.items()}
+
+    def keys(self):
+        return list(self.name2idx.keys())
+
+    def __contains__(self, name):
+        return name in self.name2idx
+
+    def __getitem__(self, name):
+        offset, count = self.index[self.name2idx[name]]
+        return {key: arr[offset:offset+count]
+                for key, arr in self.arrays.items()}
+
+
+def _count_boxes(args):
+    """ number of boxes of a chunk of images in the 'all' LMDB
+    (run in a worker process, which opens its own environment)
+    """
+    db_path, compress, fnames, conf_th, min_bb, max_bb = args
+    env = lmdb.open(db_path, readonly=True, create=False, lock=False,
+                    readahead=False)
+    nbbs = []
+    with env.begin(buffers=True) as txn:
+        for fname in fnames:
+            dump = txn.get(fname.encode('utf-8'))
+            if compress:
+                with io.BytesIO(dump) as reader:
+                    confs = np.load(reader, allow_pickle=True)['conf']
+            else:
+                confs = msgpack.loads(dump, raw=False)['conf']
+            nbbs.append(compute_num_bb(confs, conf_th, min_bb, max_bb))
+    env.close()
+    return nbbs
+
+
+def save_nbb(path, fnames, nbbs):
+    """ atomically write the box counts of the images to a binary sidecar
+    (fnames: names of the images, nbbs: int array aligned with fnames)
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, fnames=np.array(fnames, dtype=np.str_),
+                 nbbs=np.asarray(nbbs, dtype=np.int32))
+    os.replace(tmp_path, path)
+
+
+def load_nbb(path):
+    with np.load(path) as sidecar:
+        return sidecar['fnames'].tolist(), sidecar['nbbs']
+
+
 class DetectFeatLmdb(object):
+    """ the number of boxes kept per image (name2nbb, or the fnames/nbbs
+    arrays) is read from the nbb_th*.json of the db, else from the
+    nbb_th*.npz sidecar, which is computed (once, in parallel) and written
+    the first time a threshold is used
+    """
     def __init__(self, img_dir, conf_th=0.2, max_bb=100, min_bb=10, num_bb=36,
-                 compress=True):
+                 compress=True, n_workers=None):
         self.img_dir = img_dir
+        self.conf_th = conf_th
+        self.max_bb = max_bb
+        self.min_bb = min_bb
+        self.n_workers = n_workers
+        self.fnames = self.nbbs = None
         if conf_th == -1:
             db_name = f'feat_numbb{num_bb}'
             self.name2nbb = defaultdict(lambda: num_bb)
         else:
             db_name = f'feat_th{conf_th}_max{max_bb}_min{min_bb}'
-            nbb = f'nbb_th{conf_th}_max{max_bb}_min{min_bb}.json'
-            if not exists(f'{img_dir}/{nbb}'):
-                # nbb is not pre-computed
-                self.name2nbb = None
+            nbb = f'nbb_th{conf_th}_max{max_bb}_min{min_bb}'
+            self.nbb_path = f'{img_dir}/{nbb}.npz'
+            if exists(f'{img_dir}/{nbb}.json'):
+                self.name2nbb = json.load(open(f'{img_dir}/{nbb}.json'))
+                self.fnames = list(self.name2nbb.keys())
+                self.nbbs = np.array(list(self.name2nbb.values()),
+                                     dtype=np.int32)
             else:
-                self.name2nbb = json.load(open(f'{img_dir}/{nbb}'))
+                # nbb is not pre-computed, read the boxes from the full db
+                db_name = 'all'
+                if exists(self.nbb_path):
+                    self._load_nbb()
+                else:
+                    self.name2nbb = None
         self.compress = compress
+        # a flat store converted from the LMDB replaces it
+        self.flat = None
+        if exists(f'{img_dir}/{db_name}_flat/features.bin'):
+            self.flat = FlatFeatDb(f'{img_dir}/{db_name}_flat')
+            self.env = None
+            if self.name2nbb is None:
+                self._compute_nbb()
+            return
+
         if compress:
             db_name += '_compressed'
-
-        if self.name2nbb is None:
-            if compress:
-                db_name = 'all_compressed'
-            else:
-                db_name = 'all'
+        self.db_path = f'{img_dir}/{db_name}'
         # only read ahead on single node training
-        self.env = lmdb.open(f'{img_dir}/{db_name}',
+        self.env = lmdb.open(self.db_path,
                              readonly=True, create=False,
                              readahead=not _check_distributed())
         self.txn = self.env.begin(buffers=True)
         if self.name2nbb is None:
-            self.name2nbb = self._compute_nbb()
+            self._compute_nbb()
+
+    def _load_nbb(self):
+        self.fnames, self.nbbs = load_nbb(self.nbb_path)
+        self.name2nbb = dict(zip(self.fnames, self.nbbs.tolist()))
 
     def _compute_nbb(self):
-        name2nbb = {}
-        fnames = json.loads(self.txn.get(key=b'__keys__').decode('utf-8'))
-        for fname in tqdm(fnames, desc='reading images'):
-            dump = self.txn.get(fname.encode('utf-8'))
-            if self.compress:
-                with io.BytesIO(dump) as reader:
-                    img_dump = np.load(reader, allow_pickle=True)
-                    confs = img_dump['conf']
+        """ computes the box counts and writes them to the sidecar; the other
+        processes computing the same sidecar wait on its lock and load it
+        """
+        try:
+            lock = open(f'{self.nbb_path}.lock', 'w')
+        except OSError:
+            # read-only db, every process computes its own counts
+            lock = None
+        try:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if exists(self.nbb_path):
+                    self._load_nbb()
+                    return
+            if self.flat is not None:
+                fnames = self.flat.keys()
+                nbbs = self._count_flat_boxes()
             else:
-                img_dump = msgpack.loads(dump, raw=False)
-                confs = img_dump['conf']
-            name2nbb[fname] = compute_num_bb(confs, self.conf_th,
-                                             self.min_bb, self.max_bb)
-
-        return name2nbb
+                fnames = json.loads(
+                    bytes(self.txn.get(key=b'__keys__')).decode('utf-8'))
+                nbbs = self._count_lmdb_boxes(fnames)
+            self.fnames = fnames
+            self.nbbs = np.asarray(nbbs, dtype=np.int32)
+            self.name2nbb = dict(zip(self.fnames, self.nbbs.tolist()))
+            if lock is not None:
+                save_nbb(self.nbb_path, self.fnames, self.nbbs)
+        finally:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+
+    def _count_flat_boxes(self):
+        # vectorized over the memory-mapped confidences of all the boxes,
+        # the rows of the index follow the order of flat.keys()
+        confs = self.flat.arrays['conf'].reshape(-1)
+        above = np.zeros(len(confs) + 1, dtype=np.int64)
+        np.cumsum(confs > self.conf_th, out=above[1:])
+        offset, count = self.flat.index[:, 0], self.flat.index[:, 1]
+        nbbs = above[offset + count] - above[offset]
+        return np.minimum(self.max_bb, np.maximum(self.min_bb, nbbs))
+
+    def _count_lmdb_boxes(self, fnames):
+        n_workers = self.n_workers or os.cpu_count() or 1
+        chunk_size = max(1, min(1024, len(fnames) // (n_workers * 4) + 1))
+        chunks = [(self.db_path, self.compress, fnames[i:i+chunk_size],
+                   self.conf_th, self.min_bb, self.max_bb)
+                  for i in range(0, len(fnames), chunk_size)]
+        nbbs = []
+        # spawn: the workers must not inherit this process' open environment
+        with mp.get_context('spawn').Pool(n_workers) as pool, \
+                tqdm(total=len(fnames), desc='reading images') as pbar:
+            for chunk_nbbs in pool.imap(_count_boxes, chunks):
+                nbbs.extend(chunk_nbbs)
+                pbar.update(len(chunk_nbbs))
+        return nbbs
+
+    def get_nbbs(self, fnames):
+        """ number of boxes of the images, as an int array (for samplers) """
+        return np.array([self.name2nbb[fname] for fname in fnames],
+                        dtype=np.int32)
 
     def __del__(self):
-        self.env.close()
+        if self.env is not None:
+            self.env.close()
 
     def get_dump(self, file_name):
         # hack for MRC
-        dump = self.txn.get(file_name.encode('utf-8'))
         nbb = self.name2nbb[file_name]
+        if self.flat is not None:
+            img_dump = _fp16_to_fp32(self.flat[file_name])
+            return {k: arr[:nbb, ...] for k, arr in img_dump.items()}
+        dump = self.txn.get(file_name.encode('utf-8'))
         if self.compress:
             with io.BytesIO(dump) as reader:
                 img_dump = np.load(reader, allow_pickle=True)
@@ -112,8 +263,15 @@ class DetectFeatLmdb(object):
         return img_dump
 
     def __getitem__(self, file_name):
-        dump = self.txn.get(file_name.encode('utf-8'))
         nbb = self.name2nbb[file_name]
+        if self.flat is not None:
+            # zero-copy views of the memory-mapped store (fp16 features are
+            # only cast)
+            img_dump = self.flat[file_name]
+            img_feat = torch.from_numpy(img_dump['features'][:nbb]).float()
+            img_bb = torch.from_numpy(img_dump['norm_bb'][:nbb]).float()
+            return img_feat, img_bb
+        dump = self.txn.get(file_name.encode('utf-8'))
         if self.compress:
             with io.BytesIO(dump) as reader:
                 img_dump = np.load(reader, allow_pickle=True)
@@ -175,6 +333,164 @@ class TxtLmdb(object):
         return ret
 
 
+def write_txt_img_index(db_dir):
+    """ binary sidecar of txt2img.json (and img2txts.json) in
+    '<db_dir>/txt_img_index', read memory-mapped by TxtTokLmdb:
+    the utf-8 names of the texts and images (with their sort order for
+    lookups), the image row(s) of every text and the text rows of every
+    image (CSR offsets)
+    """
+    txt2img = json.load(open(f'{db_dir}/txt2img.json'))
+    img2txts = (json.load(open(f'{db_dir}/img2txts.json'))
+                if exists(f'{db_dir}/img2txts.json') else {})
+    values = list(txt2img.values())
+    multi = bool(values) and isinstance(values[0], list)
+    if multi and len(set(len(imgs) for imgs in values)) > 1:
+        # ragged image lists, the json files are used
+        return False
+
+    # the texts/images of txt2img/img2txts come first, in the json order
+    txt_rows = {id_: i for i, id_ in enumerate(txt2img)}
+    img_rows = {img: i for i, img in enumerate(img2txts)}
+    for imgs in values:
+        for img in (imgs if multi else [imgs]):
+            img_rows.setdefault(img, len(img_rows))
+    for txts in img2txts.values():
+        for id_ in txts:
+            txt_rows.setdefault(id_, len(txt_rows))
+
+    index_dir = f'{db_dir}/txt_img_index'
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {
+        'txt2img': np.array([[img_rows[img] for img in imgs] if multi
+                             else img_rows[imgs] for imgs in values],
+                            dtype=np.int32),
+        'img2txts_offsets': np.cumsum(
+            [0] + [len(txts) for txts in img2txts.values()], dtype=np.int64),
+        'img2txts': np.array([txt_rows[id_] for txts in img2txts.values()
+                              for id_ in txts], dtype=np.int32)}
+    for key, rows in [('txt', txt_rows), ('img', img_rows)]:
+        names = np.array([name.encode('utf-8') for name in rows], dtype=bytes)
+        arrays[f'{key}_names'] = names
+        arrays[f'{key}_order'] = np.argsort(names, kind='stable')
+    for key, arr in arrays.items():
+        np.save(f'{index_dir}/{key}.npy', arr)
+    # written last, the index is only used once complete
+    with open(f'{index_dir}/meta.json', 'w') as f:
+        json.dump({'num_txt2img': len(txt2img),
+                   'num_img2txts': len(img2txts)}, f)
+    return True
+
+
+class TxtImgIndex(object):
+    """ the sidecar written by write_txt_img_index, memory-mapped """
+    def __init__(self, index_dir):
+        self.meta = json.load(open(f'{index_dir}/meta.json'))
+        for key in ['txt_names', 'txt_order', 'img_names', 'img_order',
+                    'txt2img', 'img2txts_offsets', 'img2txts']:
+            setattr(self, key, np.load(f'{index_dir}/{key}.npy',
+                                       mmap_mode='r'))
+
+    @staticmethod
+    def _rows(names, order, keys):
+        keys = np.array([key.encode('utf-8') for key in keys], dtype=bytes)
+        pos = np.searchsorted(names, keys, sorter=order)
+        rows = np.asarray(order)[np.minimum(pos, len(order)-1)]
+        missing = names[rows] != keys
+        if missing.any():
+            raise KeyError(keys[missing][0].decode('utf-8'))
+        return rows
+
+    def txt_rows(self, ids):
+        return self._rows(self.txt_names, self.txt_order, ids)
+
+    def img_rows(self, fnames):
+        return self._rows(self.img_names, self.img_order, fnames)
+
+
+class _RowItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class Txt2ImgMap(Mapping):
+    """ read-only txt2img backed by a TxtImgIndex """
+    def __init__(self, index):
+        self.index = index
+        self.multi = index.txt2img.ndim == 2
+
+    def _value(self, img_rows):
+        if self.multi:
+            return [self.index.img_names[r].decode('utf-8') for r in img_rows]
+        return self.index.img_names[img_rows].decode('utf-8')
+
+    def __getitem__(self, id_):
+        row = self.index.txt_rows([id_])[0]
+        if row >= len(self):
+            raise KeyError(id_)
+        return self._value(self.index.txt2img[row])
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.index.txt_names[row].decode('utf-8')
+
+    def __len__(self):
+        return self.index.meta['num_txt2img']
+
+    def items(self):
+        return _RowItemsView(self)
+
+    def iter_items(self):
+        for row in range(len(self)):
+            yield (self.index.txt_names[row].decode('utf-8'),
+                   self._value(self.index.txt2img[row]))
+
+    def get_many(self, ids):
+        """ [self[id_] for id_ in ids], looked up at once """
+        rows = self.index.txt_rows(ids)
+        if (rows >= len(self)).any():
+            raise KeyError(ids[int(np.argmax(rows >= len(self)))])
+        img_rows = self.index.txt2img[rows]
+        # decode every image name once
+        uniq, inverse = np.unique(img_rows, return_inverse=True)
+        fnames = [self.index.img_names[r].decode('utf-8') for r in uniq]
+        inverse = inverse.reshape(img_rows.shape)
+        if self.multi:
+            return [[fnames[i] for i in imgs] for imgs in inverse]
+        return [fnames[i] for i in inverse]
+
+
+class Img2TxtsMap(Mapping):
+    """ read-only img2txts backed by a TxtImgIndex """
+    def __init__(self, index):
+        self.index = index
+
+    def _value(self, row):
+        start, end = self.index.img2txts_offsets[row:row+2]
+        return [self.index.txt_names[r].decode('utf-8')
+                for r in self.index.img2txts[start:end]]
+
+    def __getitem__(self, fname):
+        row = self.index.img_rows([fname])[0]
+        if row >= len(self):
+            raise KeyError(fname)
+        return self._value(row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.index.img_names[row].decode('utf-8')
+
+    def __len__(self):
+        return self.index.meta['num_img2txts']
+
+    def items(self):
+        return _RowItemsView(self)
+
+    def iter_items(self):
+        for row in range(len(self)):
+            yield self.index.img_names[row].decode('utf-8'), self._value(row)
+
+
 class TxtTokLmdb(object):
     def __init__(self, db_dir, max_txt_len=60):
 
@@ -205,15 +521,43 @@ class TxtTokLmdb(object):
             input_ids.extend(ids + [self.sep])
         return torch.tensor(input_ids)
 
+    @property
+    def txt_img_index(self):
+        """ the binary sidecar (write_txt_img_index) if built, else None """
+        if not hasattr(self, '_txt_img_index'):
+            index_dir = f'{self.db_dir}/txt_img_index'
+            self._txt_img_index = (TxtImgIndex(index_dir)
+                                   if exists(f'{index_dir}/meta.json')
+                                   else None)
+        return self._txt_img_index
+
     @property
     def txt2img(self):
-        txt2img = json.load(open(f'{self.db_dir}/txt2img.json'))
-        return txt2img
+        # loaded once, memory-mapped from the sidecar when there is one
+        if not hasattr(self, '_txt2img'):
+            if self.txt_img_index is not None:
+                self._txt2img = Txt2ImgMap(self.txt_img_index)
+            else:
+                self._txt2img = json.load(open(f'{self.db_dir}/txt2img.json'))
+        return self._txt2img
 
     @property
     def img2txts(self):
-        img2txts = json.load(open(f'{self.db_dir}/img2txts.json'))
-        return img2txts
+        if not hasattr(self, '_img2txts'):
+            if (self.txt_img_index is not None
+                    and self.txt_img_index.meta['num_img2txts']):
+                self._img2txts = Img2TxtsMap(self.txt_img_index)
+            else:
+                self._img2txts = json.load(
+                    open(f'{self.db_dir}/img2txts.json'))
+        return self._img2txts
+
+    def get_imgs(self, ids):
+        """ [self.txt2img[id_] for id_ in ids] """
+        txt2img = self.txt2img
+        if isinstance(txt2img, Txt2ImgMap):
+            return txt2img.get_many(ids)
+        return [txt2img[id_] for id_ in ids]
 
 
 def get_ids_and_lens(db):
@@ -234,9 +578,9 @@ class DetectFeatTxtTokDataset(Dataset):
         self.img_db = img_db
         txt_lens, self.ids = get_ids_and_lens(txt_db)
 
-        txt2img = txt_db.txt2img
-        self.lens = [tl + self.img_db.name2nbb[txt2img[id_]]
-                     for tl, id_ in zip(txt_lens, self.ids)]
+        img_fnames = txt_db.get_imgs(self.ids)
+        self.lens = (np.array(txt_lens, dtype=np.int64)
+                     + self.img_db.get_nbbs(img_fnames)).tolist()
 
     def __len__(self):
         return len(self.ids)
@@ -261,22 +605,25 @@ def pad_tensors(tensors, lens=None, pad=0):
     bs = len(tensors)
     hid = tensors[0].size(-1)
     dtype = tensors[0].dtype
-    output = torch.zeros(bs, max_len, hid, dtype=dtype)
-    if pad:
-        output.data.fill_(pad)
+    # every element is written once: the rows, then the padding after them
+    output = torch.empty(bs, max_len, hid, dtype=dtype)
     for i, (t, l) in enumerate(zip(tensors, lens)):
-        output.data[i, :l, ...] = t.data;
+        output.data[i, :l, ...] = t.data
+        output.data[i, l:, ...] = pad
     return output
 
 
 def get_gather_index(txt_lens, num_bbs, batch_size, max_len, out_size):
     assert len(txt_lens) == len(num_bbs) == batch_size
+    # position j of example i reads the text at j, or the image box j-tl
+    # (at max_len+j-tl in the [txt, img] concatenation) for tl <= j < tl+nbb
+    txt_lens = torch.tensor(txt_lens, dtype=torch.long).unsqueeze(1)
+    num_bbs = torch.tensor(num_bbs, dtype=torch.long).unsqueeze(1)
     gather_index = torch.arange(0, out_size, dtype=torch.long,
                                 ).unsqueeze(0).repeat(batch_size, 1)
-
-    for i, (tl, nbb) in enumerate(zip(txt_lens, num_bbs)):
-        gather_index.data[i, tl:tl+nbb] = torch.arange(max_len, max_len+nbb,
-                                                       dtype=torch.long).data
+    is_img = (gather_index >= txt_lens) & (gather_index < txt_lens + num_bbs)
+    gather_index = torch.where(is_img, gather_index - txt_lens + max_len,
+                               gather_index)
     return gather_index
 
 
@@ -297,6 +644,7 @@ class ConcatDatasetWithLens(ConcatDataset):
 
 
 class ImageLmdbGroup(object):
+    """ opens each image db once, the datasets of all the tasks share it """
     def __init__(self, conf_th, max_bb, min_bb, num_bb, compress):
         self.path2imgdb = {}
         self.conf_th = conf_th
@@ -310,4 +658,5 @@ class ImageLmdbGroup(object):
         if img_db is None:
             img_db = DetectFeatLmdb(path, self.conf_th, self.max_bb,
                                     self.min_bb, self.num_bb, self.compress)
+            self.path2imgdb[path] = img_db
         return img_db
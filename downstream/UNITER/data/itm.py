@@ -190,8 +190,7 @@ class ItmRankDataset(DetectFeatTxtTokDataset):
             "ItmRankDataset need at least 1 negative sample"
         super().__init__(txt_db, img_db)
 
-        txt2img = self.txt_db.txt2img
-        self.txt2img = {id_: txt2img[id_] for id_ in self.ids}
+        self.txt2img = dict(zip(self.ids, self.txt_db.get_imgs(self.ids)))
         # images partitioned by rank
         self.img2txts = defaultdict(list)
         for id_, img in self.txt2img.items():
@@ -273,8 +272,7 @@ class ItmRankDatasetHardNegFromText(DetectFeatTxtTokDataset):
         assert neg_sample_size > 0, "need at least 1 negative sample"
         super().__init__(txt_db, img_db)
 
-        txt2img = self.txt_db.txt2img
-        self.txt2img = {id_: txt2img[id_] for id_ in self.ids}
+        self.txt2img = dict(zip(self.ids, self.txt_db.get_imgs(self.ids)))
         self.img2txts = self.txt_db.img2txts
         self.img_name_list = list(self.img2txts.keys())
         self.neg_sample_size = neg_sample_size
@@ -320,8 +318,7 @@ class ItmRankDatasetHardNegFromImage(DetectFeatTxtTokDataset):
         assert neg_sample_size > 0, "need at least 1 negative sample"
         super().__init__(txt_db, img_db)
 
-        txt2img = self.txt_db.txt2img
-        self.txt2img = {id_: txt2img[id_] for id_ in self.ids}
+        self.txt2img = dict(zip(self.ids, self.txt_db.get_imgs(self.ids)))
         self.img2txts = self.txt_db.img2txts
         self.txt_name_list = list(self.txt2img.keys())
         self.neg_sample_size = neg_sample_size
@@ -415,27 +412,29 @@ class ItmValDataset(DetectFeatTxtTokDataset):
         return batch
 
     def get_batch(self, i, img_ids):
+        # process image features (gt always first)
+        img_feats, img_pos_feats, num_bbs = map(
+            list, unzip(map(self._get_img_feat, img_ids)))
+        img_feat = pad_tensors(img_feats, num_bbs)
+        img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+        return self._make_batch(i, img_feat, img_pos_feat, num_bbs)
+
+    def _make_batch(self, i, img_feat, img_pos_feat, num_bbs):
         example = super().__getitem__(i)
 
         input_ids = example['input_ids']
         input_ids = self.txt_db.combine_inputs(input_ids)
-        input_ids = input_ids.unsqueeze(0).expand(len(img_ids), -1).clone()
+        input_ids = input_ids.unsqueeze(0).expand(len(num_bbs), -1).clone()
         position_ids = torch.arange(0, input_ids.size(1), dtype=torch.long
                                     ).unsqueeze(0)
 
-        # process image features (gt always first)
-        img_feats, img_pos_feats, num_bbs = map(
-            list, unzip(map(self._get_img_feat, img_ids)))
-        img_feat = pad_tensors(img_feats, num_bbs)
-        img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
-
         tl = input_ids.size(1)
-        attn_masks = torch.zeros(len(img_ids), max(num_bbs) + tl).long()
+        attn_masks = torch.zeros(len(num_bbs), max(num_bbs) + tl).long()
         for i, nbb in enumerate(num_bbs):
             attn_masks.data[i, :tl+nbb].fill_(1)
         out_size = attn_masks.size(1)
-        gather_index = get_gather_index([tl]*len(img_ids), num_bbs,
-                                        len(img_ids), tl, out_size)
+        gather_index = get_gather_index([tl]*len(num_bbs), num_bbs,
+                                        len(num_bbs), tl, out_size)
 
         batch = {'input_ids': input_ids,
                  'position_ids': position_ids,
@@ -452,12 +451,34 @@ def itm_val_collate(inputs):
 
 
 class ItmEvalDataset(ItmValDataset):
-    def __init__(self, *args, **kwargs):
+    """ every text is scored against all the images, in mini-batches of
+    images sorted by number of boxes
+
+    with cache_img, the padded image features of every mini-batch are
+    loaded once (in shared memory, so that the dataloader workers do not
+    copy them) and reused for all the texts, instead of reading
+    N_txt x N_img image features
+    """
+    def __init__(self, *args, cache_img=False, **kwargs):
         super().__init__(*args, **kwargs)
         self.all_img_ids = sorted(copy.deepcopy(self.all_img_ids),
                                   key=lambda i: self.img_db.name2nbb[i])
+        self.img_cache = None
+        if cache_img:
+            self.img_cache = []
+            for st in range(0, len(self.all_img_ids), self.bs):
+                img_ids = self.all_img_ids[st:st+self.bs]
+                img_feats, img_pos_feats, num_bbs = map(
+                    list, unzip(map(self._get_img_feat, img_ids)))
+                img_feat = pad_tensors(img_feats, num_bbs).share_memory_()
+                img_pos_feat = pad_tensors(img_pos_feats,
+                                           num_bbs).share_memory_()
+                self.img_cache.append((img_feat, img_pos_feat, num_bbs))
 
     def __getitem__(self, i):
+        if self.img_cache is not None:
+            return [self._make_batch(i, *img_batch)
+                    for img_batch in self.img_cache]
         mini_batches = []
         for st in range(0, len(self.all_img_ids), self.bs):
             mini_batches.append(
@@ -466,3 +487,65 @@ class ItmEvalDataset(ItmValDataset):
 
 
 itm_eval_collate = itm_val_collate
+
+
+class ItmRerankEvalDataset(ItmValDataset):
+    """ two-stage retrieval evaluation: the texts and the images are first
+    encoded separately (txt_batches / img_batches) to select candidate
+    pairs, then every text is scored by the cross-encoder against its
+    candidate images only (set_candidates) """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.candidates = None
+
+    def txt_batches(self, batch_size):
+        """ text only inputs of self.ids, in order """
+        for st in range(0, len(self.ids), batch_size):
+            input_ids = [self.txt_db.combine_inputs(
+                             self.txt_db[id_]['input_ids'])
+                         for id_ in self.ids[st:st+batch_size]]
+            txt_lens = [i.size(0) for i in input_ids]
+            input_ids = pad_sequence(input_ids, batch_first=True,
+                                     padding_value=0)
+            position_ids = torch.arange(0, input_ids.size(1),
+                                        dtype=torch.long).unsqueeze(0)
+            attn_masks = torch.zeros(len(txt_lens), max(txt_lens)).long()
+            for i, tl in enumerate(txt_lens):
+                attn_masks.data[i, :tl].fill_(1)
+            yield {'input_ids': input_ids,
+                   'position_ids': position_ids,
+                   'attn_masks': attn_masks}
+
+    def img_batches(self, batch_size):
+        """ image only inputs of self.all_img_ids, in order """
+        for st in range(0, len(self.all_img_ids), batch_size):
+            img_feats, img_pos_feats, num_bbs = map(
+                list, unzip(map(self._get_img_feat,
+                                self.all_img_ids[st:st+batch_size])))
+            img_feat = pad_tensors(img_feats, num_bbs)
+            img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+            attn_masks = torch.zeros(len(num_bbs), max(num_bbs)).long()
+            for i, nbb in enumerate(num_bbs):
+                attn_masks.data[i, :nbb].fill_(1)
+            yield {'img_feat': img_feat,
+                   'img_pos_feat': img_pos_feat,
+                   'attn_masks': attn_masks}
+
+    def set_candidates(self, candidates):
+        """ candidates[i]: indices (in self.all_img_ids) of the images
+        scored for the i-th text """
+        assert len(candidates) == len(self.ids)
+        self.candidates = candidates
+
+    def __getitem__(self, i):
+        """ this returns list of mini-batches over the candidate images,
+        'img_js' holding their indices """
+        assert self.candidates is not None, "set_candidates not called"
+        img_js = self.candidates[i]
+        mini_batches = []
+        for st in range(0, len(img_js), self.bs):
+            js = img_js[st:st+self.bs]
+            batch = self.get_batch(i, [self.all_img_ids[j] for j in js])
+            batch['img_js'] = torch.tensor(js, dtype=torch.long)
+            mini_batches.append(batch)
+        return mini_batches
@@ -6,17 +6,85 @@ A prefetch loader to speedup data loading
 Modified from Nvidia Deep Learning Examples
 (https://github.com/NVIDIA/DeepLearningExamples/tree/master/PyTorch).
 """
+from functools import partial
 import random
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 from utils.distributed import any_broadcast
 
 
+class MetaTaskDataset(Dataset):
+    """ the datasets of all tasks, indexed by (task, index) """
+    def __init__(self, name2dataset):
+        self.name2dataset = name2dataset
+
+    def __getitem__(self, i):
+        task, i = i
+        return task, self.name2dataset[task][i]
+
+
+def meta_task_collate(name2collate, inputs):
+    task = inputs[0][0]
+    assert all(t == task for t, _ in inputs)
+    return task, name2collate[task]([ex for _, ex in inputs])
+
+
+class MetaTaskBatchSampler(Sampler):
+    """ draws the task of every step (as MetaLoader) and yields its next batch
+    of (task, index)
+
+    the iteration stops when the sampler of a task starts a new epoch, so
+    that the workers are restarted with the new state of its dataset
+    (e.g. the ITM negatives), it resumes from this batch when iterated again
+    """
+    def __init__(self, name2sampler, sampling_pools,
+                 accum_steps=1, distributed=False):
+        self.name2sampler = name2sampler
+        self.name2iter = {n: iter(s) for n, s in name2sampler.items()}
+        self.sampling_pools = sampling_pools
+        self.accum_steps = accum_steps
+        self.distributed = distributed
+        self.step = 0
+        self.task = sampling_pools[0]
+        self.pending_task = None
+
+    def __iter__(self):
+        while True:
+            if self.pending_task is None:
+                if self.step % self.accum_steps == 0:
+                    self.task = random.choice(self.sampling_pools)
+                    if self.distributed:
+                        # make sure all process is training same task
+                        self.task = any_broadcast(self.task, 0)
+                self.step += 1
+                task = self.task
+                try:
+                    indices = next(self.name2iter[task])
+                except StopIteration:
+                    self.name2iter[task] = iter(self.name2sampler[task])
+                    self.pending_task = task
+                    return
+            else:
+                task, self.pending_task = self.pending_task, None
+                indices = next(self.name2iter[task])
+            yield [(task, i) for i in indices]
+
+    def __len__(self):
+        raise ValueError("NOT supported. This sampler runs indefinitely")
+
+
 class MetaLoader(object):
-    """ wraps multiple data loaders """
-    def __init__(self, loaders, accum_steps=1, distributed=False):
+    """ wraps multiple data loaders
+
+    with n_workers, the loaders are not iterated themselves: the batches of
+    all tasks are loaded by one shared pool of n_workers processes (from the
+    datasets, batch samplers and collate functions of the loaders) instead of
+    one pool per task
+    """
+    def __init__(self, loaders, accum_steps=1, distributed=False,
+                 n_workers=None, pin_mem=False):
         assert isinstance(loaders, dict)
         self.name2loader = {}
         self.name2iter = {}
@@ -29,15 +97,35 @@ class MetaLoader(object):
             else:
                 raise ValueError()
             self.name2loader[n] = l
-            self.name2iter[n] = iter(l)
+            if n_workers is None:
+                self.name2iter[n] = iter(l)
             self.sampling_pools.extend([n]*r)
 
         self.accum_steps = accum_steps
         self.distributed = distributed
         self.step = 0
 
+        self.shared_loader = None
+        if n_workers is not None:
+            dataset = MetaTaskDataset(
+                {n: l.dataset for n, l in self.name2loader.items()})
+            batch_sampler = MetaTaskBatchSampler(
+                {n: l.batch_sampler for n, l in self.name2loader.items()},
+                self.sampling_pools, accum_steps, distributed)
+            collate_fn = partial(
+                meta_task_collate,
+                {n: l.collate_fn for n, l in self.name2loader.items()})
+            self.shared_loader = DataLoader(
+                dataset, batch_sampler=batch_sampler, num_workers=n_workers,
+                pin_memory=pin_mem, collate_fn=collate_fn)
+
     def __iter__(self):
         """ this iterator will run indefinitely """
+        if self.shared_loader is not None:
+            while True:
+                for task, batch in self.shared_loader:
+                    self.step += 1
+                    yield task, batch
         task = self.sampling_pools[0]
         while True:
             if self.step % self.accum_steps == 0:
@@ -23,10 +23,9 @@ class Nlvr2PairedDataset(DetectFeatTxtTokDataset):
         self.img_db = img_db
         txt_lens, self.ids = get_ids_and_lens(txt_db)
 
-        txt2img = txt_db.txt2img
-        self.lens = [2*tl + sum(self.img_db.name2nbb[img]
-                                for img in txt2img[id_])
-                     for tl, id_ in zip(txt_lens, self.ids)]
+        img_fnames = txt_db.get_imgs(self.ids)
+        self.lens = [2*tl + sum(self.img_db.name2nbb[img] for img in imgs)
+                     for tl, imgs in zip(txt_lens, img_fnames)]
 
         self.use_img_type = use_img_type
 
@@ -120,10 +119,9 @@ class Nlvr2TripletDataset(DetectFeatTxtTokDataset):
         self.img_db = img_db
         txt_lens, self.ids = get_ids_and_lens(txt_db)
 
-        txt2img = txt_db.txt2img
-        self.lens = [tl + sum(self.img_db.name2nbb[img]
-                              for img in txt2img[id_])
-                     for tl, id_ in zip(txt_lens, self.ids)]
+        img_fnames = txt_db.get_imgs(self.ids)
+        self.lens = [tl + sum(self.img_db.name2nbb[img] for img in imgs)
+                     for tl, imgs in zip(txt_lens, img_fnames)]
 
         self.use_img_type = use_img_type
 
@@ -61,18 +61,18 @@ class VcrDetectFeatTxtTokDataset(DetectFeatTxtTokDataset):
         self.tokenizer = AutoTokenizer.from_pretrained("bert-base-cased")
         txt_lens, self.ids = get_ids_and_lens(txt_db)
 
-        txt2img = txt_db.txt2img
+        img_fnames = txt_db.get_imgs(self.ids)
 
         if self.img_db and self.img_db_gt:
-            self.lens = [tl+self.img_db_gt.name2nbb[txt2img[id_][0]] +
-                         self.img_db.name2nbb[txt2img[id_][1]]
-                         for tl, id_ in zip(txt_lens, self.ids)]
+            self.lens = [tl+self.img_db_gt.name2nbb[imgs[0]] +
+                         self.img_db.name2nbb[imgs[1]]
+                         for tl, imgs in zip(txt_lens, img_fnames)]
         elif self.img_db:
-            self.lens = [tl+self.img_db.name2nbb[txt2img[id_][1]]
-                         for tl, id_ in zip(txt_lens, self.ids)]
+            self.lens = [tl+self.img_db.name2nbb[imgs[1]]
+                         for tl, imgs in zip(txt_lens, img_fnames)]
         else:
-            self.lens = [tl+self.img_db_gt.name2nbb[txt2img[id_][0]]
-                         for tl, id_ in zip(txt_lens, self.ids)]
+            self.lens = [tl+self.img_db_gt.name2nbb[imgs[0]]
+                         for tl, imgs in zip(txt_lens, img_fnames)]
 
     def _get_img_feat(self, fname_gt, fname):
         
@@ -101,6 +101,21 @@ class VcrDetectFeatTxtTokDataset(DetectFeatTxtTokDataset):
         return img_feat, img_bb, num_bb
 
 
+def _collate_shared_img(img_feats, img_pos_feats, num_choices):
+    """
+    the image of every question is padded once (not once per choice), the
+    model broadcasts it to the choices with img_index
+    returns the image batches, img_index and the number of boxes per choice
+    """
+    num_bbs = [f.size(0) for f in img_feats]
+    img_feat = pad_tensors(img_feats, num_bbs)
+    img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+    img_index = torch.arange(len(num_choices), dtype=torch.long
+                             ).repeat_interleave(torch.tensor(num_choices))
+    num_bbs = [nbb for nbb, n in zip(num_bbs, num_choices) for _ in range(n)]
+    return img_feat, img_pos_feat, img_index, num_bbs
+
+
 class VcrDataset(VcrDetectFeatTxtTokDataset):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -128,8 +143,7 @@ class VcrDataset(VcrDetectFeatTxtTokDataset):
 
     def __getitem__(self, i):
         """
-        [[txt, img1],
-         [txt, img2]]
+        [[txt1, txt2, ...], img]
         """
         example = super().__getitem__(i)
         img_feat, img_pos_feat, num_bb = self._get_img_feat(
@@ -161,15 +175,14 @@ class VcrDataset(VcrDetectFeatTxtTokDataset):
 
             outs.append(
                 (input_ids, txt_type_ids,
-                 img_feat, img_pos_feat,
                  attn_masks, target))
 
-        return tuple(outs)
+        return tuple(outs), img_feat, img_pos_feat
 
 
 def vcr_collate(inputs):
-    (input_ids, txt_type_ids, img_feats,
-     img_pos_feats, attn_masks, targets) = map(list, unzip(concat(inputs)))
+    (input_ids, txt_type_ids, attn_masks, targets
+     ) = map(list, unzip(concat(outs for outs, _, _ in inputs)))
 
     txt_lens = [i.size(0) for i in input_ids]
     input_ids = pad_sequence(input_ids, batch_first=True, padding_value=0)
@@ -178,10 +191,10 @@ def vcr_collate(inputs):
     position_ids = torch.arange(0, input_ids.size(1), dtype=torch.long
                                 ).unsqueeze(0)
 
-    # image batches
-    num_bbs = [f.size(0) for f in img_feats]
-    img_feat = pad_tensors(img_feats, num_bbs)
-    img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+    # image batches, one image per question
+    img_feat, img_pos_feat, img_index, num_bbs = _collate_shared_img(
+        [f for _, f, _ in inputs], [f for _, _, f in inputs],
+        [len(outs) for outs, _, _ in inputs])
 
     attn_masks = pad_sequence(attn_masks, batch_first=True, padding_value=0)
     targets = torch.stack(targets, dim=0)
@@ -195,6 +208,7 @@ def vcr_collate(inputs):
              'position_ids': position_ids,
              'img_feat': img_feat,
              'img_pos_feat': img_pos_feat,
+             'img_index': img_index,
              'attn_masks': attn_masks,
              'gather_index': gather_index,
              'targets': targets}
@@ -300,16 +314,15 @@ class VcrEvalDataset(VcrDetectFeatTxtTokDataset):
 
             outs.append(
                 (input_ids, txt_type_ids,
-                 img_feat, img_pos_feat,
                  attn_masks, img_soft_label, img_gt_soft_label, img_tot_soft_label)) ### compute confounder dictionary : extract soft label
 
-        return tuple(outs), qid, qa_target, qar_target
+        return tuple(outs), img_feat, img_pos_feat, qid, qa_target, qar_target
 
 
 def vcr_eval_collate(inputs):
-    (input_ids, txt_type_ids, img_feats,
-     img_pos_feats, attn_masks, img_soft_label, img_gt_soft_label, img_tot_soft_label) = map(
-         list, unzip(concat(outs for outs, _, _, _ in inputs)))
+    (input_ids, txt_type_ids,
+     attn_masks, img_soft_label, img_gt_soft_label, img_tot_soft_label) = map(
+         list, unzip(concat(outs for outs, _, _, _, _, _ in inputs)))
     # import ipdb;ipdb.set_trace(context=10)
 
     txt_lens = [i.size(0) for i in input_ids]
@@ -319,10 +332,10 @@ def vcr_eval_collate(inputs):
     position_ids = torch.arange(0, input_ids.size(1), dtype=torch.long
                                 ).unsqueeze(0)
 
-    # image batches
-    num_bbs = [f.size(0) for f in img_feats]
-    img_feat = pad_tensors(img_feats, num_bbs)
-    img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+    # image batches, one image per question
+    img_feat, img_pos_feat, img_index, num_bbs = _collate_shared_img(
+        [f for _, f, _, _, _, _ in inputs], [f for _, _, f, _, _, _ in inputs],
+        [len(outs) for outs, _, _, _, _, _ in inputs])
 
     attn_masks = pad_sequence(attn_masks, batch_first=True, padding_value=0)
 
@@ -331,10 +344,10 @@ def vcr_eval_collate(inputs):
     gather_index = get_gather_index(txt_lens, num_bbs, bs, max_tl, out_size)
     
     qa_targets = torch.stack(
-        [t for _, _, t, _ in inputs], dim=0)
+        [t for _, _, _, _, t, _ in inputs], dim=0)
     qar_targets = torch.stack(
-        [t for _, _, _, t in inputs], dim=0)
-    qids = [id_ for _, id_, _, _ in inputs]
+        [t for _, _, _, _, _, t in inputs], dim=0)
+    qids = [id_ for _, _, _, id_, _, _ in inputs]
     
     ### compute confounder dictionary : extract soft label
     #img_tot_soft_label = [torch.Tensor(np.concatenate((img_soft_label[i], img_gt_soft_label[i]), axis=0)) for i in range(len(img_soft_label))]
@@ -349,6 +362,7 @@ def vcr_eval_collate(inputs):
             'position_ids': position_ids,
             'img_feat': img_feat,
             'img_pos_feat': img_pos_feat,
+            'img_index': img_index,
             'attn_masks': attn_masks,
             'gather_index': gather_index,
             'qa_targets': qa_targets,
@@ -399,8 +413,7 @@ class VcrDcDataset(VcrDetectFeatTxtTokDataset):
 
     def __getitem__(self, i):
         """
-        [[txt, img1],
-         [txt, img2]]
+        [[txt1, txt2, ...], img]
         """
         example = super().__getitem__(i)
         img_feat, img_pos_feat, num_bb = self._get_img_feat(
@@ -446,15 +459,15 @@ class VcrDcDataset(VcrDetectFeatTxtTokDataset):
 
             outs.append(
                 (input_ids, txt_type_ids,
-                 img_feat, img_pos_feat,
                  attn_masks, target, input_ids_dc, txt_type_ids_dc, attn_masks_dc))
 
-        return tuple(outs)
+        return tuple(outs), img_feat, img_pos_feat
 
 
 def vcr_dc_collate(inputs):
-    (input_ids, txt_type_ids, img_feats,
-     img_pos_feats, attn_masks, targets, input_ids_dc, txt_type_ids_dc, attn_masks_dc) = map(list, unzip(concat(inputs)))
+    (input_ids, txt_type_ids, attn_masks, targets,
+     input_ids_dc, txt_type_ids_dc, attn_masks_dc
+     ) = map(list, unzip(concat(outs for outs, _, _ in inputs)))
 
     txt_lens = [i.size(0) for i in input_ids]
     input_ids = pad_sequence(input_ids, batch_first=True, padding_value=0)
@@ -463,10 +476,10 @@ def vcr_dc_collate(inputs):
     position_ids = torch.arange(0, input_ids.size(1), dtype=torch.long
                                 ).unsqueeze(0)
 
-    # image batches
-    num_bbs = [f.size(0) for f in img_feats]
-    img_feat = pad_tensors(img_feats, num_bbs)
-    img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+    # image batches, one image per question
+    img_feat, img_pos_feat, img_index, num_bbs = _collate_shared_img(
+        [f for _, f, _ in inputs], [f for _, _, f in inputs],
+        [len(outs) for outs, _, _ in inputs])
 
     attn_masks = pad_sequence(attn_masks, batch_first=True, padding_value=0)
     targets = torch.stack(targets, dim=0)
@@ -498,6 +511,7 @@ def vcr_dc_collate(inputs):
              'position_ids': position_ids,
              'img_feat': img_feat,
              'img_pos_feat': img_pos_feat,
+             'img_index': img_index,
              'attn_masks': attn_masks,
              'gather_index': gather_index,
              'targets': targets,
@@ -659,18 +673,17 @@ class VcrDcEvalDataset(VcrDetectFeatTxtTokDataset):
 
             outs.append(
                 (input_ids, txt_type_ids,
-                 img_feat, img_pos_feat,
                  attn_masks, img_soft_label, img_gt_soft_label, img_tot_soft_label,
                  attn_masks_dc, input_ids_dc, txt_type_ids_dc)) ### compute confounder dictionary : extract soft label
 
-        return tuple(outs), qid, qa_target, qar_target
+        return tuple(outs), img_feat, img_pos_feat, qid, qa_target, qar_target
 
 
 def vcr_dc_eval_collate(inputs):
-    (input_ids, txt_type_ids, img_feats,
-     img_pos_feats, attn_masks, img_soft_label, img_gt_soft_label, img_tot_soft_label,
+    (input_ids, txt_type_ids,
+     attn_masks, img_soft_label, img_gt_soft_label, img_tot_soft_label,
      attn_masks_dc, input_ids_dc, txt_type_ids_dc) = map(
-         list, unzip(concat(outs for outs, _, _, _ in inputs)))
+         list, unzip(concat(outs for outs, _, _, _, _, _ in inputs)))
 
     txt_lens = [i.size(0) for i in input_ids]
     input_ids = pad_sequence(input_ids, batch_first=True, padding_value=0)
@@ -687,10 +700,10 @@ def vcr_dc_eval_collate(inputs):
         position_ids_dc = torch.arange(0, input_ids_dc.size(1), dtype=torch.long).unsqueeze(0)
         attn_masks_dc = pad_sequence(attn_masks_dc, batch_first=True, padding_value=0)
 
-    # image batches
-    num_bbs = [f.size(0) for f in img_feats]
-    img_feat = pad_tensors(img_feats, num_bbs)
-    img_pos_feat = pad_tensors(img_pos_feats, num_bbs)
+    # image batches, one image per question
+    img_feat, img_pos_feat, img_index, num_bbs = _collate_shared_img(
+        [f for _, f, _, _, _, _ in inputs], [f for _, _, f, _, _, _ in inputs],
+        [len(outs) for outs, _, _, _, _, _ in inputs])
 
     attn_masks = pad_sequence(attn_masks, batch_first=True, padding_value=0)
 
@@ -706,10 +719,10 @@ def vcr_dc_eval_collate(inputs):
         input_ids_dc, txt_type_ids_dc, txt_type_ids_dc, position_ids_dc, attn_masks_dc = None, None, None, None, None
     
     qa_targets = torch.stack(
-        [t for _, _, t, _ in inputs], dim=0)
+        [t for _, _, _, _, t, _ in inputs], dim=0)
     qar_targets = torch.stack(
-        [t for _, _, _, t in inputs], dim=0)
-    qids = [id_ for _, id_, _, _ in inputs]
+        [t for _, _, _, _, _, t in inputs], dim=0)
+    qids = [id_ for _, _, _, id_, _, _ in inputs]
 
     return {'qids': qids,
         'input_ids': input_ids,
@@ -717,6 +730,7 @@ def vcr_dc_eval_collate(inputs):
         'position_ids': position_ids,
         'img_feat': img_feat,
         'img_pos_feat': img_pos_feat,
+        'img_index': img_index,
         'attn_masks': attn_masks,
         'gather_index': gather_index,
         'qa_targets': qa_targets,
@@ -9,7 +9,6 @@ import json
 import os
 from os.path import exists
 import pickle
-from time import time
 
 import torch
 from torch.utils.data import DataLoader
@@ -18,14 +17,14 @@ from apex import amp
 from horovod import torch as hvd
 
 from data import (PrefetchLoader,
-                  DetectFeatLmdb, TxtTokLmdb, ItmEvalDataset, itm_eval_collate)
+                  DetectFeatLmdb, TxtTokLmdb, ItmEvalDataset,
+                  ItmRerankEvalDataset, itm_eval_collate)
 from model.itm import UniterForImageTextRetrieval
 
 from utils.logger import LOGGER
-from utils.distributed import all_gather_list
 from utils.misc import Struct
 from utils.const import IMG_DIM
-from utils.itm_eval import inference, itm_eval
+from utils.itm_eval import evaluate
 
 
 def main(opts):
@@ -51,7 +50,13 @@ def main(opts):
                                  opts.min_bb, opts.num_bb,
                                  opts.compressed_db)
     eval_txt_db = TxtTokLmdb(opts.txt_db, -1)
-    eval_dataset = ItmEvalDataset(eval_txt_db, eval_img_db, opts.batch_size)
+    if opts.rerank_k > 0:
+        eval_dataset = ItmRerankEvalDataset(eval_txt_db, eval_img_db,
+                                            opts.batch_size)
+    else:
+        eval_dataset = ItmEvalDataset(eval_txt_db, eval_img_db,
+                                      opts.batch_size,
+                                      cache_img=opts.cache_img)
 
     # Prepare model
     checkpoint = torch.load(opts.checkpoint)
@@ -69,7 +74,8 @@ def main(opts):
                                  collate_fn=itm_eval_collate)
     eval_dataloader = PrefetchLoader(eval_dataloader)
 
-    eval_log, results = evaluate(model, eval_dataloader)
+    eval_log, results = evaluate(model, eval_dataloader, opts.rerank_k,
+                                 return_results=True)
     if hvd.rank() == 0:
         if not exists(opts.output_dir) and rank == 0:
             os.makedirs(opts.output_dir)
@@ -91,30 +97,6 @@ def main(opts):
         LOGGER.info("========================================================")
 
 
-@torch.no_grad()
-def evaluate(model, eval_loader):
-    model.eval()
-    st = time()
-    LOGGER.info("start running Image/Text Retrieval evaluation ...")
-    score_matrix = inference(model, eval_loader)
-    dset = eval_loader.dataset
-    all_score = hvd.allgather(score_matrix)
-    all_txt_ids = [i for ids in all_gather_list(dset.ids)
-                   for i in ids]
-    all_img_ids = dset.all_img_ids
-    assert all_score.size() == (len(all_txt_ids), len(all_img_ids))
-    if hvd.rank() != 0:
-        return {}, tuple()
-    # NOTE: only use rank0 to compute final scores
-    eval_log = itm_eval(all_score, all_txt_ids, all_img_ids,
-                        dset.txt2img, dset.img2txts)
-
-    results = (all_score, all_txt_ids, all_img_ids)
-    tot_time = time()-st
-    LOGGER.info(f"evaluation finished in {int(tot_time)} seconds, ")
-    return eval_log, results
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
@@ -148,6 +130,13 @@ if __name__ == "__main__":
                         help='static number of bounding boxes')
     parser.add_argument("--batch_size", default=400, type=int,
                         help="number of tokens in a batch")
+    parser.add_argument('--cache_img', action='store_true',
+                        help="load the image features once and reuse them "
+                             "for all the texts")
+    parser.add_argument('--rerank_k', type=int, default=0,
+                        help="two-stage retrieval: only rerank the top k "
+                             "pairs of separately encoded texts and images "
+                             "with the full model (0: score all pairs)")
 
     # device parameters
     parser.add_argument('--fp16', action='store_true',
@@ -34,11 +34,13 @@ class UniterForPretraining(UniterPreTrainedModel):
         self.itm_output = nn.Linear(config.hidden_size, 2)
         self.apply(self.init_weights)
         ### use 'do-calculus' in UNITER pretrain 2: make method 
+        # the heads reading the same confounder files share one module
+        confounders = {}
         '''
         self.predictor = FPNPredictor(config, img_dim) # use 'do-calculus' in UNITER pretrain 2 
-        self.causal_predictor_1 = CausalPredictor_1(config, img_dim) # use 'do-calculus' in UNITER pretrain 2
-        self.causal_predictor_2 = CausalPredictor_2(config, config.hidden_size)
-        self.causal_predictor_3 = CausalPredictor_3(config, img_dim)
+        self.causal_predictor_1 = CausalPredictor_1(config, img_dim, confounders) # use 'do-calculus' in UNITER pretrain 2
+        self.causal_predictor_2 = CausalPredictor_2(config, config.hidden_size, confounders)
+        self.causal_predictor_3 = CausalPredictor_3(config, img_dim, confounders)
         self.Wx = nn.Linear(config.hidden_size, config.hidden_size)
         
         nn.init.normal_(self.Wx.weight, std=0.02)
@@ -49,10 +51,10 @@ class UniterForPretraining(UniterPreTrainedModel):
         ###
         ### use 'do-calculus' in UNITER pretrain embedder (version 3)
         '''
-        self.causal_v = Causal_v()
+        self.causal_v = Causal_v(config, confounders)
         self.causal_predictor_v = BertImagePredictionHead(config, 2048)
 
-        self.causal_t = Causal_t()
+        self.causal_t = Causal_t(config, confounders)
         self.base_model_prefix = 'uniter'
 
     def forward(self, batch, task, compute_loss=True):
@@ -483,11 +483,15 @@ class UniterModel(UniterModelAdaptersMixin, UniterPreTrainedModel):
     def _compute_img_txt_embeddings(self, input_ids, position_ids,
                                     img_feat, img_pos_feat,
                                     gather_index, img_masks=None,
-                                    txt_type_ids=None, img_type_ids=None):
+                                    txt_type_ids=None, img_type_ids=None,
+                                    img_index=None):
         txt_emb = self._compute_txt_embeddings(
             input_ids, position_ids, txt_type_ids)
         img_emb = self._compute_img_embeddings(
             img_feat, img_pos_feat, img_masks, img_type_ids)
+        if img_index is not None:
+            # the images are embedded once, then broadcast to their inputs
+            img_emb = img_emb.index_select(0, img_index)
         # align back to most compact input
         gather_index = gather_index.unsqueeze(-1).expand(
             -1, -1, self.config.hidden_size)
@@ -499,7 +503,7 @@ class UniterModel(UniterModelAdaptersMixin, UniterPreTrainedModel):
                 img_feat, img_pos_feat,
                 attention_mask, gather_index=None, img_masks=None,
                 output_all_encoded_layers=True,
-                txt_type_ids=None, img_type_ids=None):
+                txt_type_ids=None, img_type_ids=None, img_index=None):
         # compute self-attention mask
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
         extended_attention_mask = extended_attention_mask.to(
@@ -519,7 +523,8 @@ class UniterModel(UniterModelAdaptersMixin, UniterPreTrainedModel):
             embedding_output = self._compute_img_txt_embeddings(
                 input_ids, position_ids,
                 img_feat, img_pos_feat,
-                gather_index, img_masks, txt_type_ids, img_type_ids)
+                gather_index, img_masks, txt_type_ids, img_type_ids,
+                img_index)
 
         encoded_layers, two_type_outputs = self.encoder(
             embedding_output, extended_attention_mask,
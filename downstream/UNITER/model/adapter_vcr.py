@@ -63,12 +63,14 @@ class UniterAdapterForVisualCommonsenseReasoning(ModelWithHeadsAdaptersMixin, Un
         attn_masks = batch['attn_masks']
         gather_index = batch['gather_index']
         txt_type_ids = batch['txt_type_ids']
+        img_index = batch['img_index']
 
         sequence_output, _, _ = self.uniter(input_ids, position_ids,
                                       img_feat, img_pos_feat,
                                       attn_masks, gather_index,
                                       output_all_encoded_layers=False,
-                                      txt_type_ids=txt_type_ids)
+                                      txt_type_ids=txt_type_ids,
+                                      img_index=img_index)
         pooled_output = self.uniter.pooler(sequence_output)
         rank_scores = self.vcr_output(pooled_output)
 
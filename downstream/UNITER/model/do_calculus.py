@@ -3,7 +3,6 @@ import torch.nn.functional as F
 import torch
 import numpy as np
 import math
-from horovod import torch as hvd
 
 '''
 class FastRCNNPredictor(nn.Module):
@@ -56,10 +55,80 @@ class FPNPredictor(nn.Module):
 
     
 
+# confounder dictionary and prior: the memory-mapped CPU arrays are shared by
+# all the heads of a process, the heads of a model share one module (which
+# moves and casts the tensors of that model only)
+DIC_FILE = './conf_and_prior_version4/dic_vcr_tot.npy'
+PRIOR_FILE = './conf_and_prior_version4/stat_prob_vcr_tot.npy'
+_DTYPES = {'float32': torch.float32, 'fp32': torch.float32,
+           'float16': torch.float16, 'fp16': torch.float16}
+if hasattr(torch, 'bfloat16'):
+    _DTYPES.update({'bfloat16': torch.bfloat16, 'bf16': torch.bfloat16})
+_confounder_arrays = {}
+
+
+def load_confounder(dic_file, prior_file):
+    """ read-only (copy-on-write) memory maps of the files, once per process """
+    key = (dic_file, prior_file)
+    if key not in _confounder_arrays:
+        _confounder_arrays[key] = (
+            torch.from_numpy(np.load(dic_file, mmap_mode='c')),
+            torch.from_numpy(np.load(prior_file, mmap_mode='c')))
+    return _confounder_arrays[key]
+
+
+class ConfounderDictionary(nn.Module):
+    """
+    the dictionary and the prior are the shared memory-mapped CPU tensors
+    until the module is moved (.to(device), .half(), ...), which gives it its
+    own copies; they are cast once, at first use, to `dtype` (default: fp16
+    on GPU, fp32 on CPU) and are not part of the state dict
+    """
+    def __init__(self, dic_file, prior_file, dtype=None):
+        super(ConfounderDictionary, self).__init__()
+        self.dtype = _DTYPES[dtype] if isinstance(dtype, str) else dtype
+        self.dic, self.prior = load_confounder(dic_file, prior_file)
+
+    def _apply(self, fn, *args, **kwargs):
+        # plain tensor attributes (not buffers), moved with the module
+        module = super(ConfounderDictionary, self)._apply(fn, *args, **kwargs)
+        self.dic = fn(self.dic)
+        self.prior = fn(self.prior)
+        return module
+
+    def forward(self):
+        dtype = self.dtype
+        if dtype is None:
+            dtype = torch.float16 if self.dic.is_cuda else torch.float32
+        if self.dic.dtype != dtype:
+            self.dic = self.dic.to(dtype)
+            self.prior = self.prior.to(dtype)
+        return self.dic, self.prior
+
+
+def config_confounder(config, dic_key='conf_dic_file',
+                      prior_key='conf_prior_file',
+                      dic_file=DIC_FILE, prior_file=PRIOR_FILE,
+                      confounders=None):
+    """ a confounder module for the files named in the model config
+    confounders: the {(files, dtype): module} dict of a model, the heads of
+    the model given the same dict share one module per files
+    """
+    key = (getattr(config, dic_key, dic_file),
+           getattr(config, prior_key, prior_file),
+           getattr(config, 'conf_dtype', None))
+    if confounders is not None and key in confounders:
+        return confounders[key]
+    confounder = ConfounderDictionary(*key)
+    if confounders is not None:
+        confounders[key] = confounder
+    return confounder
+
+
 # 2. Context Predictor
 ## 1) version 1
 class CausalPredictor_1(nn.Module):
-    def __init__(self, config, in_channels):
+    def __init__(self, config, in_channels, confounders=None):
         super(CausalPredictor_1, self).__init__()
 
         num_classes = 1601 # 나중에 옵션화
@@ -78,13 +147,10 @@ class CausalPredictor_1(nn.Module):
         nn.init.constant_(self.causal_score.bias, 0)
 
         self.feature_size = representation_size
-        self.dic = torch.tensor(np.load('./conf_and_prior_version4/dic_vcr_tot.npy'), dtype=torch.float16) # cfg.DIC_FILE[1:] 나중에 옵션화
-        self.prior = torch.tensor(np.load('./conf_and_prior_version4/stat_prob_vcr_tot.npy'), dtype=torch.float16) # cfg.PRIOR_PROB 나중에 옵션화
+        self.confounder = config_confounder(config, confounders=confounders)
 
     def forward(self, y, proposals):
-        device = y.get_device()
-        dic_z = self.dic.to(device)
-        prior = self.prior.to(device)
+        dic_z, prior = self.confounder()
 
         box_size_list = [proposal for proposal in proposals]
         feature_split = y.split(box_size_list)
@@ -98,7 +164,7 @@ class CausalPredictor_1(nn.Module):
 
 # 2) version 2, 3 
 class CausalPredictor_2(nn.Module):
-    def __init__(self, config, in_channels):
+    def __init__(self, config, in_channels, confounders=None):
         super(CausalPredictor_2, self).__init__()
 
         num_classes = 1601 # 나중에 옵션화
@@ -117,17 +183,11 @@ class CausalPredictor_2(nn.Module):
         nn.init.constant_(self.causal_score.bias, 0)
 
         self.feature_size = representation_size
-        self.dic = torch.tensor(np.load('./conf_and_prior_version4/dic_vcr_tot.npy'), dtype=torch.float16) # cfg.DIC_FILE[1:] 나중에 옵션화
-        self.dic = self.dic.to(torch.device("cuda", hvd.local_rank()))
-        # self.dic = torch.where(self.dic==0, 1e-6, )
-        self.prior = torch.tensor(np.load('./conf_and_prior_version4/stat_prob_vcr_tot.npy'), dtype=torch.float16) # cfg.PRIOR_PROB 나중에 옵션화
-        self.prior = self.prior.to(torch.device("cuda", hvd.local_rank()))
+        self.confounder = config_confounder(config, confounders=confounders)
 
     def forward(self, y, num_bbs, img_soft_labels):
 
-        # device = y[0].get_device()
-        dic_z = self.dic
-        prior = self.prior
+        dic_z, prior = self.confounder()
 
         # box_size_list = proposals #[proposal for proposal in proposals]
         # feature_split = y.split(box_size_list)
@@ -167,7 +227,7 @@ class CausalPredictor_2(nn.Module):
 
 # 3) version 4
 class CausalPredictor_3(CausalPredictor_2):
-    def __init__(self, config, in_channels):
+    def __init__(self, config, in_channels, confounders=None):
         super(CausalPredictor_2, self).__init__()
         num_classes = 1601 # 나중에 옵션화
         self.embedding_size = config.hidden_size # 나중에 옵션화 cfg.MODEL.ROI_BOX_HEAD.EMBEDDING
@@ -188,10 +248,7 @@ class CausalPredictor_3(CausalPredictor_2):
         nn.init.constant_(self.causal_score.bias, 0)
 
         self.feature_size = representation_size
-        self.dic = torch.tensor(np.load('./conf_and_prior_version4/dic_vcr_tot.npy'), dtype=torch.float16) # cfg.DIC_FILE[1:] 나중에 옵션화
-        self.dic = self.dic.to(torch.device("cuda", hvd.local_rank()))
-        self.prior = torch.tensor(np.load('./conf_and_prior_version4/stat_prob_vcr_tot.npy'), dtype=torch.float16) # cfg.PRIOR_PROB 나중에 옵션화
-        self.prior = self.prior.to(torch.device("cuda", hvd.local_rank()))
+        self.confounder = config_confounder(config, confounders=confounders)
 
     def z_dic(self, y, dic_z, prior):
         """
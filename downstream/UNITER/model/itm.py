@@ -8,6 +8,7 @@ from collections import defaultdict
 
 import torch
 from torch import nn
+from torch.nn import functional as F
 from .model import UniterPreTrainedModel, UniterModel
 
 
@@ -35,10 +36,10 @@ class UniterForImageTextRetrieval(UniterPreTrainedModel):
         img_pos_feat = batch['img_pos_feat']
         attention_mask = batch['attn_masks']
         gather_index = batch['gather_index']
-        sequence_output = self.uniter(input_ids, position_ids,
-                                      img_feat, img_pos_feat,
-                                      attention_mask, gather_index,
-                                      output_all_encoded_layers=False)
+        sequence_output, _ = self.uniter(input_ids, position_ids,
+                                         img_feat, img_pos_feat,
+                                         attention_mask, gather_index,
+                                         output_all_encoded_layers=False)
         pooled_output = self.uniter.pooler(sequence_output)
         rank_scores = self.rank_output(pooled_output)
 
@@ -54,6 +55,23 @@ class UniterForImageTextRetrieval(UniterPreTrainedModel):
         else:
             return rank_scores
 
+    def encode(self, batch):
+        """ single modality embedding for the retrieval prefilter: text only
+        (no img_feat) or image only (no input_ids) inputs, averaged over the
+        valid positions and L2 normalized
+        """
+        batch = defaultdict(lambda: None, batch)
+        attention_mask = batch['attn_masks']
+        sequence_output, _ = self.uniter(batch['input_ids'],
+                                         batch['position_ids'],
+                                         batch['img_feat'],
+                                         batch['img_pos_feat'],
+                                         attention_mask,
+                                         output_all_encoded_layers=False)
+        mask = attention_mask.unsqueeze(-1).to(dtype=sequence_output.dtype)
+        pooled_output = (sequence_output * mask).sum(dim=1) / mask.sum(dim=1)
+        return F.normalize(pooled_output.float(), dim=-1)
+
 
 class UniterForImageTextRetrievalHardNeg(UniterForImageTextRetrieval):
     """ Finetune UNITER for image text retrieval
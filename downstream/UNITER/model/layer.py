@@ -50,6 +50,47 @@ class GELU(nn.Module):
         return output
 
 
+class PackedBatch(object):
+    """ layout of a batch whose valid tokens are packed to one [sum(L), H]
+    tensor, built from the lengths of the inputs: the collates lay out the
+    tokens of every input first in its row (the text then the image tokens
+    of gather_index, the ones of attn_masks)
+    lens: [B] number of tokens of every input
+    max_len: L of the padded batch
+    index: positions of the tokens in the flattened [B*L] batch
+    groups: the packed positions [n, l] of the n inputs of each length l,
+        attention runs per group, without padding nor mask
+    """
+    def __init__(self, lens, max_len):
+        device = lens.device
+        lens = lens.cpu()
+        self.batch_size = lens.size(0)
+        self.max_len = max_len
+        starts = torch.cumsum(lens, 0) - lens
+        rows = torch.arange(self.batch_size).repeat_interleave(lens)
+        pos = torch.arange(rows.size(0)) - starts[rows]
+        self.index = (rows * max_len + pos).to(device)
+
+        groups = [starts[lens == length].unsqueeze(1) + torch.arange(length)
+                  for length in lens.unique().tolist() if length > 0]
+        # one copy to the device for all the groups
+        flat = torch.cat([g.view(-1) for g in groups]).to(device)
+        self.groups = [positions.view(g.size())
+                       for positions, g in zip(
+                           flat.split([g.numel() for g in groups]), groups)]
+
+    def pack(self, padded):
+        """ [B, L, H] -> [sum(L), H] """
+        return padded.view(-1, padded.size(-1)).index_select(0, self.index)
+
+    def pad(self, packed):
+        """ [sum(L), H] -> [B, L, H], zeros at the padding """
+        padded = packed.new_zeros(self.batch_size*self.max_len,
+                                  packed.size(-1))
+        padded.index_copy_(0, self.index, packed)
+        return padded.view(self.batch_size, self.max_len, -1)
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
         super(BertSelfAttention, self).__init__()
@@ -72,20 +113,46 @@ class BertSelfAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, attention_mask):
+    def forward(self, hidden_states, attention_mask, packed=None):
         mixed_query_layer = self.query(hidden_states)
         mixed_key_layer = self.key(hidden_states)
         mixed_value_layer = self.value(hidden_states)
+        if packed is not None:
+            return self.packed_attention(mixed_query_layer, mixed_key_layer,
+                                         mixed_value_layer, packed)
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
+        context_layer = self.attend(query_layer, key_layer, value_layer,
+                                    attention_mask)
+        return context_layer
+
+    def packed_attention(self, mixed_query_layer, mixed_key_layer,
+                         mixed_value_layer, packed):
+        """ block-diagonal attention of packed [sum(L), H] tokens: every
+        group of inputs of the same length attends as one unmasked batch """
+        context_layer = mixed_query_layer.new_empty(mixed_query_layer.size())
+        for positions in packed.groups:
+            n, length = positions.size()
+            positions = positions.view(-1)
+            query_layer, key_layer, value_layer = (
+                self.transpose_for_scores(
+                    layer.index_select(0, positions).view(n, length, -1))
+                for layer in (mixed_query_layer, mixed_key_layer,
+                              mixed_value_layer))
+            context = self.attend(query_layer, key_layer, value_layer)
+            context_layer.index_copy_(
+                0, positions, context.view(-1, self.all_head_size))
+        return context_layer
 
+    def attend(self, query_layer, key_layer, value_layer, attention_mask=None):
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-        attention_scores = attention_scores + attention_mask
+        if attention_mask is not None:
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
         attention_probs = nn.Softmax(dim=-1)(attention_scores)
@@ -121,8 +188,8 @@ class BertAttention(nn.Module):
         self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, input_tensor, attention_mask):
-        self_output = self.self(input_tensor, attention_mask)
+    def forward(self, input_tensor, attention_mask, packed=None):
+        self_output = self.self(input_tensor, attention_mask, packed)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -163,8 +230,9 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def forward(self, hidden_states, attention_mask, packed=None):
+        attention_output = self.attention(hidden_states, attention_mask,
+                                          packed)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output
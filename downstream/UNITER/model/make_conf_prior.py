@@ -160,10 +160,12 @@ class UniterForEmbedConfPriorForVCR(UniterForConfPriorForVCR):
         img_pos_feat = batch['img_pos_feat']
         attn_masks = batch['attn_masks']
         gather_index = batch['gather_index']
+        img_index = batch['img_index']
         sequence_output, embedding_output = self.uniter(input_ids, position_ids,
                                       img_feat, img_pos_feat,
                                       attn_masks, gather_index,
-                                      output_all_encoded_layers=False)
+                                      output_all_encoded_layers=False,
+                                      img_index=img_index)
 
         ### compute confounder dictionary : extract soft label
         img_soft_label = batch['img_soft_label']
@@ -231,10 +233,12 @@ class UniterForUpDownConfPriorForVCR(UniterForConfPriorForVCR):
         img_pos_feat = batch['img_pos_feat']
         attn_masks = batch['attn_masks']
         gather_index = batch['gather_index']
+        img_index = batch['img_index']
         sequence_output, embedding_output = self.uniter(input_ids, position_ids,
                                       img_feat, img_pos_feat,
                                       attn_masks, gather_index,
-                                      output_all_encoded_layers=False)
+                                      output_all_encoded_layers=False,
+                                      img_index=img_index)
 
         ### compute confounder dictionary : extract soft label
         img_soft_label = batch['img_soft_label']
@@ -16,7 +16,7 @@ from torch import nn
 from apex.normalization.fused_layer_norm import FusedLayerNorm
 import numpy as np
 
-from .layer import BertLayer, BertPooler
+from .layer import BertLayer, BertPooler, PackedBatch
 
 
 logger = logging.getLogger(__name__)
@@ -284,19 +284,41 @@ class UniterEncoder(nn.Module):
                                     for _ in range(config.num_hidden_layers)])
 
     def forward(self, input_, attention_mask,
-                output_all_encoded_layers=True):
+                output_all_encoded_layers=True, packed=None):
+        """
+        packed: PackedBatch of the input; if given, the layers run on the
+        [sum(L), H] valid tokens only (attention per input, see
+        BertSelfAttention.packed_attention) and the outputs are scattered
+        back to [B, L, H] (zeros at the padding)
+        """
+        def unpack(hidden_states):
+            if packed is None:
+                return hidden_states
+            return packed.pad(hidden_states)
+
         all_encoder_layers = []
         hidden_states = input_
+        if packed is not None:
+            hidden_states = packed.pack(hidden_states)
         for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+            hidden_states = layer_module(hidden_states, attention_mask,
+                                         packed)
             if output_all_encoded_layers:
-                all_encoder_layers.append(hidden_states)
+                all_encoder_layers.append(unpack(hidden_states))
         if not output_all_encoded_layers:
-            all_encoder_layers.append(hidden_states)
+            all_encoder_layers.append(unpack(hidden_states))
         return all_encoder_layers
 
 class UniterModel(UniterPreTrainedModel):
     """ Modification for Joint Vision-Language Encoding
+
+    with "packed_encoder": true in the model config, the encoder skips the
+    padding: the valid tokens of the batch (the ones of attention_mask, laid
+    out first in each row by gather_index) run through the projections,
+    feed-forward and layer norms as one [sum(L), H] tensor, and the
+    attention is block-diagonal, computed per group of inputs of the same
+    length without any mask. The outputs at the valid positions are the ones
+    of the padded path.
     """
     def __init__(self, config, img_dim):
         super().__init__(config)
@@ -304,6 +326,7 @@ class UniterModel(UniterPreTrainedModel):
         self.img_embeddings = UniterImageEmbeddings(config, img_dim)
         self.encoder = UniterEncoder(config)
         self.pooler = BertPooler(config)
+        self.packed_encoder = getattr(config, 'packed_encoder', False)
         self.apply(self.init_weights)
 
     def _compute_txt_embeddings(self, input_ids, position_ids,
@@ -324,11 +347,15 @@ class UniterModel(UniterPreTrainedModel):
     def _compute_img_txt_embeddings(self, input_ids, position_ids,
                                     img_feat, img_pos_feat,
                                     gather_index, img_masks=None,
-                                    txt_type_ids=None, img_type_ids=None):
+                                    txt_type_ids=None, img_type_ids=None,
+                                    img_index=None):
         txt_emb = self._compute_txt_embeddings(
             input_ids, position_ids, txt_type_ids)
         img_emb = self._compute_img_embeddings(
             img_feat, img_pos_feat, img_masks, img_type_ids)
+        if img_index is not None:
+            # the images are embedded once, then broadcast to their inputs
+            img_emb = img_emb.index_select(0, img_index)
         # align back to most compact input
         gather_index = gather_index.unsqueeze(-1).expand(
             -1, -1, self.config.hidden_size)
@@ -340,7 +367,7 @@ class UniterModel(UniterPreTrainedModel):
                 img_feat, img_pos_feat,
                 attention_mask, gather_index=None, img_masks=None,
                 output_all_encoded_layers=True,
-                txt_type_ids=None, img_type_ids=None):
+                txt_type_ids=None, img_type_ids=None, img_index=None):
         # compute self-attention mask
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
         extended_attention_mask = extended_attention_mask.to(
@@ -360,11 +387,17 @@ class UniterModel(UniterPreTrainedModel):
             embedding_output = self._compute_img_txt_embeddings(
                 input_ids, position_ids,
                 img_feat, img_pos_feat,
-                gather_index, img_masks, txt_type_ids, img_type_ids)
+                gather_index, img_masks, txt_type_ids, img_type_ids,
+                img_index)
 
+        packed = None
+        if self.packed_encoder:
+            # the lengths of the collate (txt_lens + num_bbs)
+            packed = PackedBatch(attention_mask.sum(1), attention_mask.size(1))
         encoded_layers = self.encoder(
             embedding_output, extended_attention_mask,
-            output_all_encoded_layers=output_all_encoded_layers)
+            output_all_encoded_layers=output_all_encoded_layers,
+            packed=packed)
         if not output_all_encoded_layers:
             encoded_layers = encoded_layers[-1]
         return encoded_layers, embedding_output
@@ -575,7 +608,7 @@ class UniterModelConfPrior(UniterModel):
                 img_feat, img_pos_feat,
                 attention_mask, gather_index=None, img_masks=None,
                 output_all_encoded_layers=True,
-                txt_type_ids=None, img_type_ids=None):
+                txt_type_ids=None, img_type_ids=None, img_index=None):
         # compute self-attention mask
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
         extended_attention_mask = extended_attention_mask.to(
@@ -595,7 +628,8 @@ class UniterModelConfPrior(UniterModel):
             embedding_output = self._compute_img_txt_embeddings(
                 input_ids, position_ids,
                 img_feat, img_pos_feat,
-                gather_index, img_masks, txt_type_ids, img_type_ids)
+                gather_index, img_masks, txt_type_ids, img_type_ids,
+                img_index)
         '''
         encoded_layers = self.encoder(
             embedding_output, extended_attention_mask,
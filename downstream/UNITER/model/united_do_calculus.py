@@ -3,40 +3,82 @@ import torch
 import numpy as np
 import torch.nn.functional as F
 
+from .do_calculus import config_confounder
+
+DIC_V_FILE = "./conf_and_prior_1_mrc_from_devlbert/dic_v.npy"
+PRIOR_V_FILE = "./conf_and_prior_1_mrc_from_devlbert/prior_v.npy"
+DIC_T_FILE = "./conf_and_prior_1_mrc_from_devlbert/dic_t.npy"
+PRIOR_T_FILE = "./conf_and_prior_1_mrc_from_devlbert/prior_t.npy"
+
+
+def matmul_intervention(attention, dic_z, prior, topk=None):
+    """
+    z = sum_k P(z_k) softmax(attention)_k z_k for every query as one matmul,
+    without the [..., K, D] weighted entries; with topk the softmax only
+    keeps the topk dictionary entries of every query
+    attention: [..., K] logits, dic_z: [K, D], prior: [K]
+    """
+    if topk is not None and topk < attention.size(-1):
+        values, indices = attention.topk(topk, dim=-1)
+        attention = torch.zeros_like(attention).scatter_(
+            -1, indices, F.softmax(values, -1))
+    else:
+        attention = F.softmax(attention, -1)
+    return torch.matmul((attention * prior).to(dic_z.dtype), dic_z)
+
+
+def config_intervention(config):
+    """ conf_intervention: "dense" (N x K x D weighted entries), "matmul" or
+    "topk" (matmul over the conf_intervention_topk best entries) """
+    mode = getattr(config, 'conf_intervention', 'dense')
+    assert mode in ('dense', 'matmul', 'topk'), \
+        f'Unknown intervention mode {mode}'
+    topk = getattr(config, 'conf_intervention_topk', 32)
+    return mode, topk if mode == 'topk' else None
+
+
 class Causal_v(nn.Module):
-    def __init__(self):
+    def __init__(self, config, confounders=None):
         super(Causal_v, self).__init__()
         self.embedding_size = 768
         self.Wy = nn.Linear(self.embedding_size, self.embedding_size)
         self.Wz = nn.Linear(2048, self.embedding_size)
-        self.dic_z = torch.tensor(np.load("./conf_and_prior_1_mrc_from_devlbert/dic_v.npy"), dtype=torch.float16).cuda()
-        self.prior = torch.tensor(np.load("./conf_and_prior_1_mrc_from_devlbert/prior_v.npy"), dtype=torch.float16).cuda()
+        self.confounder = config_confounder(
+            config, 'conf_dic_v_file', 'conf_prior_v_file',
+            DIC_V_FILE, PRIOR_V_FILE, confounders)
+        self.intervention, self.topk = config_intervention(config)
         nn.init.normal_(self.Wy.weight, std=0.02)
         nn.init.normal_(self.Wz.weight, std=0.02)
         nn.init.constant_(self.Wy.bias, 0)
         nn.init.constant_(self.Wz.bias, 0)
 
     def forward(self, y):
+        dic_z, prior = self.confounder()
+        if self.intervention != 'dense':
+            attention = torch.matmul(self.Wy(y), self.Wz(dic_z).t()) / (self.embedding_size ** 0.5)
+            return matmul_intervention(attention, dic_z, prior, self.topk)
         temp = []
         # Class = torch.argmax(image_target, 2, keepdim=True)
         # for boxes, cls in zip(y, Class):
         for boxes in y:
-            attention = torch.mm(self.Wy(boxes), self.Wz(self.dic_z).t()) / (self.embedding_size ** 0.5)
+            attention = torch.mm(self.Wy(boxes), self.Wz(dic_z).t()) / (self.embedding_size ** 0.5)
             attention = F.softmax(attention, 1)  # torch.Size([box, 1601])
-            z_hat = attention.unsqueeze(2) * self.dic_z.unsqueeze(0)  # torch.Size([box, 1601, 2048])
-            z = torch.matmul(self.prior.unsqueeze(0), z_hat).squeeze(1)  # torch.Size([box, 1, 2048])->torch.Size([box, 2048])
+            z_hat = attention.unsqueeze(2) * dic_z.unsqueeze(0)  # torch.Size([box, 1601, 2048])
+            z = torch.matmul(prior.unsqueeze(0), z_hat).squeeze(1)  # torch.Size([box, 1, 2048])->torch.Size([box, 2048])
             temp.append(z)
         temp = torch.stack(temp, 0)
         return temp
 
 class Causal_t(nn.Module):
-    def __init__(self):
+    def __init__(self, config, confounders=None):
         super(Causal_t, self).__init__()
         self.embedding_size = 768
         self.Wy = nn.Linear(768, 768)
         self.Wz = nn.Linear(768, 768)
-        self.dic_z = torch.tensor(np.load("./conf_and_prior_1_mrc_from_devlbert/dic_t.npy"), dtype=torch.float16).cuda()
-        self.prior = torch.tensor(np.load("./conf_and_prior_1_mrc_from_devlbert/prior_t.npy"), dtype=torch.float16).cuda()
+        self.confounder = config_confounder(
+            config, 'conf_dic_t_file', 'conf_prior_t_file',
+            DIC_T_FILE, PRIOR_T_FILE, confounders)
+        self.intervention, self.topk = config_intervention(config)
         nn.init.normal_(self.Wy.weight, std=0.02)
         nn.init.normal_(self.Wz.weight, std=0.02)
         nn.init.constant_(self.Wy.bias, 0)
@@ -44,12 +86,16 @@ class Causal_t(nn.Module):
         # self.id2class = np.load("./dic/id2class.npy", allow_pickle=True).item()
 
     def forward(self, y):
+        dic_z, prior = self.confounder()
+        if self.intervention != 'dense':
+            attention = torch.matmul(self.Wy(y), self.Wz(dic_z).t()) / (self.embedding_size ** 0.5)
+            return matmul_intervention(attention, dic_z, prior, self.topk)
         temp = []
         for sentence in y:
-            attention = torch.mm(self.Wy(sentence), self.Wz(self.dic_z).t()) / (self.embedding_size ** 0.5)
+            attention = torch.mm(self.Wy(sentence), self.Wz(dic_z).t()) / (self.embedding_size ** 0.5)
             attention = F.softmax(attention, 1)  # torch.Size([box, 1601])
-            z_hat = attention.unsqueeze(2) * self.dic_z.unsqueeze(0)  # torch.Size([box, 1601, 2048])
-            z = torch.matmul(self.prior.unsqueeze(0), z_hat).squeeze(1)  # torch.Size([box, 1, 2048])->torch.Size([box, 2048])
+            z_hat = attention.unsqueeze(2) * dic_z.unsqueeze(0)  # torch.Size([box, 1601, 2048])
+            z = torch.matmul(prior.unsqueeze(0), z_hat).squeeze(1)  # torch.Size([box, 1, 2048])->torch.Size([box, 2048])
             temp.append(z)
         temp = torch.stack(temp, 0)
         return temp
\ No newline at end of file
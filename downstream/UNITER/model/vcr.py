@@ -67,12 +67,14 @@ class UniterForVisualCommonsenseReasoning(UniterPreTrainedModel):
         attn_masks = batch['attn_masks']
         gather_index = batch['gather_index']
         txt_type_ids = batch['txt_type_ids']
+        img_index = batch['img_index']
         
         sequence_output, _ = self.uniter(input_ids, position_ids,
                                       img_feat, img_pos_feat,
                                       attn_masks, gather_index,
                                       output_all_encoded_layers=False,
-                                      txt_type_ids=txt_type_ids)
+                                      txt_type_ids=txt_type_ids,
+                                      img_index=img_index)
         '''
         ### compute confounder dictionary 2 : extract soft label
         img_soft_label = batch['img_soft_label']
@@ -163,6 +165,7 @@ class UniterForVisualCommonsenseReasoningDc(UniterPreTrainedModel):
         attn_masks = batch['attn_masks']
         gather_index = batch['gather_index']
         txt_type_ids = batch['txt_type_ids']
+        img_index = batch['img_index']
         # do-calculus #
         input_ids_dc = batch['input_ids_dc']
         position_ids_dc = batch['position_ids_dc']
@@ -174,7 +177,8 @@ class UniterForVisualCommonsenseReasoningDc(UniterPreTrainedModel):
                                       img_feat, img_pos_feat,
                                       attn_masks, gather_index,
                                       output_all_encoded_layers=False,
-                                      txt_type_ids=txt_type_ids)
+                                      txt_type_ids=txt_type_ids,
+                                      img_index=img_index)
         pooled_output = self.uniter.pooler(sequence_output)
         rank_scores = self.vcr_output(pooled_output)
 
@@ -183,7 +187,8 @@ class UniterForVisualCommonsenseReasoningDc(UniterPreTrainedModel):
                                     img_feat, img_pos_feat,
                                     attn_masks_dc, gather_index_dc,
                                     output_all_encoded_layers=False,
-                                    txt_type_ids=txt_type_ids_dc)
+                                    txt_type_ids=txt_type_ids_dc,
+                                    img_index=img_index)
         pooled_output_dc = self.uniter.pooler(sequence_output_dc)
         rank_scores_dc = self.vcr_output(pooled_output_dc)
 
@@ -14,7 +14,7 @@ from cytoolz import curry
 from tqdm import tqdm
 from pytorch_pretrained_bert import BertTokenizer
 
-from data.data import open_lmdb
+from data.data import open_lmdb, write_txt_img_index
 
 
 @curry
@@ -160,6 +160,8 @@ def main(opts):
     for dump, name in zip(jsons, output_field_name):
         with open(f'{opts.output}/{name}.json', 'w') as f:
             json.dump(dump, f)
+    if 'txt2img' in output_field_name:
+        write_txt_img_index(opts.output)
 
 
 if __name__ == '__main__':
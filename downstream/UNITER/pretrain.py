@@ -206,9 +206,11 @@ def main(opts):
         opts.train_datasets, True, opts)
     val_dataloaders, _ = create_dataloaders(
         opts.val_datasets, False, opts, all_img_dbs)
+    # one pool of n_workers loads the batches of all the training tasks
     meta_loader = MetaLoader(train_dataloaders,
                              accum_steps=opts.gradient_accumulation_steps,
-                             distributed=n_gpu > 1)
+                             distributed=n_gpu > 1,
+                             n_workers=opts.n_workers, pin_mem=opts.pin_mem)
     meta_loader = PrefetchLoader(meta_loader)
 
     # Prepare model
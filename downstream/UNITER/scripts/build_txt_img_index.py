@@ -0,0 +1,27 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+write the binary txt2img/img2txts sidecar of existing text DBs
+(new DBs get it from prepro.py)
+
+usage: PYTHONPATH=. python scripts/build_txt_img_index.py <txt_db> ...
+"""
+import argparse
+
+from data.data import write_txt_img_index
+
+
+def main(opts):
+    for db_dir in opts.txt_dbs:
+        if write_txt_img_index(db_dir):
+            print(f'{db_dir}: wrote {db_dir}/txt_img_index')
+        else:
+            print(f'{db_dir}: ragged txt2img, keeping the json files')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('txt_dbs', nargs='+', help='text DB directories')
+    args = parser.parse_args()
+    main(args)
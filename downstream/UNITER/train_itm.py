@@ -19,7 +19,7 @@ from tqdm import tqdm
 from data import (PrefetchLoader, TxtTokLmdb, ImageLmdbGroup,
                   ItmRankDataset, itm_rank_collate,
                   ItmValDataset, itm_val_collate,
-                  ItmEvalDataset, itm_eval_collate)
+                  ItmEvalDataset, ItmRerankEvalDataset, itm_eval_collate)
 from model.itm import UniterForImageTextRetrieval
 from optim import get_lr_sched
 from optim.misc import build_optimizer
@@ -109,14 +109,24 @@ def main(opts):
     LOGGER.info(f"Loading val, test Dataset for full evaluation: "
                 f"{opts.val_txt_db}, {opts.val_img_db}"
                 f"{opts.test_txt_db}, {opts.test_img_db}")
-    eval_dataset_val = ItmEvalDataset(val_txt_db, val_img_db,
-                                      opts.inf_minibatch_size)
+    if opts.rerank_k > 0:
+        eval_dataset_val = ItmRerankEvalDataset(val_txt_db, val_img_db,
+                                                opts.inf_minibatch_size)
+    else:
+        eval_dataset_val = ItmEvalDataset(val_txt_db, val_img_db,
+                                          opts.inf_minibatch_size,
+                                          cache_img=opts.cache_img)
     eval_loader_val = build_dataloader(eval_dataset_val, itm_eval_collate,
                                        False, opts)
     test_img_db = all_img_dbs[opts.test_img_db]
     test_txt_db = TxtTokLmdb(opts.test_txt_db, -1)
-    eval_dataset_test = ItmEvalDataset(test_txt_db, test_img_db,
-                                       opts.inf_minibatch_size)
+    if opts.rerank_k > 0:
+        eval_dataset_test = ItmRerankEvalDataset(test_txt_db, test_img_db,
+                                                 opts.inf_minibatch_size)
+    else:
+        eval_dataset_test = ItmEvalDataset(test_txt_db, test_img_db,
+                                           opts.inf_minibatch_size,
+                                           cache_img=opts.cache_img)
     eval_loader_test = build_dataloader(eval_dataset_test, itm_eval_collate,
                                         False, opts)
 
@@ -215,7 +225,8 @@ def main(opts):
                         LOGGER.info(
                             f"========================== Step {global_step} "
                             f"==========================")
-                        val_log = evaluate(model, eval_loader_val)
+                        val_log = evaluate(model, eval_loader_val,
+                                           opts.rerank_k)
                         TB_LOGGER.log_scaler_dict(
                             {f"valid/{k}": v for k, v in val_log.items()})
                         LOGGER.info(f"image retrieval R1: "
@@ -255,7 +266,7 @@ def main(opts):
     # evaluation
     for split, loader in [('val', eval_loader_val),
                           ('test', eval_loader_test)]:
-        eval_log = evaluate(model, loader)
+        eval_log = evaluate(model, loader, opts.rerank_k)
         TB_LOGGER.log_scaler_dict({f"eval/{split}_{k}": v
                                    for k, v in eval_log.items()})
         if hvd.rank() != 0:
@@ -384,6 +395,13 @@ if __name__ == "__main__":
                         help="random seed for initialization")
     parser.add_argument('--full_val', action='store_true',
                         help="Always run full evaluation during training")
+    parser.add_argument('--cache_img', action='store_true',
+                        help="load the image features of the full evaluation "
+                             "once and reuse them for all the texts")
+    parser.add_argument('--rerank_k', type=int, default=0,
+                        help="full evaluation with two-stage retrieval: only "
+                             "rerank the top k pairs of separately encoded "
+                             "texts and images (0: score all pairs)")
     parser.add_argument('--fp16', action='store_true',
                         help="Whether to use 16-bit float precision instead "
                              "of 32-bit")
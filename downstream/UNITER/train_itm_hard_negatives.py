@@ -113,13 +113,15 @@ def main(opts):
                 f"{opts.val_txt_db}, {opts.val_img_db}"
                 f"{opts.test_txt_db}, {opts.test_img_db}")
     eval_dataset_val = ItmEvalDataset(val_txt_db, val_img_db,
-                                      opts.inf_minibatch_size)
+                                      opts.inf_minibatch_size,
+                                      cache_img=opts.cache_img)
     eval_loader_val = build_dataloader(eval_dataset_val, itm_eval_collate,
                                        False, opts)
     test_img_db = all_img_dbs[opts.test_img_db]
     test_txt_db = TxtTokLmdb(opts.test_txt_db, -1)
     eval_dataset_test = ItmEvalDataset(test_txt_db, test_img_db,
-                                       opts.inf_minibatch_size)
+                                       opts.inf_minibatch_size,
+                                       cache_img=opts.cache_img)
     eval_loader_test = build_dataloader(eval_dataset_test, itm_eval_collate,
                                         False, opts)
 
@@ -411,6 +413,9 @@ if __name__ == "__main__":
                         help="random seed for initialization")
     parser.add_argument('--full_val', action='store_true',
                         help="Always run full evaluation during training")
+    parser.add_argument('--cache_img', action='store_true',
+                        help="load the image features of the full evaluation "
+                             "once and reuse them for all the texts")
     parser.add_argument('--fp16', action='store_true',
                         help="Whether to use 16-bit float precision instead "
                              "of 32-bit")
@@ -15,40 +15,81 @@ from .misc import NoOp
 from .distributed import all_gather_list
 
 
-@torch.no_grad()
-def itm_eval(score_matrix, txt_ids, img_ids, txt2img, img2txts):
-    # image retrieval
+def _gt_index(txt_ids, img_ids, txt2img, img2txts, device):
+    """ ground truth of every text (index of its image) and of every image
+    (indices of its texts, padded with -1) """
     img2j = {i: j for j, i in enumerate(img_ids)}
-    _, rank_txt = score_matrix.topk(10, dim=1)
+    txt2i = {t: i for i, t in enumerate(txt_ids)}
     gt_img_j = torch.LongTensor([img2j[txt2img[txt_id]]
-                                 for txt_id in txt_ids],
-                                ).to(rank_txt.device
-                                     ).unsqueeze(1).expand_as(rank_txt)
-    rank = (rank_txt == gt_img_j).nonzero()
-    if rank.numel():
-        ir_r1 = (rank < 1).sum().item() / len(txt_ids)
-        ir_r5 = (rank < 5).sum().item() / len(txt_ids)
-        ir_r10 = (rank < 10).sum().item() / len(txt_ids)
+                                 for txt_id in txt_ids]).to(device)
+    max_txts = max(len(img2txts[img_id]) for img_id in img_ids)
+    gt_txt_i = torch.full((len(img_ids), max_txts), -1, dtype=torch.long)
+    for j, img_id in enumerate(img_ids):
+        txt_is = [txt2i[t] for t in img2txts[img_id]]
+        gt_txt_i[j, :len(txt_is)] = torch.LongTensor(txt_is)
+    return gt_img_j, gt_txt_i.to(device)
+
+
+def _hits_at_k(hit, ks):
+    """ hit: N x K, whether the item ranked j-th for the i-th query is a
+    ground truth; returns the number of queries with a hit in the top k,
+    for every k of ks """
+    return [hit[:, :k].any(dim=1).sum().item() for k in ks]
+
+
+@torch.no_grad()
+def _recalls(score_matrix, txt_ids, img_ids, txt2img, img2txts, ks,
+             distributed=False):
+    """ image and text retrieval recall@k for every k of ks
+
+    with distributed, score_matrix only holds the rows of txt_ids, the texts
+    of this process (the full matrix being the rows of all the processes in
+    rank order); only the counts and the per-image top max(ks) texts are
+    gathered, every process has to call it
+    """
+    max_k = max(ks)
+    device = score_matrix.device
+    if distributed:
+        rank_txt_ids = all_gather_list(txt_ids)
+        all_txt_ids = [i for ids in rank_txt_ids for i in ids]
+        offset = sum(len(ids) for ids in rank_txt_ids[:hvd.rank()])
     else:
-        ir_r1, ir_r5, ir_r10 = 0, 0, 0
+        all_txt_ids = txt_ids
+        offset = 0
+    gt_img_j, gt_txt_i = _gt_index(all_txt_ids, img_ids, txt2img, img2txts,
+                                   device)
 
-    # text retrieval
-    txt2i = {t: i for i, t in enumerate(txt_ids)}
-    _, rank_img = score_matrix.topk(10, dim=0)
-    tr_r1, tr_r5, tr_r10 = 0, 0, 0
-    for j, img_id in enumerate(img_ids):
-        gt_is = [txt2i[t] for t in img2txts[img_id]]
-        ranks = [(rank_img[:, j] == i).nonzero() for i in gt_is]
-        rank = min([10] + [r.item() for r in ranks if r.numel()])
-        if rank < 1:
-            tr_r1 += 1
-        if rank < 5:
-            tr_r5 += 1
-        if rank < 10:
-            tr_r10 += 1
-    tr_r1 /= len(img_ids)
-    tr_r5 /= len(img_ids)
-    tr_r10 /= len(img_ids)
+    # image retrieval, each text only needs its own row
+    _, rank_txt = score_matrix.topk(min(max_k, len(img_ids)), dim=1)
+    local_gt = gt_img_j[offset:offset+len(txt_ids)].unsqueeze(1)
+    ir_hits = _hits_at_k(rank_txt == local_gt, ks)
+    if distributed:
+        ir_hits = [sum(h) for h in zip(*all_gather_list(ir_hits))]
+
+    # text retrieval, merge the per-process top max_k of every image
+    scores, rank_img = score_matrix.topk(min(max_k, len(txt_ids)), dim=0)
+    rank_img += offset
+    if distributed:
+        scores = hvd.allgather(scores.contiguous())
+        rank_img = hvd.allgather(rank_img.contiguous())
+        _, top = scores.topk(min(max_k, scores.size(0)), dim=0)
+        rank_img = rank_img.gather(0, top)
+    tr_hits = _hits_at_k(
+        (rank_img.t().unsqueeze(2) == gt_txt_i.unsqueeze(1)).any(dim=2), ks)
+
+    ir = {k: h / len(all_txt_ids) for k, h in zip(ks, ir_hits)}
+    tr = {k: h / len(img_ids) for k, h in zip(ks, tr_hits)}
+    return ir, tr
+
+
+@torch.no_grad()
+def itm_eval(score_matrix, txt_ids, img_ids, txt2img, img2txts,
+             distributed=False):
+    """ see _recalls for distributed """
+    ir, tr = _recalls(score_matrix, txt_ids, img_ids, txt2img, img2txts,
+                      (1, 5, 10), distributed)
+    ir_r1, ir_r5, ir_r10 = ir[1], ir[5], ir[10]
+    tr_r1, tr_r5, tr_r10 = tr[1], tr[5], tr[10]
 
     tr_mean = (tr_r1 + tr_r5 + tr_r10) / 3
     ir_mean = (ir_r1 + ir_r5 + ir_r10) / 3
@@ -67,25 +108,62 @@ def itm_eval(score_matrix, txt_ids, img_ids, txt2img, img2txts):
 
 
 @torch.no_grad()
-def evaluate(model, eval_loader):
+def recall_at_k(score_matrix, txt_ids, img_ids, txt2img, img2txts, k,
+                distributed=False):
+    """ fraction of the texts (images) with a ground truth image (text)
+    in their top k """
+    ir, tr = _recalls(score_matrix, txt_ids, img_ids, txt2img, img2txts,
+                      (k,), distributed)
+    return ir[k], tr[k]
+
+
+@torch.no_grad()
+def evaluate(model, eval_loader, rerank_k=0, return_results=False):
+    """ rerank_k > 0 runs the two-stage retrieval (see rerank_inference),
+    eval_loader then iterates an ItmRerankEvalDataset
+    return_results also gathers the full score matrix and returns
+    (eval_log, (all_score, all_txt_ids, all_img_ids)), on rank 0 only """
     st = time()
     LOGGER.info("start running Image/Text Retrieval evaluation ...")
-    score_matrix = inference(model, eval_loader)
+    if rerank_k > 0:
+        score_matrix, prefilter_score = rerank_inference(
+            model, eval_loader, rerank_k)
+    else:
+        score_matrix = inference(model, eval_loader)
     dset = eval_loader.dataset
-    all_score = hvd.allgather(score_matrix)
-    all_txt_ids = [i for ids in all_gather_list(dset.ids)
-                   for i in ids]
-    all_img_ids = dset.all_img_ids
-    assert all_score.size() == (len(all_txt_ids), len(all_img_ids))
-    if hvd.rank() != 0:
-        return {}
+    assert score_matrix.size() == (len(dset.ids), len(dset.all_img_ids))
 
-    # NOTE: only use rank0 to compute final scores
-    eval_log = itm_eval(all_score, all_txt_ids, all_img_ids,
-                        dset.txt2img, dset.img2txts)
+    # the score matrix stays sharded, only the top ranks are gathered
+    eval_log = itm_eval(score_matrix, dset.ids, dset.all_img_ids,
+                        dset.txt2img, dset.img2txts, distributed=True)
+    if rerank_k > 0:
+        # quality of the first stage alone, recall@rerank_k bounds the
+        # recall of the reranked results
+        prefilter_log = itm_eval(prefilter_score, dset.ids,
+                                 dset.all_img_ids, dset.txt2img,
+                                 dset.img2txts, distributed=True)
+        ir_rk, tr_rk = recall_at_k(prefilter_score, dset.ids,
+                                   dset.all_img_ids, dset.txt2img,
+                                   dset.img2txts, rerank_k, distributed=True)
+        prefilter_log[f'img_r{rerank_k}'] = ir_rk
+        prefilter_log[f'txt_r{rerank_k}'] = tr_rk
+        eval_log.update({f'prefilter_{k}': v
+                         for k, v in prefilter_log.items()})
+        LOGGER.info(f"prefilter recall@{rerank_k}: "
+                    f"image retrieval {ir_rk*100:.2f}, "
+                    f"text retrieval {tr_rk*100:.2f}")
+    if return_results:
+        all_score = hvd.allgather(score_matrix)
+        all_txt_ids = [i for ids in all_gather_list(dset.ids)
+                       for i in ids]
+        results = (all_score, all_txt_ids, dset.all_img_ids)
+    if hvd.rank() != 0:
+        return ({}, tuple()) if return_results else {}
 
     tot_time = time()-st
     LOGGER.info(f"evaluation finished in {int(tot_time)} seconds")
+    if return_results:
+        return eval_log, results
     return eval_log
 
 
@@ -112,3 +190,87 @@ def inference(model, eval_loader):
     model.train()
     pbar.close()
     return score_matrix
+
+
+@torch.no_grad()
+def prefilter(model, dset, k, batch_size=256):
+    """ first stage of the two-stage retrieval: the texts of this process and
+    all the images are encoded once, separately, and every pair is scored by
+    the cosine similarity of the embeddings
+
+    Returns:
+        score_matrix: local texts x images similarities
+        candidates: for every local text, the indices of the images to
+            rerank: its top k images and the images having it in their
+            top k texts (among the texts of all processes)
+    """
+    model.eval()
+    txt_emb = torch.cat([model.encode(_to_cuda(batch))
+                         for batch in dset.txt_batches(batch_size)], dim=0)
+    img_emb = torch.cat([model.encode(_to_cuda(batch))
+                         for batch in dset.img_batches(batch_size)], dim=0)
+    score_matrix = txt_emb @ img_emb.t()
+
+    # image retrieval candidates
+    candidate_mask = torch.zeros(score_matrix.size(), dtype=torch.bool,
+                                 device=score_matrix.device)
+    _, rank_txt = score_matrix.topk(min(k, img_emb.size(0)), dim=1)
+    candidate_mask.scatter_(1, rank_txt, True)
+
+    # text retrieval candidates, the texts are split across processes
+    all_txt_emb = hvd.allgather(txt_emb)
+    n_txts = all_gather_list(txt_emb.size(0))
+    offset = sum(n_txts[:hvd.rank()])
+    k_txt = min(k, all_txt_emb.size(0))
+    for st in range(0, img_emb.size(0), batch_size):
+        sim = all_txt_emb @ img_emb[st:st+batch_size].t()
+        _, rank_img = sim.topk(k_txt, dim=0)
+        txt_i = rank_img - offset
+        img_j = torch.arange(st, st + sim.size(1), device=sim.device
+                             ).unsqueeze(0).expand_as(txt_i)
+        local = (txt_i >= 0) & (txt_i < txt_emb.size(0))
+        candidate_mask[txt_i[local], img_j[local]] = True
+    candidates = [row.nonzero().squeeze(1).tolist() for row in candidate_mask]
+    return score_matrix, candidates
+
+
+@torch.no_grad()
+def rerank_inference(model, eval_loader, k):
+    """ two-stage retrieval: the cross-encoder only scores the pairs
+    selected by the prefilter, the other ones get -inf
+
+    Returns:
+        score_matrix: reranked scores
+        prefilter_score: similarities of the first stage
+    """
+    assert k >= 10, "recall@10 needs at least 10 candidates"
+    dset = eval_loader.dataset
+    st = time()
+    prefilter_score, candidates = prefilter(model, dset, k)
+    dset.set_candidates(candidates)
+    n_pairs = sum(len(c) for c in candidates)
+    LOGGER.info(f"prefilter done in {int(time()-st)} seconds, "
+                f"{n_pairs} pairs to rerank "
+                f"({n_pairs / max(prefilter_score.numel(), 1)*100:.2f}%)")
+
+    model.eval()
+    if hvd.rank() == 0:
+        pbar = tqdm(total=len(eval_loader))
+    else:
+        pbar = NoOp()
+    score_matrix = torch.full(prefilter_score.size(), float('-inf'),
+                              device=torch.device("cuda"),
+                              dtype=torch.float16)
+    for i, mini_batches in enumerate(eval_loader):
+        for batch in mini_batches:
+            scores = model(batch, compute_loss=False)
+            score_matrix.data[i, batch['img_js']] = scores.data.squeeze(1
+                                                                   ).half()
+        pbar.update(1)
+    model.train()
+    pbar.close()
+    return score_matrix, prefilter_score.half()
+
+
+def _to_cuda(batch):
+    return {k: v.cuda(non_blocking=True) for k, v in batch.items()}
@@ -0,0 +1,317 @@
+"""
+CIDEr-D and BLEU of token id sequences, for the self-critical rewards.
+
+They give the scores of pyciderevalcap's CiderD and pycocoevalcap's Bleu on
+the space-joined token ids (see rewards.array_to_str), without building and
+re-tokenizing the strings: the n-grams of a sequence are packed into int64
+codes and counted with numpy, all the hypotheses of a batch are matched
+against their references at once, and the n-gram statistics of the
+references are cached per image.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import misc.utils as utils
+
+# the token ids are packed _BITS bits at a time, so that a 4-gram fits in an
+# int64
+_BITS = 15
+
+
+def as_matrix(seqs):
+    """
+    The zero padded num_seqs x max_length int64 matrix of a list of
+    sequences (or a 2D array), and their lengths: the tokens up to the first
+    0 (<eos>) included, as array_to_str.
+    """
+    if isinstance(seqs, np.ndarray) and seqs.ndim == 2:
+        matrix = seqs.astype(np.int64)
+    else:
+        seqs = [np.asarray(_, dtype=np.int64).reshape(-1) for _ in seqs]
+        matrix = np.zeros((len(seqs), max([len(_) for _ in seqs] + [0])), dtype=np.int64)
+        for i, seq in enumerate(seqs):
+            matrix[i, :len(seq)] = seq
+    assert matrix.size == 0 or (matrix.min() >= 0 and matrix.max() < (1 << _BITS)), \
+        'token ids must be in [0, %d)' % (1 << _BITS)
+    is_end = matrix == 0
+    if matrix.shape[1] == 0:
+        return matrix, np.zeros(len(matrix), dtype=np.int64)
+    lengths = np.where(is_end.any(1), is_end.argmax(1) + 1, matrix.shape[1])
+    if not isinstance(seqs, np.ndarray):
+        # the padding of shorter sequences is not an <eos>
+        lengths = np.minimum(lengths, [len(_) for _ in seqs])
+    return matrix, lengths
+
+
+def ngram_codes(seq, k):
+    # codes of the k-grams of seq, in order
+    num = len(seq) - k + 1
+    if num <= 0:
+        return np.zeros(0, dtype=np.int64)
+    codes = seq[:num].copy()
+    for i in range(1, k):
+        codes = (codes << _BITS) | seq[i:i + num]
+    return codes
+
+
+def count_ngrams(matrix, lengths, n):
+    """
+    Counts the n-grams of sequences given by as_matrix. Returns, for every
+    order k, the (sequence index, code, count) arrays of the distinct k-grams
+    of every sequence.
+    """
+    counts = []
+    for k in range(1, n + 1):
+        num = max(matrix.shape[1] - k + 1, 0)
+        codes = matrix[:, :num]
+        for i in range(1, k):
+            codes = (codes << _BITS) | matrix[:, i:i + num]
+        # the k-grams within the length of every sequence
+        valid = np.arange(num)[None] + k <= lengths[:, None]
+        seq_ix = np.nonzero(valid)[0]
+        codes = codes[valid]
+        # distinct (sequence, code) pairs
+        order = np.lexsort((codes, seq_ix))
+        seq_ix, codes = seq_ix[order], codes[order]
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = (seq_ix[1:] != seq_ix[:-1]) | (codes[1:] != codes[:-1])
+        start = np.flatnonzero(first)
+        counts.append((seq_ix[start], codes[start], np.diff(np.append(start, len(codes)))))
+    return counts
+
+
+def lookup(query_group, query_codes, group, codes, values):
+    """
+    The values of the (query_group, query_codes) n-grams in the table of
+    distinct (group, codes) n-grams, 0 for the missing ones.
+    """
+    out = np.zeros(len(query_codes), dtype=values.dtype)
+    if len(codes) == 0 or len(query_codes) == 0:
+        return out
+    # the codes are renumbered densely so that (group, code) fits in an int64
+    uniq, inv = np.unique(np.concatenate([query_codes, codes]), return_inverse=True)
+    inv = inv.reshape(-1)
+    keys = group * len(uniq) + inv[len(query_codes):]
+    query = query_group * len(uniq) + inv[:len(query_codes)]
+    order = np.argsort(keys)
+    keys, values = keys[order], values[order]
+    ix = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    found = keys[ix] == query
+    out[found] = values[ix[found]]
+    return out
+
+
+class _RefCache(object):
+    # LRU cache of the statistics of the references of an image, keyed by
+    # their labels
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def get(self, refs, cook):
+        refs = np.asarray(refs)
+        if self.cache_size <= 0 or refs.dtype == object:
+            return cook(refs)
+        key = (refs.shape, refs.dtype.str, refs.tobytes())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        item = self._cache[key] = cook(refs)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return item
+
+
+def _concat_images(images, used, k):
+    # the (image, code, value) n-grams of order k of the used images
+    return [np.concatenate([np.full(len(images[i][k][0]), i, dtype=np.int64) for i in used]),
+            np.concatenate([images[i][k][0] for i in used]),
+            np.concatenate([images[i][k][1] for i in used])]
+
+
+class CiderD(object):
+    """
+    CIDEr-D of token id sequences.
+
+    Parameters
+    ----------
+    n : int
+        Maximum n-gram order.
+    sigma : float
+        Standard deviation of the Gaussian length penalty.
+    df : str
+        'corpus' to compute the document frequencies from the references of
+        every call, otherwise the name of the pickle written by
+        scripts/prepro_ngrams.py (data/<df>.p, the -idxs one).
+    cache_size : int
+        Number of images whose reference vectors are cached (0 disables it).
+    """
+    def __init__(self, n=4, sigma=6.0, df='corpus', cache_size=200000):
+        self.n = n
+        self.sigma = sigma
+        self.df_mode = df
+        self.cache = _RefCache(cache_size)
+        if df != 'corpus':
+            with open(os.path.join('data', df + '.p'), 'rb') as f:
+                pkl_file = utils.pickle_load(f)
+            self.ref_len = np.log(float(pkl_file['ref_len']))
+            # sorted codes and log document frequencies of every order
+            self.df = []
+            for k in range(1, n + 1):
+                ngrams = [(ngram, freq) for ngram, freq in pkl_file['document_frequency'].items()
+                          if len(ngram) == k]
+                codes = np.array([ngram_codes(np.array([int(w) for w in ngram], dtype=np.int64), k)[0]
+                                  for ngram, _ in ngrams], dtype=np.int64).reshape(-1)
+                log_df = np.log(np.maximum(1.0, np.array([freq for _, freq in ngrams], dtype=np.float64)))
+                self.df.append((codes, log_df))
+
+    def _cook(self, seqs, df, ref_len):
+        """
+        The tf-idf vectors of a list of sequences, as (sequence index, code,
+        value) arrays per order, their norms (num_seqs x n) and their lengths.
+        """
+        matrix, lengths = as_matrix(seqs)
+        vectors = []
+        norms = np.zeros((len(matrix), self.n))
+        for k, (seq_ix, codes, tf) in enumerate(count_ngrams(matrix, lengths, self.n)):
+            df_codes, log_df = df[k]
+            vec = tf * (ref_len - lookup(np.zeros_like(codes), codes, np.zeros_like(df_codes), df_codes, log_df))
+            norms[:, k] = np.sqrt(np.bincount(seq_ix, weights=vec ** 2, minlength=len(matrix)))
+            vectors.append((seq_ix, codes, vec))
+        # the length of CiderD is the number of bigrams
+        return vectors, norms, np.maximum(lengths - 1, 0).astype(np.float64)
+
+    def _corpus_df(self, gts, gts_index):
+        # as CiderD: one document per hypothesis, made of the references of
+        # its image
+        docs = np.bincount(gts_index, minlength=len(gts)).astype(np.float64)
+        counts = [count_ngrams(*as_matrix(refs), n=self.n) for refs in gts]
+        df = []
+        for k in range(self.n):
+            codes = [np.unique(c[k][1]) for c in counts]
+            keys, inv = np.unique(np.concatenate(codes), return_inverse=True)
+            freq = np.bincount(inv.reshape(-1), weights=np.repeat(docs, [len(_) for _ in codes]),
+                               minlength=len(keys))
+            df.append((keys, np.log(np.maximum(1.0, freq))))
+        return df, np.log(float(len(gts_index)))
+
+    def compute_score(self, gts, res, gts_index=None):
+        """
+        Parameters
+        ----------
+        gts : list
+            The reference token ids of every image (a list of sequences or
+            a 2D array of zero padded labels).
+        res : list
+            The token ids of the hypotheses (sequences or a 2D array).
+        gts_index : np.ndarray
+            The image of every hypothesis, defaults to one image each.
+
+        Returns the mean score and the score of every hypothesis.
+        """
+        num_hyps = len(res)
+        gts_index = np.arange(num_hyps) if gts_index is None else np.asarray(gts_index, dtype=np.int64)
+        used = sorted(set(gts_index.tolist()))
+        if self.df_mode == 'corpus':
+            df, ref_len = self._corpus_df(gts, gts_index)
+            refs = {i: self._cook(gts[i], df, ref_len) for i in used}
+        else:
+            df, ref_len = self.df, self.ref_len
+            refs = {i: self.cache.get(gts[i], lambda _: self._cook(_, df, ref_len)) for i in used}
+        hyp_vectors, hyp_norms, hyp_lengths = self._cook(res, df, ref_len)
+
+        # the references of the used images, numbered globally
+        num_refs = np.zeros(len(gts), dtype=np.int64)
+        num_refs[used] = [len(refs[i][2]) for i in used]
+        ref_start = np.cumsum(num_refs) - num_refs
+        ref_norms = np.concatenate([refs[i][1] for i in used])
+        ref_lengths = np.concatenate([refs[i][2] for i in used])
+
+        # every (hypothesis, reference of its image) pair, contiguous per
+        # hypothesis
+        pairs_per_hyp = num_refs[gts_index]
+        pair_hyp = np.repeat(np.arange(num_hyps), pairs_per_hyp)
+        pair_start = np.cumsum(pairs_per_hyp) - pairs_per_hyp
+        pair_ref = np.arange(len(pair_hyp)) - pair_start[pair_hyp] + ref_start[gts_index[pair_hyp]]
+
+        val = np.zeros((len(pair_hyp), self.n))
+        for k in range(self.n):
+            hyp_ix, hyp_codes, vec = hyp_vectors[k]
+            ref_ix = np.concatenate([refs[i][0][k][0] + ref_start[i] for i in used])
+            ref_codes = np.concatenate([refs[i][0][k][1] for i in used])
+            ref_vec = np.concatenate([refs[i][0][k][2] for i in used])
+            # every n-gram of a hypothesis against every reference of its image
+            reps = pairs_per_hyp[hyp_ix]
+            entry = np.repeat(np.arange(len(hyp_ix)), reps)
+            pair = pair_start[hyp_ix[entry]] + np.arange(len(entry)) - np.repeat(np.cumsum(reps) - reps, reps)
+            vec_ref = lookup(pair_ref[pair], hyp_codes[entry], ref_ix, ref_codes, ref_vec)
+            val[:, k] = np.bincount(pair, weights=np.minimum(vec[entry], vec_ref) * vec_ref,
+                                    minlength=len(pair_hyp))
+            norm = hyp_norms[pair_hyp, k] * ref_norms[pair_ref, k]
+            val[:, k] /= np.where(norm != 0, norm, 1)
+        delta = hyp_lengths[pair_hyp] - ref_lengths[pair_ref]
+        val *= np.exp(-(delta ** 2) / (2 * self.sigma ** 2))[:, None]
+
+        scores = np.bincount(pair_hyp, weights=val.mean(1), minlength=num_hyps)
+        scores = scores / pairs_per_hyp * 10.0
+        return np.mean(scores), scores
+
+
+class Bleu(object):
+    """
+    Sentence level BLEU of token id sequences, as the per-caption scores of
+    pycocoevalcap's Bleu (closest reference length).
+    """
+    def __init__(self, n=4, cache_size=200000):
+        self.n = n
+        self.cache = _RefCache(cache_size)
+
+    def _cook_refs(self, refs):
+        # the maximum count of every n-gram in the references and their lengths
+        matrix, lengths = as_matrix(refs)
+        max_counts = []
+        for _, codes, counts in count_ngrams(matrix, lengths, self.n):
+            keys, inv = np.unique(codes, return_inverse=True)
+            max_count = np.zeros(len(keys), dtype=np.int64)
+            np.maximum.at(max_count, inv.reshape(-1), counts)
+            max_counts.append((keys, max_count))
+        return max_counts, lengths
+
+    def compute_score(self, gts, res, gts_index=None):
+        """
+        Same arguments as CiderD.compute_score. Returns the mean and the
+        per-hypothesis BLEU-1 to BLEU-n, as lists over the orders.
+        """
+        tiny, small = 1e-15, 1e-9
+        num_hyps = len(res)
+        gts_index = np.arange(num_hyps) if gts_index is None else np.asarray(gts_index, dtype=np.int64)
+        used = sorted(set(gts_index.tolist()))
+        refs = {i: self.cache.get(gts[i], self._cook_refs) for i in used}
+        max_counts = {i: refs[i][0] for i in used}
+        hyps, test_lengths = as_matrix(res)
+
+        # the closest reference length, the shortest one on ties
+        lengths = [refs[i][1] for i in gts_index.tolist()]
+        diff = np.abs(np.concatenate(lengths) - np.repeat(test_lengths, [len(_) for _ in lengths]))
+        closest = diff * (1 << 20) + np.concatenate(lengths)
+        ref_lengths = np.minimum.reduceat(closest, np.cumsum([0] + [len(_) for _ in lengths])[:-1]) % (1 << 20)
+
+        scores = []
+        bleu = np.ones(num_hyps)
+        for k, (hyp_ix, codes, counts) in enumerate(count_ngrams(hyps, test_lengths, self.n)):
+            # clipped counts
+            max_count = lookup(gts_index[hyp_ix], codes, *_concat_images(max_counts, used, k))
+            correct = np.bincount(hyp_ix, weights=np.minimum(counts, max_count), minlength=num_hyps)
+            guess = np.maximum(0, test_lengths - k)
+            bleu = bleu * (correct + tiny) / (guess + small)
+            scores.append(bleu ** (1. / (k + 1)))
+        ratio = (test_lengths + tiny) / (ref_lengths + small)
+        brevity = np.where(ratio < 1, np.exp(1 - 1 / ratio), 1.0)
+        scores = [_ * brevity for _ in scores]
+        return [np.mean(_) for _ in scores], scores
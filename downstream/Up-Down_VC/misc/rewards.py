@@ -8,11 +8,8 @@ import misc.utils as utils
 from collections import OrderedDict
 import torch
 
-import sys
-sys.path.append("cider")
-from pyciderevalcap.ciderD.ciderD import CiderD
-sys.path.append("coco-caption")
-from pycocoevalcap.bleu.bleu import Bleu
+# scored on the token ids, see misc/ngram_scorer.py
+from misc.ngram_scorer import CiderD, Bleu
 
 CiderD_scorer = None
 Bleu_scorer = None
@@ -35,37 +32,30 @@ def array_to_str(arr):
 def get_self_critical_reward(greedy_res, data_gts, gen_result, opt):
     batch_size = gen_result.size(0)# batch_size = sample_size * seq_per_img
     seq_per_img = batch_size // len(data_gts)
+    # the greedy baseline is given once per image, or for every sample
+    greedy_per_img = greedy_res.size(0) // len(data_gts)
 
-    res = OrderedDict()
-    
     gen_result = gen_result.data.cpu().numpy()
     greedy_res = greedy_res.data.cpu().numpy()
-    for i in range(batch_size):
-        res[i] = [array_to_str(gen_result[i])]
-    for i in range(batch_size):
-        res[batch_size + i] = [array_to_str(greedy_res[i])]
+    # the sampled then the greedy captions, and the image of each
+    res = np.concatenate([gen_result, greedy_res])
+    gts_index = np.concatenate([np.arange(batch_size) // seq_per_img,
+                                np.arange(len(greedy_res)) // greedy_per_img])
 
-    gts = OrderedDict()
-    for i in range(len(data_gts)):
-        gts[i] = [array_to_str(data_gts[i][j]) for j in range(len(data_gts[i]))]
-
-    res_ = [{'image_id':i, 'caption': res[i]} for i in range(2 * batch_size)]
-    res__ = {i: res[i] for i in range(2 * batch_size)}
-    gts = {i: gts[i % batch_size // seq_per_img] for i in range(2 * batch_size)}
     if opt.cider_reward_weight > 0:
-        _, cider_scores = CiderD_scorer.compute_score(gts, res_)
+        _, cider_scores = CiderD_scorer.compute_score(data_gts, res, gts_index)
         print('Cider scores:', _)
     else:
         cider_scores = 0
     if opt.bleu_reward_weight > 0:
-        _, bleu_scores = Bleu_scorer.compute_score(gts, res__)
+        _, bleu_scores = Bleu_scorer.compute_score(data_gts, res, gts_index)
         bleu_scores = np.array(bleu_scores[3])
         print('Bleu scores:', _[3])
     else:
         bleu_scores = 0
     scores = opt.cider_reward_weight * cider_scores + opt.bleu_reward_weight * bleu_scores
 
-    scores = scores[:batch_size] - scores[batch_size:]
+    scores = scores[:batch_size] - np.repeat(scores[batch_size:], seq_per_img // greedy_per_img)
 
     rewards = np.repeat(scores[:, np.newaxis], gen_result.shape[1], 1)
 
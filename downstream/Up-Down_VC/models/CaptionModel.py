@@ -16,6 +16,8 @@ import torch.nn.functional as F
 from torch.autograd import *
 import misc.utils as utils
 
+from functools import reduce
+
 
 class CaptionModel(nn.Module):
     def __init__(self):
@@ -32,70 +34,56 @@ class CaptionModel(nn.Module):
         return getattr(self, '_'+mode)(*args, **kwargs)
 
     def beam_search(self, init_state, init_logprobs, *args, **kwargs):
+        # All the images of the batch are searched at once: init_state,
+        # init_logprobs and args hold batch_size * beam_size rows, the beams of
+        # an image being contiguous (see utils.repeat_tensors), and the states
+        # are reordered along their dimension 1. Returns the list of the final
+        # beams of every image.
 
         # function computes the similarity score to be augmented
-        def add_diversity(beam_seq_table, logprobsf, t, divm, diversity_lambda, bdash):
-            local_time = t - divm
+        def add_diversity(beam_seq_table, logprobsf, t, divm, diversity_lambda):
             unaug_logprobsf = logprobsf.clone()
-            for prev_choice in range(divm):
-                prev_decisions = beam_seq_table[prev_choice][local_time]
-                for sub_beam in range(bdash):
-                    for prev_labels in range(bdash):
-                        logprobsf[sub_beam][prev_decisions[prev_labels]] = logprobsf[sub_beam][prev_decisions[prev_labels]] - diversity_lambda
-            return unaug_logprobsf
+            if divm > 0:
+                # every word chosen by the previous groups at this step is
+                # penalized once per choice
+                prev_decisions = torch.cat([beam_seq_table[prev_choice][:, :, t] for prev_choice in range(divm)], 1)
+                counts = logprobsf.new_zeros(logprobsf.size(0), logprobsf.size(2))
+                counts.scatter_add_(1, prev_decisions, torch.ones_like(prev_decisions, dtype=counts.dtype))
+                logprobsf = logprobsf - diversity_lambda * counts.unsqueeze(1)
+            return logprobsf, unaug_logprobsf
 
         # does one step of classical beam search
 
-        def beam_step(logprobsf, unaug_logprobsf, beam_size, t, beam_seq, beam_seq_logprobs, beam_logprobs_sum, state):
+        def beam_step(logprobsf, unaug_logprobsf, beam_size, t, beam_seq, beam_seq_logprobs, beam_logprobs_sum):
             #INPUTS:
-            #logprobsf: probabilities augmented after diversity
+            #logprobsf: probabilities augmented after diversity, batch x beam x vocab
             #beam_size: obvious
             #t        : time instant
-            #beam_seq : tensor contanining the beams
+            #beam_seq : tensor contanining the beams, batch x beam x seq_length
             #beam_seq_logprobs: tensor contanining the beam logprobs
-            #beam_logprobs_sum: tensor contanining joint logprobs
+            #beam_logprobs_sum: tensor contanining joint logprobs, batch x beam
             #OUPUTS:
             #beam_seq : tensor containing the word indices of the decoded captions
             #beam_seq_logprobs : log-probability of each decision made, same size as beam_seq
             #beam_logprobs_sum : joint log-probability of each beam
+            #beam_ix : index of the previous beam of each beam, batch x beam
 
-            ys,ix = torch.sort(logprobsf,1,True)
-            candidates = []
-            cols = min(beam_size, ys.size(1))
-            rows = beam_size
+            batch_size, _, vocab_size = logprobsf.shape
+            candidate_logprobs = beam_logprobs_sum.unsqueeze(-1) + logprobsf
             if t == 0:
-                rows = 1
-            for c in range(cols): # for each column (word, essentially)
-                for q in range(rows): # for each beam expansion
-                    #compute logprob of expanding beam q with word in (sorted) position c
-                    local_logprob = ys[q,c].item()
-                    candidate_logprob = beam_logprobs_sum[q] + local_logprob
-                    local_unaug_logprob = unaug_logprobsf[q,ix[q,c]]
-                    candidates.append({'c':ix[q,c], 'q':q, 'p':candidate_logprob, 'r':local_unaug_logprob})
-            candidates = sorted(candidates,  key=lambda x: -x['p'])
-            
-            new_state = [_.clone() for _ in state]
-            #beam_seq_prev, beam_seq_logprobs_prev
-            if t >= 1:
-            #we''ll need these as reference when we fork beams around
-                beam_seq_prev = beam_seq[:t].clone()
-                beam_seq_logprobs_prev = beam_seq_logprobs[:t].clone()
-            for vix in range(beam_size):
-                v = candidates[vix]
-                #fork beam index q into index vix
-                if t >= 1:
-                    beam_seq[:t, vix] = beam_seq_prev[:, v['q']]
-                    beam_seq_logprobs[:t, vix] = beam_seq_logprobs_prev[:, v['q']]
-                #rearrange recurrent states
-                for state_ix in range(len(new_state)):
-                #  copy over state in previous beam q to new beam at vix
-                    new_state[state_ix][:, vix] = state[state_ix][:, v['q']] # dimension one is time step
-                #append new end terminal at the end of this beam
-                beam_seq[t, vix] = v['c'] # c'th word is the continuation
-                beam_seq_logprobs[t, vix] = v['r'] # the raw logprob here
-                beam_logprobs_sum[vix] = v['p'] # the new (sum) logprob along this beam
-            state = new_state
-            return beam_seq,beam_seq_logprobs,beam_logprobs_sum,state,candidates
+                # all the beams are the same at the first step
+                candidate_logprobs[:, 1:] = float('-inf')
+            beam_logprobs_sum, ix = candidate_logprobs.view(batch_size, -1).topk(beam_size, 1)
+            beam_ix = ix // vocab_size
+            words = ix % vocab_size
+
+            #fork the beams, the state is reordered by the caller
+            beam_seq = beam_seq.gather(1, beam_ix.unsqueeze(-1).expand_as(beam_seq)).clone()
+            beam_seq_logprobs = beam_seq_logprobs.gather(1, beam_ix.unsqueeze(-1).expand_as(beam_seq_logprobs)).clone()
+            #append new end terminal at the end of this beam
+            beam_seq[:, :, t] = words
+            beam_seq_logprobs[:, :, t] = unaug_logprobsf.view(batch_size, -1).gather(1, ix) # the raw logprob here
+            return beam_seq,beam_seq_logprobs,beam_logprobs_sum,beam_ix
 
         # Start diverse_beam_search
         opt = kwargs['opt']
@@ -107,83 +95,94 @@ class CaptionModel(nn.Module):
         remove_bad_endings = opt.get('remove_bad_endings', 0)
         length_penalty = utils.penalty_builder(opt.get('length_penalty', ''))
         bdash = beam_size // group_size # beam per group
+        batch_size = init_logprobs.size(0) // beam_size
+        device = init_logprobs.device
 
         # INITIALIZATIONS
-        beam_seq_table = [torch.LongTensor(self.seq_length, bdash).zero_() for _ in range(group_size)]
-        beam_seq_logprobs_table = [torch.FloatTensor(self.seq_length, bdash).zero_() for _ in range(group_size)]
-        beam_logprobs_sum_table = [torch.zeros(bdash) for _ in range(group_size)]
-
-        # logprobs # logprobs predicted in last time step, shape (beam_size, vocab_size+1)
-        done_beams_table = [[] for _ in range(group_size)]
-        # state_table = [list(torch.unbind(_)) for _ in torch.stack(init_state).chunk(group_size, 2)]
-        state_table = list(zip(*[_.chunk(group_size, 1) for _ in init_state]))
-        logprobs_table = list(init_logprobs.chunk(group_size, 0))
+        beam_seq_table = [torch.zeros(batch_size, bdash, self.seq_length, dtype=torch.long, device=device) for _ in range(group_size)]
+        beam_seq_logprobs_table = [torch.zeros(batch_size, bdash, self.seq_length, device=device) for _ in range(group_size)]
+        beam_logprobs_sum_table = [torch.zeros(batch_size, bdash, device=device) for _ in range(group_size)]
+        # offset of the first row of every group in the state
+        group_offset = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size
+        if remove_bad_endings:
+            bad_endings = torch.zeros(init_logprobs.size(1), dtype=torch.bool, device=device)
+            bad_endings[self.bad_endings_ix] = True
+
+        # logprobs # logprobs predicted in last time step, shape (batch_size * beam_size, vocab_size+1)
+        done_beams_table = [[[] for _ in range(group_size)] for _ in range(batch_size)]
+        state = list(init_state)
+        logprobs = init_logprobs
+        args = list(args)
         # END INIT
 
-        # Chunk elements in the args
-        args = list(args)
-        if self.__class__.__name__ == 'AttEnsemble':
-            args = [[_.chunk(group_size) if _ is not None else [None]*group_size for _ in args_] for args_ in args] # arg_name, model_name, group_name
-            args = [[[args[j][i][k] for i in range(len(self.models))] for j in range(len(args))] for k in range(group_size)] # group_name, arg_name, model_name
-        else:
-            args = [_.chunk(group_size) if _ is not None else [None]*group_size for _ in args]
-            args = [[args[i][j] for i in range(len(args))] for j in range(group_size)]
-
-        for t in range(self.seq_length + group_size - 1):
-            for divm in range(group_size): 
-                if t >= divm and t <= self.seq_length + divm - 1:
-                    # add diversity
-                    logprobsf = logprobs_table[divm].data.float()
-                    # suppress previous word
-                    if decoding_constraint and t-divm > 0:
-                        logprobsf.scatter_(1, beam_seq_table[divm][t-divm-1].unsqueeze(1).cuda(), float('-inf'))
-                    if remove_bad_endings and t-divm > 0:
-                        logprobsf[torch.from_numpy(np.isin(beam_seq_table[divm][t-divm-1].cpu().numpy(), self.bad_endings_ix).astype('uint8')), 0] = float('-inf')
-                    # suppress UNK tokens in the decoding
-                    logprobsf[:,logprobsf.size(1)-1] = logprobsf[:, logprobsf.size(1)-1] - 1000  
-                    # diversity is added here
-                    # the function directly modifies the logprobsf values and hence, we need to return
-                    # the unaugmented ones for sorting the candidates in the end. # for historical
-                    # reasons :-)
-                    unaug_logprobsf = add_diversity(beam_seq_table,logprobsf,t,divm,diversity_lambda,bdash)
-
-                    # infer new beams
-                    beam_seq_table[divm],\
-                    beam_seq_logprobs_table[divm],\
-                    beam_logprobs_sum_table[divm],\
-                    state_table[divm],\
-                    candidates_divm = beam_step(logprobsf,
-                                                unaug_logprobsf,
-                                                bdash,
-                                                t-divm,
-                                                beam_seq_table[divm],
-                                                beam_seq_logprobs_table[divm],
-                                                beam_logprobs_sum_table[divm],
-                                                state_table[divm])
-
-                    # if time's up... or if end token is reached then copy beams
-                    for vix in range(bdash):
-                        if beam_seq_table[divm][t-divm,vix] == 0 or t == self.seq_length + divm - 1:
-                            final_beam = {
-                                'seq': beam_seq_table[divm][:, vix].clone(), 
-                                'logps': beam_seq_logprobs_table[divm][:, vix].clone(),
-                                'unaug_p': beam_seq_logprobs_table[divm][:, vix].sum().item(),
-                                'p': beam_logprobs_sum_table[divm][vix].item()
-                            }
-                            final_beam['p'] = length_penalty(t-divm+1, final_beam['p'])
-                            done_beams_table[divm].append(final_beam)
-                            # don't continue beams from finished sequences
-                            beam_logprobs_sum_table[divm][vix] = -1000
-
-                    # move the current group one step forward in time
-                    
-                    it = beam_seq_table[divm][t-divm]
-                    logprobs_table[divm], state_table[divm] = self.get_logprobs_state(it.cuda(), *(args[divm] + [state_table[divm]]))
-                    logprobs_table[divm] = F.log_softmax(logprobs_table[divm] / temperature, dim=-1)
+        # The groups are searched one after the other at every time step, so
+        # that a group sees the words chosen by the previous ones at the same
+        # step, but the model is run once per step for all the groups.
+        for t in range(self.seq_length):
+            logprobs = logprobs.data.float().view(batch_size, group_size, bdash, -1)
+            state_ix = []
+            for divm in range(group_size):
+                logprobsf = logprobs[:, divm].clone()
+                # suppress previous word
+                if decoding_constraint and t > 0:
+                    logprobsf.scatter_(2, beam_seq_table[divm][:, :, t-1:t], float('-inf'))
+                if remove_bad_endings and t > 0:
+                    logprobsf[..., 0].masked_fill_(bad_endings[beam_seq_table[divm][:, :, t-1]], float('-inf'))
+                # suppress UNK tokens in the decoding
+                logprobsf[..., -1] = logprobsf[..., -1] - 1000
+                # diversity is added here
+                # the unaugmented log-probabilities are the ones recorded
+                # in the beams, for historical reasons :-)
+                logprobsf, unaug_logprobsf = add_diversity(beam_seq_table,logprobsf,t,divm,diversity_lambda)
+
+                # infer new beams
+                beam_seq_table[divm],\
+                beam_seq_logprobs_table[divm],\
+                beam_logprobs_sum_table[divm],\
+                beam_ix = beam_step(logprobsf,
+                                    unaug_logprobsf,
+                                    bdash,
+                                    t,
+                                    beam_seq_table[divm],
+                                    beam_seq_logprobs_table[divm],
+                                    beam_logprobs_sum_table[divm])
+                state_ix.append(group_offset + divm * bdash + beam_ix)
+
+                # if time's up... or if end token is reached then copy beams
+                if t == self.seq_length - 1:
+                    is_end = torch.ones_like(beam_logprobs_sum_table[divm], dtype=torch.bool)
+                else:
+                    is_end = beam_seq_table[divm][:, :, t] == 0
+                done_ix = is_end.nonzero().tolist()
+                if done_ix:
+                    done_seq = beam_seq_table[divm][is_end].cpu()
+                    done_logps = beam_seq_logprobs_table[divm][is_end].cpu()
+                    done_p = beam_logprobs_sum_table[divm][is_end].tolist()
+                    for n, (k, vix) in enumerate(done_ix):
+                        final_beam = {
+                            'seq': done_seq[n],
+                            'logps': done_logps[n],
+                            'unaug_p': done_logps[n].sum().item(),
+                            'p': length_penalty(t+1, done_p[n])
+                        }
+                        done_beams_table[k][divm].append(final_beam)
+                    # don't continue beams from finished sequences
+                    beam_logprobs_sum_table[divm] = beam_logprobs_sum_table[divm].masked_fill(is_end, -1000)
+
+            if t == self.seq_length - 1:
+                break
+            # rearrange recurrent states, dimension one is the beam
+            state_ix = torch.cat(state_ix, 1).view(-1)
+            state = [_.index_select(1, state_ix) for _ in state]
+
+            # move all the groups one step forward in time
+            it = torch.cat([_[:, :, t] for _ in beam_seq_table], 1).view(-1)
+            logprobs, state = self.get_logprobs_state(it, *(args + [state]))
+            logprobs = F.log_softmax(logprobs / temperature, dim=-1)
 
         # all beams are sorted by their log-probabilities
-        done_beams_table = [sorted(done_beams_table[i], key=lambda x: -x['p'])[:bdash] for i in range(group_size)]
-        done_beams = reduce(lambda a,b:a+b, done_beams_table)
+        done_beams = [reduce(lambda a,b:a+b, [sorted(done_beams_k[i], key=lambda x: -x['p'])[:bdash] for i in range(group_size)])
+                      for done_beams_k in done_beams_table]
         return done_beams
 
 
@@ -14,6 +14,8 @@ def parse_opt():
                     help='path to the directory containing the preprocessed att feats')
     parser.add_argument('--input_box_dir', type=str, default='data/cocotalk_box',
                     help='path to the directory containing the boxes of att feats')
+    parser.add_argument('--input_att_store', type=str, default='',
+                    help='path to the att feats prebuilt by scripts/build_att_store.py (replaces the att, vc and box dirs)')
     parser.add_argument('--input_label_h5', type=str, default='data/coco_label.h5',
                     help='path to the h5file containing the preprocessed dataset')
     parser.add_argument('--start_from', type=str, default=None,
@@ -57,6 +59,8 @@ def parse_opt():
                     help='If use box features')
     parser.add_argument('--norm_box_feat', type=int, default=0,
                     help='If use box, do we normalize box feature')
+    parser.add_argument('--num_workers', type=int, default=4,
+                    help='number of dataloader workers loading and collating the batches of each split')
 
     # Optimization: General
     parser.add_argument('--max_epochs', type=int, default=-1,
@@ -220,6 +224,8 @@ def add_eval_options(parser):
                     help='path to the h5file containing the preprocessed dataset')
     parser.add_argument('--input_box_dir', type=str, default='',
                     help='path to the h5file containing the preprocessed dataset')
+    parser.add_argument('--input_att_store', type=str, default='',
+                    help='path to the att feats prebuilt by scripts/build_att_store.py')
     parser.add_argument('--input_label_h5', type=str, default='',
                     help='path to the h5file containing the preprocessed dataset')
     parser.add_argument('--input_json', type=str, default='', 
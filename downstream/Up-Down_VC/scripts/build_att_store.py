@@ -0,0 +1,105 @@
+"""
+Prebuild the attention features read by the DataLoader (--input_att_store).
+
+The bottom-up and VC features of every image are concatenated (and, with
+--use_box, augmented with the box features and sorted by box size) once,
+exactly as DataLoader.load_att_feat does, and written as one flat store per
+split, <output_dir>/<split>:
+
+features.bin: the rows of all the images, fp16 by default, memory-mapped by
+  the loader
+index.npy: an int64 (offset, count) row per image
+names.json: the image ids
+meta.json: the dtype, the feature size, the numbers of images and rows and
+  the feature options the store was built with
+
+Loading an image is then a single slice of features.bin.
+
+Usage (from the repository root):
+PYTHONPATH=. python scripts/build_att_store.py --input_json data/cocotalk.json \
+  --input_att_dir data/cocobu_att --input_att_dir_vc data/vc_feat \
+  --output_dir data/cocobu_vc_store
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import argparse
+import numpy as np
+
+from dataloader import DataLoader
+
+
+def build_split(loader, split, output_dir, dtype):
+  split_dir = os.path.join(output_dir, split)
+  if not os.path.isdir(split_dir):
+    os.makedirs(split_dir)
+
+  names = []
+  index = []
+  offset = 0
+  dim = 0
+  with open(os.path.join(split_dir, 'features.bin'), 'wb') as f:
+    for i, ix in enumerate(loader.split_ix[split]):
+      att_feat = loader.load_att_feat(ix).astype(dtype)
+      f.write(np.ascontiguousarray(att_feat).tobytes())
+      names.append(str(loader.info['images'][ix]['id']))
+      index.append((offset, att_feat.shape[0]))
+      offset += att_feat.shape[0]
+      dim = att_feat.shape[1]
+      if i % 1000 == 0:
+        print('%s: processing %d/%d (%.2f%% done)' % (split, i, len(loader.split_ix[split]), i*100.0/len(loader.split_ix[split])))
+
+  np.save(os.path.join(split_dir, 'index.npy'), np.array(index, dtype=np.int64).reshape(-1, 2))
+  with open(os.path.join(split_dir, 'names.json'), 'w') as f:
+    json.dump(names, f)
+  with open(os.path.join(split_dir, 'meta.json'), 'w') as f:
+    json.dump({'dtype': np.dtype(dtype).name, 'dim': dim, 'fields': {},
+               'num_images': len(names), 'num_boxes': offset,
+               'att_options': {'use_box': loader.use_box,
+                               'norm_att_feat': loader.norm_att_feat,
+                               'norm_box_feat': loader.norm_box_feat}}, f)
+  print('wrote %d images (%d rows) to %s' % (len(names), offset, split_dir))
+
+
+def main(params):
+  opt = argparse.Namespace(**params)
+  # only the image list and the feature loaders are needed
+  opt.input_label_h5 = 'none'
+  opt.input_fc_dir = ''
+  opt.seq_per_img = 1
+  opt.batch_size = 1
+  opt.num_workers = 0
+  loader = DataLoader(opt)
+
+  dtype = np.float16 if params['fp16'] else np.float32
+  for split in params['splits'].split(','):
+    build_split(loader, split, params['output_dir'], dtype)
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser()
+
+  # input json
+  parser.add_argument('--input_json', required=True, help='input json file, as given to the DataLoader')
+  parser.add_argument('--input_att_dir', required=True, help='directory (or lmdb / flat store) of the bottom-up att feats')
+  parser.add_argument('--input_att_dir_vc', required=True, help='directory (or lmdb / flat store) of the VC feats')
+  parser.add_argument('--input_box_dir', default='', help='directory of the boxes, needed with --use_box')
+  parser.add_argument('--output_dir', required=True, help='output directory, one store per split')
+
+  # options, as for training
+  parser.add_argument('--use_box', type=int, default=0, help='append the box features and sort the rows by box size')
+  parser.add_argument('--norm_att_feat', type=int, default=0, help='normalize the att feats')
+  parser.add_argument('--norm_box_feat', type=int, default=0, help='normalize the box feats')
+  parser.add_argument('--train_only', type=int, default=0, help='if true then restval is not in the train split')
+  parser.add_argument('--splits', default='train,val,test', help='comma separated splits to build')
+  parser.add_argument('--fp16', type=int, default=1, help='store the features in fp16')
+
+  args = parser.parse_args()
+  params = vars(args) # convert to ordinary dict
+  print('parsed input parameters:')
+  print(json.dumps(params, indent = 2))
+  main(params)
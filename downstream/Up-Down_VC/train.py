@@ -67,8 +67,7 @@ def train(opt):
     else:
         infos['iter'] = 0
         infos['epoch'] = 0
-        infos['iterators'] = loader.iterators
-        infos['split_ix'] = loader.split_ix
+        infos['loader_state_dict'] = loader.state_dict()
         infos['vocab'] = loader.get_vocab()
     infos['opt'] = opt
 
@@ -80,8 +79,12 @@ def train(opt):
     lr_history = histories.get('lr_history', {})
     ss_prob_history = histories.get('ss_prob_history', {})
 
-    loader.iterators = infos.get('iterators', loader.iterators)
-    loader.split_ix = infos.get('split_ix', loader.split_ix)
+    if 'loader_state_dict' in infos:
+        loader.load_state_dict(infos['loader_state_dict'])
+    elif 'iterators' in infos:
+        # infos of the old loader: the order and position of every split
+        loader.load_state_dict({split: {'order': infos['split_ix'][split], 'position': infos['iterators'][split]}
+                                for split in infos['iterators']})
     if opt.load_best_score == 1:
         best_val_score = infos.get('best_val_score', None)
 
@@ -209,8 +212,7 @@ def train(opt):
             # update infos
             infos['iter'] = iteration
             infos['epoch'] = epoch
-            infos['iterators'] = loader.iterators
-            infos['split_ix'] = loader.split_ix
+            infos['loader_state_dict'] = loader.state_dict()
             
             # make evaluation on validation set, and save model
             if (iteration % opt.save_checkpoint_every == 0):
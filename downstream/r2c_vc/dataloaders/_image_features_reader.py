@@ -1,5 +1,8 @@
 from typing import List
+from collections import OrderedDict
+import argparse
 import csv
+import os
 import h5py
 import numpy as np
 import copy
@@ -8,6 +11,50 @@ import lmdb # install lmdb by "pip install lmdb"
 import base64
 import pdb
 
+# records of the raw LMDB (see convert_to_raw_lmdb): image_h, image_w and
+# num_boxes as int32, then the float32 features and boxes
+_RAW_FORMAT_KEY = '__format__'.encode()
+_RAW_HEADER = np.dtype(np.int32).itemsize * 3
+
+
+def raw_lmdb_path(features_path: str) -> str:
+    return features_path.rstrip('/') + '_raw'
+
+
+def convert_to_raw_lmdb(src_path: str, dst_path: str = None, map_size: int = 1024 ** 4):
+    """
+    Converts the base64 / pickle LMDB of the pre-extracted features into an
+    LMDB of raw binary records, which ImageFeaturesH5Reader reads with
+    np.frombuffer on the mapped value, without decoding. The keys are kept.
+    By default it is written next to the source, where ImageFeaturesH5Reader
+    looks for it.
+    """
+    dst_path = dst_path or raw_lmdb_path(src_path)
+    src = lmdb.open(src_path, max_readers=1, readonly=True,
+                    lock=False, readahead=False, meminit=False)
+    dst = lmdb.open(dst_path, map_size=map_size)
+    with src.begin(write=False) as src_txn:
+        image_ids = pickle.loads(src_txn.get('keys'.encode()))
+        txn = dst.begin(write=True)
+        for i, image_id in enumerate(image_ids):
+            item = pickle.loads(src_txn.get(image_id))
+            num_boxes = int(item['num_boxes'])
+            header = np.array([int(item['image_h']), int(item['image_w']), num_boxes], dtype=np.int32)
+            features = base64.b64decode(item['features'])
+            boxes = base64.b64decode(item['boxes'])
+            assert len(features) == num_boxes * 2048 * 4 and len(boxes) == num_boxes * 4 * 4
+            txn.put(image_id, header.tobytes() + features + boxes)
+            if (i + 1) % 1000 == 0:
+                txn.commit()
+                txn = dst.begin(write=True)
+        txn.put('keys'.encode(), pickle.dumps(image_ids))
+        txn.put(_RAW_FORMAT_KEY, b'raw')
+        txn.commit()
+    dst.sync()
+    dst.close()
+    src.close()
+
+
 class ImageFeaturesH5Reader(object):
     """
     A reader for H5 files containing pre-extracted image features. A typical
@@ -31,136 +78,125 @@ class ImageFeaturesH5Reader(object):
         Whether to load the whole H5 file in memory. Beware, these files are
         sometimes tens of GBs in size. Set this to true if you have sufficient
         RAM - trade-off between speed and memory.
+    cache_size : int
+        Number of decoded images kept in a LRU cache when not in_memory
+        (0 disables it).
     """
-    def __init__(self, features_path: str, in_memory: bool = False):
+    def __init__(self, features_path: str, in_memory: bool = False, cache_size: int = 512):
         self.features_path = features_path
         self._in_memory = in_memory
+        self._cache_size = cache_size
 
         # with h5py.File(self.features_h5path, "r", libver='latest', swmr=True) as features_h5:
             # self._image_ids = list(features_h5["image_ids"])
             # If not loaded in memory, then list of None.
-        self.env = lmdb.open(self.features_path, max_readers=1, readonly=True,
+        # the raw copy written by convert_to_raw_lmdb is read instead when
+        # it exists (features_path still selects the VC features)
+        db_path = raw_lmdb_path(self.features_path)
+        if not os.path.exists(db_path):
+            db_path = self.features_path
+        self.env = lmdb.open(db_path, max_readers=1, readonly=True,
                             lock=False, readahead=False, meminit=False)
 
-        with self.env.begin(write=False) as txn: 
+        with self.env.begin(write=False) as txn:
             self._image_ids = pickle.loads(txn.get('keys'.encode()))
+            # LMDB written by convert_to_raw_lmdb
+            self._raw = txn.get(_RAW_FORMAT_KEY) == b'raw'
+        self._image_id_to_index = {image_id: index for index, image_id in enumerate(self._image_ids)}
+
+        # decoded (features, num_boxes, image_location, image_location_ori)
+        self._cache = OrderedDict()
 
-        self.features = [None] * len(self._image_ids)
-        self.num_boxes = [None] * len(self._image_ids)
-        self.boxes = [None] * len(self._image_ids)
-        self.boxes_ori = [None] * len(self._image_ids)
-    
     def __len__(self):
         return len(self._image_ids)
 
     def __getitem__(self, image_id):
         image_id = str(image_id).encode()
-        index = self._image_ids.index(image_id)
-        if self._in_memory:
-            # Load features during first epoch, all not loaded together as it
-            # has a slow start.
-            if self.features[index] is not None:
-                features = self.features[index]
-                num_boxes = self.num_boxes[index]
-                image_location = self.boxes[index]
-                image_location_ori = self.boxes_ori[index]
-            else:
-                with self.env.begin(write=False) as txn:
-                    item = pickle.loads(txn.get(image_id))
-                    image_id_ = item['image_id']
-                    image_h = int(item['image_h'])
-                    image_w = int(item['image_w'])
-                    num_boxes = int(item['num_boxes'])
-
-                    features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                    # if 'gt' not in self.features_path:
-                    #     features_vc = np.load('/data3/wangtan/vc/vilbert_beta/data/VCR/vcr_coco_xy/' + str(index) + '.npy')
-                    # else:
-                    #     features_vc = np.load('/data3/wangtan/vc/vilbert_beta/data/VCR/vcr_coco_xy_gt/' + str(index) + '.npy')
-                    # assert features_vc.shape[0] == features.shape[0]
-
-                    boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                    
-                    g_feat = np.sum(features, axis=0) / num_boxes
-                    # g_feat_vc = np.sum(features_vc, axis=0) / num_boxes
-
-                    num_boxes = num_boxes + 1
-
-                    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                    # features_vc = np.concatenate([np.expand_dims(g_feat_vc, axis=0), features_vc], axis=0)
-                    # features = np.concatenate([features, features_vc], axis=1)
-
-                    self.features[index] = features
-
-                    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                    image_location[:,:4] = boxes
-                    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                    image_location_ori = copy.deepcopy(image_location)
-
-                    image_location[:,0] = image_location[:,0] / float(image_w)
-                    image_location[:,1] = image_location[:,1] / float(image_h)
-                    image_location[:,2] = image_location[:,2] / float(image_w)
-                    image_location[:,3] = image_location[:,3] / float(image_h)
-
-                    g_location = np.array([0,0,1,1,1])
-                    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-                    self.boxes[index] = image_location
-
-                    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-                    self.boxes_ori[index] = image_location_ori
-                    self.num_boxes[index] = num_boxes               
+        if image_id not in self._image_id_to_index:
+            raise KeyError(image_id)
+        if image_id in self._cache:
+            self._cache.move_to_end(image_id)
+            item = self._cache[image_id]
         else:
-            # Read chunk from file everytime if not loaded in memory.    
-            with self.env.begin(write=False) as txn:
-                item = pickle.loads(txn.get(image_id))
-                image_id_ = item['image_id']
-                image_h = int(item['image_h'])
-                image_w = int(item['image_w'])
-                num_boxes = int(item['num_boxes'])
-
-                features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                g_feat = np.sum(features, axis=0) / num_boxes
-
-                if self.features_path == '/gruntdata3/wangtan/vcr/vilbert/vilbert_beta/data/VCR/VCR_resnet101_faster_rcnn_genome.lmdb':
-                    # features_vc = np.load('/gruntdata3/wangtan/vcr/r2c/r2c/data/vcr_coco_xy/' + image_id.decode() + '.npy')
-                    features_vc = np.load('/gruntdata3/wangtan/coco/new_feature/vcr_vc_xy_openimage/' + image_id.decode() + '.npy')
-                else:
-                    # features_vc = np.load('/gruntdata3/wangtan/vcr/r2c/r2c/data/vcr_coco_xy_gt/' + image_id.decode() + '.npy')
-                    features_vc = np.load('/gruntdata3/wangtan/coco/new_feature/vcr_vc_xy_openimage_gt/' + image_id.decode() + '.npy')
-                try:
-                    assert features_vc.shape[0] == features.shape[0]
-                except:
-                    print('error')
-                g_feat_vc = np.sum(features_vc, axis=0) / num_boxes
-
-
-                num_boxes = num_boxes + 1
-                features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                features_vc = np.concatenate([np.expand_dims(g_feat_vc, axis=0), features_vc], axis=0)
-                features = np.concatenate([features, features_vc], axis=1)
-
-
-                image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                image_location[:,:4] = boxes
-                image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                image_location_ori = copy.deepcopy(image_location)
-                image_location[:,0] = image_location[:,0] / float(image_w)
-                image_location[:,1] = image_location[:,1] / float(image_h)
-                image_location[:,2] = image_location[:,2] / float(image_w)
-                image_location[:,3] = image_location[:,3] / float(image_h)
-
-                g_location = np.array([0,0,1,1,1])
-                image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-
-                g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
+            item = self._load(image_id)
+            if self._in_memory or self._cache_size > 0:
+                self._cache[image_id] = item
+                if not self._in_memory and len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        features, num_boxes, image_location, image_location_ori = item
+        # the callers modify the returned arrays in place
+        return features.copy(), num_boxes, image_location.copy(), image_location_ori.copy()
+
+    def _decode(self, value):
+        if self._raw:
+            image_h, image_w, num_boxes = np.frombuffer(value, dtype=np.int32, count=3).tolist()
+            features = np.frombuffer(value, dtype=np.float32, count=num_boxes * 2048,
+                                     offset=_RAW_HEADER).reshape(num_boxes, 2048)
+            boxes = np.frombuffer(value, dtype=np.float32, count=num_boxes * 4,
+                                  offset=_RAW_HEADER + num_boxes * 2048 * 4).reshape(num_boxes, 4)
+            return image_h, image_w, num_boxes, features, boxes
+        item = pickle.loads(value)
+        image_h = int(item['image_h'])
+        image_w = int(item['image_w'])
+        num_boxes = int(item['num_boxes'])
+
+        features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
+        boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
+        return image_h, image_w, num_boxes, features, boxes
+
+    def _load(self, image_id):
+        # the raw values are read in place, they are only valid inside the
+        # transaction (the arrays below are copies)
+        with self.env.begin(write=False, buffers=self._raw) as txn:
+            return self._process(image_id, *self._decode(txn.get(image_id)))
+
+    def _process(self, image_id, image_h, image_w, num_boxes, features, boxes):
+        g_feat = np.sum(features, axis=0) / num_boxes
+
+        if self.features_path == '/gruntdata3/wangtan/vcr/vilbert/vilbert_beta/data/VCR/VCR_resnet101_faster_rcnn_genome.lmdb':
+            # features_vc = np.load('/gruntdata3/wangtan/vcr/r2c/r2c/data/vcr_coco_xy/' + image_id.decode() + '.npy')
+            features_vc = np.load('/gruntdata3/wangtan/coco/new_feature/vcr_vc_xy_openimage/' + image_id.decode() + '.npy')
+        else:
+            # features_vc = np.load('/gruntdata3/wangtan/vcr/r2c/r2c/data/vcr_coco_xy_gt/' + image_id.decode() + '.npy')
+            features_vc = np.load('/gruntdata3/wangtan/coco/new_feature/vcr_vc_xy_openimage_gt/' + image_id.decode() + '.npy')
+        try:
+            assert features_vc.shape[0] == features.shape[0]
+        except:
+            print('error')
+        g_feat_vc = np.sum(features_vc, axis=0) / num_boxes
+
+
+        num_boxes = num_boxes + 1
+        features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
+        features_vc = np.concatenate([np.expand_dims(g_feat_vc, axis=0), features_vc], axis=0)
+        features = np.concatenate([features, features_vc], axis=1)
+
+
+        image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
+        image_location[:,:4] = boxes
+        image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
+
+        image_location_ori = copy.deepcopy(image_location)
+        image_location[:,0] = image_location[:,0] / float(image_w)
+        image_location[:,1] = image_location[:,1] / float(image_h)
+        image_location[:,2] = image_location[:,2] / float(image_w)
+        image_location[:,3] = image_location[:,3] / float(image_h)
+
+        g_location = np.array([0,0,1,1,1])
+        image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
+
+        g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
+        image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
 
         return features, num_boxes, image_location, image_location_ori
 
     def keys(self) -> List[int]:
         return self._image_ids
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a feature LMDB to raw records')
+    parser.add_argument('src', help='base64 / pickle feature LMDB')
+    parser.add_argument('dst', nargs='?', default=None, help='defaults to <src>_raw')
+    args = parser.parse_args()
+    convert_to_raw_lmdb(args.src, args.dst)
@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+import unittest
+import copy
+import os
+import torch
+from vc_rcnn.config import cfg as g_cfg
+from vc_rcnn.structures.bounding_box import BoxList
+from vc_rcnn.modeling.roi_heads.box_head.roi_box_predictors import CausalPredictor
+from vc_rcnn.modeling.roi_heads.box_head.loss import FastRCNNLossComputation
+
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools")
+
+
+def _make_proposals(box_counts, num_classes):
+    proposals = []
+    for count in box_counts:
+        boxes = BoxList(torch.rand(count, 4) * 100, (200, 200))
+        boxes.add_field("labels", torch.randint(0, num_classes, (count,)))
+        proposals.append(boxes)
+    return proposals
+
+
+class TestCausalPredictor(unittest.TestCase):
+    def test_factorized_score_matches_pairwise(self):
+        ''' Make sure the factorized causal score gives the pairwise logits and loss '''
+        cfg = copy.deepcopy(g_cfg)
+        cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES = 81
+        cfg.DIC_FILE = os.path.join(TOOLS_DIR, "dic_coco.npy")
+        cfg.PRIOR_PROB = os.path.join(TOOLS_DIR, "stat_prob.npy")
+        predictor = CausalPredictor(cfg, 1024).double()
+        predictor.dic = predictor.dic.double()
+        predictor.prior = predictor.prior.double()
+        torch.nn.init.normal_(predictor.causal_score.weight, std=0.1)
+        torch.nn.init.normal_(predictor.causal_score.bias, std=0.1)
+
+        proposals = _make_proposals([5, 7], 81)
+        x = torch.rand(12, 1024, dtype=torch.float64)
+        loss_evaluator = FastRCNNLossComputation(None, None, None)
+        class_logits = [torch.rand(12, 81, dtype=torch.float64)]
+
+        predictor.score_mode = "pairwise"
+        pairwise = predictor(x, proposals)
+        _, pairwise_loss = loss_evaluator(class_logits, pairwise, proposals)
+
+        predictor.score_mode = "factorized"
+        factorized = predictor(x, proposals)
+        _, factorized_loss = loss_evaluator(class_logits, factorized, proposals)
+
+        for pair_logits, (y_logits, z_logits) in zip(pairwise, factorized):
+            logits = (y_logits.unsqueeze(1) + z_logits.unsqueeze(0)).view(-1, 81)
+            self.assertTrue(torch.allclose(pair_logits, logits))
+        self.assertTrue(torch.allclose(pairwise_loss, factorized_loss))
+
+    def test_matmul_intervention_matches_dense(self):
+        ''' Make sure the matmul intervention gives the dense z, and top-k with every entry too '''
+        cfg = copy.deepcopy(g_cfg)
+        cfg.MODEL.ROI_BOX_HEAD.NUM_CLASSES = 81
+        cfg.DIC_FILE = os.path.join(TOOLS_DIR, "dic_coco.npy")
+        cfg.PRIOR_PROB = os.path.join(TOOLS_DIR, "stat_prob.npy")
+        predictor = CausalPredictor(cfg, 1024).double()
+        dic_z = predictor.dic.double()
+        prior = predictor.prior.double()
+        y = torch.rand(6, 1024, dtype=torch.float64)
+
+        predictor.intervention_mode = "dense"
+        dense = predictor.intervention(y, dic_z, prior)
+        predictor.intervention_mode = "matmul"
+        self.assertTrue(torch.allclose(dense, predictor.intervention(y, dic_z, prior)))
+        predictor.intervention_mode = "topk"
+        predictor.intervention_topk = dic_z.size(0)
+        self.assertTrue(torch.allclose(dense, predictor.intervention(y, dic_z, prior)))
+
+        # with k = 1 every object takes the prior-weighted entry it attends to most
+        predictor.intervention_topk = 1
+        attention = torch.mm(predictor.Wy(y), predictor.Wz(dic_z).t())
+        best = attention.argmax(dim=1)
+        expected = prior[best].unsqueeze(1) * dic_z[best]
+        self.assertTrue(torch.allclose(expected, predictor.intervention(y, dic_z, prior)))
+
+
+if __name__ == "__main__":
+    unittest.main()
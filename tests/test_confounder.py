@@ -0,0 +1,74 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+from vc_rcnn.structures.bounding_box import BoxList
+from vc_rcnn.engine.confounder import ConfounderStatistics
+from vc_rcnn.tools import merge_confounder
+
+
+def _make_prediction(num_boxes, num_classes, feature_dim):
+    boxes = BoxList(torch.rand(num_boxes, 4) * 100, (200, 200))
+    boxes.add_field("labels", torch.randint(0, num_classes, (num_boxes,)))
+    boxes.add_field("features", torch.rand(num_boxes, feature_dim))
+    return boxes
+
+
+class TestConfounderStatistics(unittest.TestCase):
+    def test_matches_per_object_accumulation(self):
+        num_classes, feature_dim = 11, 8
+        batches = [
+            [_make_prediction(n, num_classes, feature_dim) for n in sizes]
+            for sizes in ([3, 5], [0, 4], [6])
+        ]
+
+        stats = ConfounderStatistics(num_classes, feature_dim)
+        for predictions in batches:
+            stats.update(predictions)
+        dictionary, prior = stats.compute()
+
+        expected_dictionary = np.zeros((num_classes, feature_dim))
+        counter = np.zeros(num_classes)
+        for predictions in batches:
+            for p in predictions:
+                for label, feature in zip(p.get_field("labels"), p.get_field("features")):
+                    expected_dictionary[label] += feature.numpy()
+                    counter[label] += 1
+        expected_prior = counter / np.sum(counter)
+        counter = np.where(counter == 0, 1e-6, counter)
+        expected_dictionary = expected_dictionary / counter[:, np.newaxis]
+
+        np.testing.assert_allclose(dictionary, expected_dictionary, rtol=1e-6)
+        np.testing.assert_allclose(prior, expected_prior)
+
+    def test_merge_job_checkpoints(self):
+        ''' Make sure merging the checkpoints of the jobs gives the statistics of one job '''
+        num_classes, feature_dim = 11, 8
+        predictions = [_make_prediction(n, num_classes, feature_dim) for n in [3, 5, 4, 6]]
+        stats = ConfounderStatistics(num_classes, feature_dim)
+        stats.update(predictions, indices=[0, 1, 2, 3])
+        dictionary, prior = stats.compute()
+
+        tmp = tempfile.mkdtemp()
+        try:
+            for job_id, indices in enumerate([[0, 2], [1], [3]]):
+                job_stats = ConfounderStatistics(num_classes, feature_dim)
+                job_stats.update([predictions[i] for i in indices], indices=indices)
+                torch.save(job_stats.state_dict(), os.path.join(
+                    tmp, "confounder_coco_job{}_rank0.pth".format(job_id)))
+            dic_file = os.path.join(tmp, "dic.npy")
+            prior_file = os.path.join(tmp, "prior.npy")
+            merge_confounder.main([os.path.join(tmp, "confounder_coco_job*_rank*.pth"),
+                                   "--dic-file", dic_file, "--prior-file", prior_file])
+            np.testing.assert_allclose(np.load(dic_file), dictionary, rtol=1e-6)
+            np.testing.assert_allclose(np.load(prior_file), prior)
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    unittest.main()
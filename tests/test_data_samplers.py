@@ -10,6 +10,7 @@ from torch.utils.data.sampler import RandomSampler
 
 from vc_rcnn.data.samplers import GroupedBatchSampler
 from vc_rcnn.data.samplers import IterationBasedBatchSampler
+from vc_rcnn.data.samplers import ShardedSampler
 
 
 class SubsetSampler(Sampler):
@@ -149,5 +150,21 @@ class TestIterationBasedBatchSampler(unittest.TestCase):
                         self.assertEqual(batch, expected)
 
 
+class TestShardedSampler(unittest.TestCase):
+    def test_shards_cover_dataset_once(self):
+        for num_samples in [0, 1, 10, 17]:
+            for num_shards in [1, 3, 8]:
+                indices = []
+                for shard_id in range(num_shards):
+                    indices.extend(list(ShardedSampler(num_samples, num_shards, shard_id)))
+                self.assertEqual(sorted(indices), list(range(num_samples)))
+
+    def test_skip(self):
+        skip = [0, 3, 4, 9]
+        sampler = ShardedSampler(10, 2, 1, skip=skip)
+        self.assertEqual(list(sampler), [1, 5, 7])
+        self.assertEqual(len(sampler), 3)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,111 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from vc_rcnn.tools import featstore
+
+
+class TestFeatstore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "npy")
+        os.makedirs(self.src)
+        rng = np.random.RandomState(0)
+        self.features = {}
+        for i, num_boxes in enumerate([3, 10, 1, 7]):
+            name = "img_{}".format(i)
+            self.features[name] = rng.rand(num_boxes, 16).astype(np.float32)
+            np.save(os.path.join(self.src, name + ".npy"), self.features[name])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _check(self, path, atol=1e-6):
+        reader = featstore.open_reader(path)
+        self.assertEqual(sorted(reader.keys()), sorted(self.features.keys()))
+        for name, expected in self.features.items():
+            np.testing.assert_allclose(
+                np.asarray(reader[name]["features"], dtype=np.float32), expected, atol=atol)
+        reader.close()
+        self.assertEqual(featstore.verify(path, against=self.src, atol=atol), [])
+
+    def test_convert_round_trip(self):
+        hdf5 = os.path.join(self.tmp, "features.hdf5")
+        lmdb = os.path.join(self.tmp, "lmdb")
+        flat = os.path.join(self.tmp, "flat")
+        featstore.main(["convert", self.src, hdf5, "--dst-format", "hdf5",
+                        "--compression", "gzip", "--workers", "2"])
+        self._check(hdf5)
+        featstore.main(["convert", hdf5, lmdb, "--dst-format", "lmdb", "--workers", "0"])
+        self._check(lmdb)
+        featstore.main(["convert", lmdb, flat, "--dst-format", "flat", "--workers", "0"])
+        self.assertEqual(featstore.detect_format(flat), "flat")
+        self._check(flat)
+
+    def test_merge_fp16(self):
+        names = sorted(self.features.keys())
+        shards = []
+        for i, shard_names in enumerate([names[:2], names[1:]]):
+            shard = os.path.join(self.tmp, "shard_{}.hdf5".format(i))
+            writer = featstore.HDF5Writer(shard)
+            for name in shard_names:
+                writer.write(name, {"features": self.features[name]})
+            writer.close()
+            shards.append(shard)
+        merged = os.path.join(self.tmp, "merged")
+        featstore.main(["merge"] + shards + [merged, "--dst-format", "flat",
+                                              "--fp16", "--workers", "0"])
+        self.assertEqual(featstore.FlatReader(merged).features.dtype, np.float16)
+        self._check(merged, atol=1e-3)
+
+    def test_flat_per_box_fields(self):
+        flat = os.path.join(self.tmp, "flat")
+        writer = featstore.FlatWriter(flat)
+        norm_bb = {}
+        for name, features in sorted(self.features.items()):
+            norm_bb[name] = np.random.rand(features.shape[0], 7).astype(np.float32)
+            writer.write(name, {"features": features.astype(np.float16),
+                                "norm_bb": norm_bb[name], "img_h": np.array(480)})
+        writer.close()
+        reader = featstore.FlatReader(flat)
+        for name, expected in self.features.items():
+            record = reader[name]
+            self.assertEqual(sorted(record.keys()), ["features", "norm_bb"])
+            self.assertIsInstance(record["features"], np.memmap)
+            np.testing.assert_allclose(record["features"], expected, atol=1e-3)
+            np.testing.assert_array_equal(record["norm_bb"], norm_bb[name])
+
+    def test_convert_feat_npz(self):
+        ''' the att npz of the captioning models store the features as "feat" '''
+        att = os.path.join(self.tmp, "att")
+        os.makedirs(att)
+        for name, features in self.features.items():
+            np.savez(os.path.join(att, name + ".npz"), feat=features)
+        flat = os.path.join(self.tmp, "flat")
+        featstore.main(["convert", att, flat, "--dst-format", "flat", "--workers", "0"])
+        self._check(flat)
+
+        renamed = os.path.join(self.tmp, "renamed")
+        os.makedirs(renamed)
+        for name, features in self.features.items():
+            np.savez(os.path.join(renamed, name + ".npz"), box_feat=features)
+        flat = os.path.join(self.tmp, "flat_renamed")
+        featstore.main(["convert", renamed, flat, "--dst-format", "flat", "--workers", "0",
+                        "--feature-key", "box_feat"])
+        self._check(flat)
+
+    def test_verify_reports_mismatch(self):
+        flat = os.path.join(self.tmp, "flat")
+        featstore.main(["convert", self.src, flat, "--dst-format", "flat", "--workers", "0"])
+        np.save(os.path.join(self.src, "img_0.npy"), np.zeros((3, 16), dtype=np.float32))
+        errors = featstore.verify(flat, against=self.src)
+        self.assertEqual(len(errors), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
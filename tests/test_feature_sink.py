@@ -0,0 +1,68 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+
+import shutil
+import tempfile
+import threading
+import unittest
+
+import torch
+
+from vc_rcnn.engine.feature_sink import NpyFeatureSink
+
+
+class _FailingFinalizeSink(NpyFeatureSink):
+    def _finalize(self):
+        raise IOError("disk full")
+
+
+class _FailingWriteSink(NpyFeatureSink):
+    def write_chunk(self, chunk):
+        raise IOError("permission denied")
+
+
+class TestFeatureSink(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _close_raises(self, sink):
+        ''' close() must re-raise the error of the writer thread, not hang '''
+        errors = []
+
+        def close():
+            try:
+                sink.close()
+            except IOError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=close, daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive(), "close() hangs")
+        self.assertEqual(len(errors), 1)
+
+    def test_close_raises_finalize_error(self):
+        sink = _FailingFinalizeSink(self.tmp, rank=0)
+        sink.put("img_0", torch.rand(3, 4))
+        self._close_raises(sink)
+
+    def test_close_raises_last_chunk_error(self):
+        sink = _FailingWriteSink(self.tmp, chunk_size=16, rank=0)
+        for i in range(3):
+            sink.put("img_{}".format(i), torch.rand(3, 4))
+        self._close_raises(sink)
+
+    def test_close_raises_mid_stream_error(self):
+        sink = _FailingWriteSink(self.tmp, chunk_size=1, queue_size=2, rank=0)
+        for i in range(8):
+            try:
+                sink.put("img_{}".format(i), torch.rand(3, 4))
+            except IOError:
+                break
+        self._close_raises(sink)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,7 +9,8 @@ import os
 
 import torch
 from vc_rcnn.config import cfg
-from vc_rcnn.data import make_data_loader
+from vc_rcnn.data import make_data_loader, make_test_datasets
+from vc_rcnn.engine.extraction import extract_features
 from vc_rcnn.engine.inference import inference
 from vc_rcnn.modeling.detector import build_detection_model
 from vc_rcnn.utils.checkpoint import DetectronCheckpointer
@@ -94,6 +95,13 @@ def main():
             output_folder = os.path.join(cfg.OUTPUT_DIR, "inference", dataset_name)
             mkdir(output_folder)
             output_folders[idx] = output_folder
+    if cfg.TEST.EXTRACTION.ENABLED:
+        datasets = make_test_datasets(cfg)
+        for dataset_name, dataset in zip(dataset_names, datasets):
+            extract_features(cfg, model, dataset, dataset_name, device=cfg.MODEL.DEVICE)
+            synchronize()
+        return
+
     data_loaders_val = make_data_loader(cfg, is_train=False, is_distributed=distributed)
     for output_folder, dataset_name, data_loader_val in zip(output_folders, dataset_names, data_loaders_val):
         inference(
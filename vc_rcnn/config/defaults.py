@@ -214,6 +214,19 @@ _C.MODEL.ROI_BOX_HEAD.POOLER_SAMPLING_RATIO = 0
 _C.MODEL.ROI_BOX_HEAD.POOLER_SCALES = (1.0 / 16,)
 _C.MODEL.ROI_BOX_HEAD.NUM_CLASSES = 80
 _C.MODEL.ROI_BOX_HEAD.EMBEDDING = 1024
+# How the causal predictor scores (object, confounder) pairs:
+# "pairwise" builds the N*N x 2D concatenated features explicitly,
+# "factorized" splits the linear classifier into W_y.y_i + W_z.z_j + b and
+# only keeps the two N x C terms (the loss reads them directly)
+_C.MODEL.ROI_BOX_HEAD.CAUSAL_SCORE = "pairwise"
+# How the causal predictor sums the dictionary entries weighted by the
+# attention and the prior P(z):
+# "dense" builds the N x K x D weighted entries explicitly,
+# "matmul" computes the same sum as one (N x K) x (K x D) matmul,
+# "topk" is "matmul" over the INTERVENTION_TOPK entries each object attends
+# to most (softmax over the kept entries only)
+_C.MODEL.ROI_BOX_HEAD.INTERVENTION = "dense"
+_C.MODEL.ROI_BOX_HEAD.INTERVENTION_TOPK = 32
 # Hidden layer dimension when using an MLP for the RoI box head
 _C.MODEL.ROI_BOX_HEAD.MLP_HEAD_DIM = 1024
 # GN
@@ -427,6 +440,48 @@ _C.TEST.IMS_PER_BATCH = 2
 # Number of detections per image
 _C.TEST.DETECTIONS_PER_IMG = 100
 
+# ---------------------------------------------------------------------------- #
+# Confounder dictionary built from the extracted features
+# ---------------------------------------------------------------------------- #
+_C.TEST.CONFOUNDER = CN()
+
+# Accumulate the per-class mean features and the class prior during inference
+_C.TEST.CONFOUNDER.ENABLED = True
+
+# Number of object classes (1601 for the Visual Genome vocabulary)
+_C.TEST.CONFOUNDER.NUM_CLASSES = 1601
+
+# Dimension of the box features returned by the box head
+_C.TEST.CONFOUNDER.FEATURE_DIM = 1024
+
+# Output files of the dictionary (class means) and of the prior P(z)
+_C.TEST.CONFOUNDER.DIC_FILE = "./dic_coco_vcr.npy"
+_C.TEST.CONFOUNDER.PRIOR_FILE = "./stat_prob_vcr.npy"
+
+# ---------------------------------------------------------------------------- #
+# Feature extraction (tools/test_net.py)
+# ---------------------------------------------------------------------------- #
+_C.TEST.EXTRACTION = CN()
+
+# Run the resumable feature extraction instead of the evaluation
+_C.TEST.EXTRACTION.ENABLED = True
+
+# The dataset is split between NUM_JOBS independent jobs (e.g. one per node)
+# times the processes of each job. JOB_ID is the index of this job
+_C.TEST.EXTRACTION.NUM_JOBS = 1
+_C.TEST.EXTRACTION.JOB_ID = 0
+
+# Save the confounder statistics every CHECKPOINT_PERIOD iterations
+_C.TEST.EXTRACTION.CHECKPOINT_PERIOD = 1000
+
+# Log the images/s of every stage every LOG_PERIOD iterations
+_C.TEST.EXTRACTION.LOG_PERIOD = 200
+
+# Keep every prediction in memory for evaluation. The feature extraction runs
+# only need the streamed statistics and saved features
+_C.TEST.KEEP_PREDICTIONS = False
+
+
 # ---------------------------------------------------------------------------- #
 # Test-time augmentations for bounding box detection
 # See configs/test_time_aug/e2e_mask_rcnn_R-50-FPN_1x.yaml for an example
@@ -478,9 +533,29 @@ _C.BOUNDINGBOX_FILE = '/.../cocobu_box'
 # The pre-prepared dictionary file path for intervention (numpy format)
 _C.DIC_FILE = './tools/dic_coco.npy'
 
-# The pre-prepared dictionary file path for intervention (numpy format)
+# The output path of the extracted features
 _C.FEATURE_SAVE_PATH = './output/vc_feature'
 
+# How the extracted features are written: "npy" (one file per image), "hdf5"
+# (chunked, compressed shards) or "lmdb". An empty string disables saving
+_C.FEATURE_SINK = "npy"
+
+# Number of images written (and recorded in the manifest) at once
+_C.FEATURE_SINK_CHUNK_SIZE = 256
+
+# Number of images waiting for the background writer before inference blocks
+_C.FEATURE_SINK_QUEUE_SIZE = 64
+
+# Number of images per HDF5 shard
+_C.FEATURE_SINK_SHARD_SIZE = 10000
+
+# HDF5 compression filter ("gzip", "lzf" or "" for none)
+_C.FEATURE_SINK_COMPRESSION = "gzip"
+
+# Mapping from the dataset image id to the saved feature name, written by the
+# VCR dataset. An empty string names the features by image id
+_C.ID2IMG_NAME_FILE = './output/id2img_name.json'
+
 # The prior probability P(z)
 _C.PRIOR_PROB = './tools/stat_prob.npy'
 
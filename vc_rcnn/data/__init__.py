@@ -1,2 +1,3 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 from .build import make_data_loader
+from .build import make_test_datasets, make_extraction_data_loader
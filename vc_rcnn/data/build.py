@@ -184,3 +184,43 @@ def make_data_loader(cfg, is_train=True, is_distributed=False, start_iter=0):
         assert len(data_loaders) == 1
         return data_loaders[0]
     return data_loaders
+
+
+def make_test_datasets(cfg):
+    """
+    Builds the datasets of cfg.DATASETS.TEST with the test transforms.
+    """
+    paths_catalog = import_file(
+        "vc_rcnn.config.paths_catalog", cfg.PATHS_CATALOG, True
+    )
+    DatasetCatalog = paths_catalog.DatasetCatalog
+    transforms = None if cfg.TEST.BBOX_AUG.ENABLED else build_transforms(cfg, False)
+    return build_dataset(cfg.DATASETS.TEST, transforms, DatasetCatalog, cfg, False)
+
+
+def make_extraction_data_loader(cfg, dataset, sampler):
+    """
+    Data loader of the feature extraction: batches of TEST.IMS_PER_BATCH / world
+    size images in the order of the given (sharded) sampler, loaded and
+    collated ahead of the forward pass by the worker processes.
+    """
+    num_gpus = get_world_size()
+    images_per_batch = cfg.TEST.IMS_PER_BATCH
+    assert (
+        images_per_batch % num_gpus == 0
+    ), "TEST.IMS_PER_BATCH ({}) must be divisible by the number of GPUs ({}) used.".format(
+        images_per_batch, num_gpus)
+    images_per_gpu = images_per_batch // num_gpus
+
+    batch_sampler = torch.utils.data.sampler.BatchSampler(
+        sampler, images_per_gpu, drop_last=False
+    )
+    collator = BBoxAugCollator() if cfg.TEST.BBOX_AUG.ENABLED else \
+        BatchCollator(cfg.DATALOADER.SIZE_DIVISIBILITY)
+    return torch.utils.data.DataLoader(
+        dataset,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        batch_sampler=batch_sampler,
+        collate_fn=collator,
+        pin_memory=cfg.MODEL.DEVICE != "cpu",
+    )
@@ -0,0 +1,31 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+from torch.utils.data.sampler import Sampler
+
+
+class ShardedSampler(Sampler):
+    """
+    Deterministically splits the indices of a dataset into num_shards strided
+    shards and iterates over the indices of one of them, in order, leaving
+    out the indices that were already processed. Unlike DistributedSampler,
+    no index is repeated to even out the shards, so every image is visited
+    exactly once over all shards.
+    Arguments:
+        num_samples (int): size of the dataset
+        num_shards (int): total number of shards (jobs x processes)
+        shard_id (int): index of the shard of this process
+        skip (iterable[int], optional): indices to leave out
+    """
+
+    def __init__(self, num_samples, num_shards=1, shard_id=0, skip=None):
+        assert 0 <= shard_id < num_shards, \
+            "shard_id ({}) must be in [0, {})".format(shard_id, num_shards)
+        skip = set(skip) if skip is not None else set()
+        self.indices = [
+            i for i in range(shard_id, num_samples, num_shards) if i not in skip
+        ]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
@@ -0,0 +1,121 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from vc_rcnn.utils.comm import get_world_size, is_main_process
+
+
+class ConfounderStatistics(object):
+    """
+    Accumulates the confounder dictionary (the mean feature of every class)
+    and the class prior P(z) from the predictions of the feature extractor.
+
+    The per-class feature sums and counts stay on the model device
+    and are updated with one index_add_/bincount per batch, so
+    nothing has to be kept once a batch has been accumulated.
+    """
+
+    def __init__(self, num_classes, feature_dim, device="cpu"):
+        self.num_classes = num_classes
+        self.feature_sum = torch.zeros(
+            (num_classes, feature_dim), dtype=torch.float64, device=device
+        )
+        self.counter = torch.zeros(num_classes, dtype=torch.float64, device=device)
+        # dataset indices already accumulated, to resume an extraction
+        self.indices = set()
+
+    def update(self, predictions, indices=None):
+        """
+        Arguments:
+            predictions (list[BoxList]): boxes with the "labels" and "features"
+                fields, as returned by the model in test mode
+            indices (list[int], optional): dataset indices of the predictions
+        """
+        if indices is not None:
+            # skip the images accumulated before an interrupted run
+            new = [int(i) not in self.indices for i in indices]
+            predictions = [p for p, keep in zip(predictions, new) if keep]
+            self.indices.update(int(i) for i in indices)
+        predictions = [p for p in predictions if len(p) > 0]
+        if not predictions:
+            return
+        device = self.feature_sum.device
+        features = torch.cat([p.get_field("features") for p in predictions], dim=0)
+        labels = torch.cat([p.get_field("labels") for p in predictions], dim=0)
+        features = features.to(device=device, dtype=torch.float64)
+        labels = labels.to(device=device, dtype=torch.int64)
+
+        self.feature_sum.index_add_(0, labels, features)
+        self.counter += torch.bincount(labels, minlength=self.num_classes).to(torch.float64)
+
+    def state_dict(self):
+        return {
+            "feature_sum": self.feature_sum.cpu(),
+            "counter": self.counter.cpu(),
+            "indices": sorted(self.indices),
+        }
+
+    def load_state_dict(self, state_dict):
+        self.feature_sum.copy_(state_dict["feature_sum"])
+        self.counter.copy_(state_dict["counter"])
+        self.indices = set(state_dict["indices"])
+
+    def all_reduce(self):
+        """
+        Sums the partial statistics of all processes. Every process has to
+        call it.
+        """
+        world_size = get_world_size()
+        if world_size < 2:
+            return
+        dist.all_reduce(self.feature_sum)
+        dist.all_reduce(self.counter)
+
+    def compute(self):
+        """
+        Returns:
+            dictionary (np.ndarray): num_classes x feature_dim class means
+            prior (np.ndarray): num_classes class frequencies
+        """
+        counter = self.counter.cpu().numpy()
+        feature_sum = self.feature_sum.cpu().numpy()
+        prior = counter / np.sum(counter)
+        counter = np.where(counter == 0, 1e-6, counter)
+        dictionary = feature_sum / counter[:, np.newaxis]
+        return dictionary, prior
+
+    def save(self, dictionary_file, prior_file):
+        """
+        Reduces the statistics across processes and writes the dictionary and
+        the prior as .npy files from the main process.
+        """
+        self.all_reduce()
+        if not is_main_process():
+            return
+        dictionary, prior = self.compute()
+        for path in (dictionary_file, prior_file):
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+        np.save(prior_file, prior)
+        np.save(dictionary_file, dictionary)
+        logger = logging.getLogger("vc_rcnn.inference")
+        logger.info(
+            "Saved confounder dictionary to {} and prior to {} ({} objects)".format(
+                dictionary_file, prior_file, int(self.counter.sum().item())
+            )
+        )
+
+
+def make_confounder_statistics(cfg):
+    if not cfg.TEST.CONFOUNDER.ENABLED:
+        return None
+    return ConfounderStatistics(
+        cfg.TEST.CONFOUNDER.NUM_CLASSES,
+        cfg.TEST.CONFOUNDER.FEATURE_DIM,
+        cfg.MODEL.DEVICE,
+    )
@@ -0,0 +1,200 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+"""
+Resumable, sharded feature extraction.
+
+The dataset is split into deterministic strided shards, one per process of
+every extraction job (TEST.EXTRACTION.NUM_JOBS x world size). The images are
+loaded by the data loader workers, run through the model in the main thread
+and written by the background thread of the feature sink, so the three
+stages overlap and each one is bounded by its queue. The images recorded in
+the sink manifests (and, when the confounder dictionary is built, in the
+confounder checkpoints) are skipped, so a killed extraction restarts where it
+stopped.
+"""
+import glob
+import logging
+import os
+import time
+
+import torch
+
+from vc_rcnn.data import make_extraction_data_loader
+from vc_rcnn.data.samplers import ShardedSampler
+from ..utils.comm import get_rank, get_world_size, is_main_process
+from ..utils.comm import synchronize
+from ..utils.timer import Timer, get_time_str
+from .bbox_aug import im_detect_bbox_aug
+from .confounder import make_confounder_statistics
+from .feature_sink import make_feature_sink
+
+
+def _confounder_checkpoint_file(save_dir, dataset_name, job_id, rank):
+    return os.path.join(
+        save_dir, "confounder_{}_job{}_rank{}.pth".format(dataset_name, job_id, rank)
+    )
+
+
+def _load_confounder_checkpoints(confounder_stats, save_dir, dataset_name, job_id):
+    """
+    Restores the statistics of the previous runs into the main process (the
+    other processes start from zero, the partial sums are all-reduced at the
+    end) and returns the indices they cover. The main process then owns the
+    merged statistics, so the checkpoints of the other processes are removed.
+    Only the checkpoints of this job are considered.
+    """
+    pattern = _confounder_checkpoint_file(save_dir, dataset_name, job_id, "*")
+    checkpoint_files = sorted(glob.glob(pattern))
+    indices = set()
+    for checkpoint_file in checkpoint_files:
+        state_dict = torch.load(checkpoint_file, map_location="cpu")
+        indices.update(state_dict["indices"])
+        if is_main_process():
+            confounder_stats.feature_sum += state_dict["feature_sum"].to(confounder_stats.feature_sum)
+            confounder_stats.counter += state_dict["counter"].to(confounder_stats.counter)
+    # images accumulated by any process are not accumulated again
+    confounder_stats.indices.update(indices)
+
+    synchronize()
+    if is_main_process() and checkpoint_files:
+        _save_confounder_checkpoint(confounder_stats, save_dir, dataset_name, job_id, 0)
+        main_file = _confounder_checkpoint_file(save_dir, dataset_name, job_id, 0)
+        for checkpoint_file in checkpoint_files:
+            if checkpoint_file != main_file:
+                os.remove(checkpoint_file)
+    synchronize()
+    return indices
+
+
+def _save_confounder_checkpoint(confounder_stats, save_dir, dataset_name, job_id, rank):
+    checkpoint_file = _confounder_checkpoint_file(save_dir, dataset_name, job_id, rank)
+    torch.save(confounder_stats.state_dict(), checkpoint_file + ".tmp")
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+
+def _job_file(path, job_id):
+    root, ext = os.path.splitext(path)
+    return "{}_job{}{}".format(root, job_id, ext)
+
+
+def extract_features(cfg, model, dataset, dataset_name, device="cuda"):
+    """
+    Extracts and saves the features of the images of one dataset.
+
+    Arguments:
+        cfg: the (frozen) config, see TEST.EXTRACTION and FEATURE_SINK
+        model (nn.Module): the VC R-CNN model
+        dataset: dataset returning (image, target, index)
+        dataset_name (str): used to name the manifests and checkpoints
+        device (str)
+    """
+    logger = logging.getLogger("vc_rcnn.extraction")
+    device = torch.device(device)
+    rank = get_rank()
+    world_size = get_world_size()
+    job_id = cfg.TEST.EXTRACTION.JOB_ID
+    num_shards = cfg.TEST.EXTRACTION.NUM_JOBS * world_size
+    shard_id = job_id * world_size + rank
+
+    # the shard id names the manifest, so the processes of different jobs
+    # never write to the same files
+    feature_sink = make_feature_sink(cfg, dataset_name, shard_id)
+    assert feature_sink is not None, "The feature extraction needs a FEATURE_SINK"
+    confounder_stats = make_confounder_statistics(cfg)
+
+    completed = feature_sink.completed_indices()
+    if confounder_stats is not None:
+        # an image is only done once both its features and its statistics are
+        # saved; when only one of them is, the image is run again and the sink
+        # (or the statistics) skip it
+        completed &= _load_confounder_checkpoints(
+            confounder_stats, feature_sink.save_dir, dataset_name, job_id
+        )
+
+    sampler = ShardedSampler(len(dataset), num_shards, shard_id, skip=completed)
+    data_loader = make_extraction_data_loader(cfg, dataset, sampler)
+    logger.info(
+        "Start feature extraction on {} dataset: shard {}/{}, {} images "
+        "({} already extracted by previous runs).".format(
+            dataset_name, shard_id, num_shards, len(sampler), len(completed)
+        )
+    )
+
+    model.eval()
+    load_timer = Timer()
+    forward_timer = Timer()
+    put_timer = Timer()
+    total_timer = Timer()
+    checkpoint_period = cfg.TEST.EXTRACTION.CHECKPOINT_PERIOD
+    log_period = cfg.TEST.EXTRACTION.LOG_PERIOD
+    num_images = 0
+
+    def log_throughput():
+        def speed(timer):
+            return num_images / timer.total_time if timer.total_time > 0 else float("inf")
+
+        write_speed = feature_sink.num_written / feature_sink.write_time \
+            if feature_sink.write_time > 0 else float("inf")
+        logger.info(
+            "[{}] {}/{} images, images/s: load {:.1f}, forward {:.1f}, "
+            "enqueue {:.1f}, write {:.1f}, overall {:.1f}".format(
+                dataset_name, num_images, len(sampler), speed(load_timer),
+                speed(forward_timer), speed(put_timer), write_speed,
+                num_images / (time.time() - start_time),
+            )
+        )
+
+    def save_confounder_checkpoint():
+        if confounder_stats is not None:
+            _save_confounder_checkpoint(
+                confounder_stats, feature_sink.save_dir, dataset_name, job_id, rank
+            )
+
+    start_time = time.time()
+    total_timer.tic()
+    data_iter = iter(data_loader)
+    for iteration in range(len(data_loader)):
+        load_timer.tic()
+        images, targets, image_ids = next(data_iter)
+        load_timer.toc()
+
+        forward_timer.tic()
+        with torch.no_grad():
+            if cfg.TEST.BBOX_AUG.ENABLED:
+                output = im_detect_bbox_aug(model, images, device)
+            else:
+                output = model(images.to(device), targets)
+            if confounder_stats is not None:
+                confounder_stats.update(output, image_ids)
+            if not cfg.MODEL.DEVICE == "cpu":
+                torch.cuda.synchronize()
+        forward_timer.toc()
+
+        put_timer.tic()
+        feature_sink.put_predictions(output, image_ids)
+        put_timer.toc()
+
+        num_images += len(image_ids)
+        if checkpoint_period > 0 and (iteration + 1) % checkpoint_period == 0:
+            save_confounder_checkpoint()
+        if log_period > 0 and (iteration + 1) % log_period == 0:
+            log_throughput()
+
+    feature_sink.close()
+    save_confounder_checkpoint()
+    total_time = total_timer.toc()
+    log_throughput()
+    logger.info("Feature extraction of shard {} done in {}".format(
+        shard_id, get_time_str(total_time)))
+
+    # wait for all processes before reducing the confounder statistics
+    synchronize()
+    if confounder_stats is None:
+        return
+    dic_file = cfg.TEST.CONFOUNDER.DIC_FILE
+    prior_file = cfg.TEST.CONFOUNDER.PRIOR_FILE
+    if cfg.TEST.EXTRACTION.NUM_JOBS > 1:
+        # every job only sees its own shards, the statistics of the jobs are
+        # merged from their checkpoints by vc_rcnn.tools.merge_confounder
+        dic_file = _job_file(dic_file, job_id)
+        prior_file = _job_file(prior_file, job_id)
+    confounder_stats.save(dic_file, prior_file)
@@ -0,0 +1,334 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+"""
+Writers for the extracted per-box features.
+
+The model only returns the features (the "features" field of the predicted
+BoxList). A sink takes them out of the inference loop and hands them to a
+background thread, which writes them to disk:
+
+    npy:  one <image_name>.npy file per image (the original layout)
+    hdf5: chunked, compressed HDF5 shards with one "<image_name>/feature"
+          dataset per image (the layout read by the downstream loaders)
+    lmdb: one LMDB per process, image name -> compressed npz record
+
+Every sink records the written images in a manifest (one json line per
+image with its name and dataset index, appended only after the data has been
+flushed), so an interrupted extraction can be resumed and the already written
+images skipped.
+"""
+import glob
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import h5py
+import lmdb
+import numpy as np
+
+from vc_rcnn.utils.comm import get_rank
+
+
+class FeatureSink(object):
+    """
+    Base class of the feature writers. put() only moves the features to host
+    memory and enqueues them; the actual writes happen in a background
+    thread, in chunks of chunk_size images.
+    """
+
+    def __init__(
+        self, save_dir, chunk_size=256, queue_size=64, id2img_name=None,
+        rank=None, dataset_name=None,
+    ):
+        self.save_dir = save_dir
+        self.chunk_size = chunk_size
+        self.id2img_name = id2img_name
+        self.rank = get_rank() if rank is None else rank
+        # files of different datasets sharing save_dir must not collide
+        self.prefix = dataset_name + "_" if dataset_name else ""
+        os.makedirs(save_dir, exist_ok=True)
+
+        self.manifest_file = os.path.join(
+            save_dir, "manifest_{}rank{}.jsonl".format(self.prefix, self.rank)
+        )
+        self.manifest = self._load_manifest()
+        # names written by any process, the number of processes may differ
+        # from the previous run
+        self.completed_names = set()
+        for manifest_file in self._manifest_files():
+            self.completed_names.update(self._load_manifest(manifest_file).keys())
+        self.logger = logging.getLogger("vc_rcnn.feature_sink")
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = None
+        # only touched by the writer thread
+        self.num_written = 0
+        self.write_time = 0.0
+
+    def _load_manifest(self, manifest_file=None):
+        manifest = {}
+        manifest_file = manifest_file or self.manifest_file
+        if not os.path.exists(manifest_file):
+            return manifest
+        with open(manifest_file, "r", encoding="utf-8") as fp:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of a killed run may be truncated
+                    continue
+                manifest[entry["name"]] = entry
+        return manifest
+
+    def _manifest_files(self):
+        pattern = os.path.join(self.save_dir, "manifest_{}rank*.jsonl".format(self.prefix))
+        return glob.glob(pattern)
+
+    def completed_indices(self):
+        """
+        Returns the dataset indices recorded in the manifests of all the
+        processes.
+        """
+        indices = set()
+        for manifest_file in self._manifest_files():
+            for entry in self._load_manifest(manifest_file).values():
+                if entry.get("index") is not None:
+                    indices.add(entry["index"])
+        return indices
+
+    def image_name(self, image_id):
+        image_id = str(image_id)
+        if self.id2img_name is None:
+            return image_id
+        return str(self.id2img_name[image_id])
+
+    def is_done(self, name):
+        return name in self.manifest or name in self.completed_names
+
+    def put_predictions(self, predictions, indices=None):
+        """
+        Arguments:
+            predictions (list[BoxList]): boxes with the "features", "image_id"
+                and "num_box" fields, as returned by the model in test mode
+            indices (list[int], optional): dataset indices of the predictions,
+                recorded in the manifest
+        """
+        if indices is None:
+            indices = [None] * len(predictions)
+        for prediction, index in zip(predictions, indices):
+            if len(prediction) == 0:
+                continue
+            features = prediction.get_field("features")
+            num_box = int(prediction.get_field("num_box")[0])
+            image_id = int(prediction.get_field("image_id")[0])
+            if num_box != features.size(0):
+                self.logger.warning(
+                    "Skip image {}: {} features for {} boxes".format(
+                        image_id, features.size(0), num_box
+                    )
+                )
+                continue
+            self.put(self.image_name(image_id), features, index)
+
+    def put(self, name, features, index=None):
+        if self._error is not None:
+            raise self._error
+        if self.is_done(name):
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((name, features.detach().cpu().numpy(), index))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is None:
+            self._finalize()
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        chunk = []
+        got_sentinel = False
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    got_sentinel = True
+                    break
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    self._flush(chunk)
+                    chunk = []
+            if chunk:
+                self._flush(chunk)
+            self._finalize()
+        except Exception as e:
+            self._error = e
+            # keep draining so that the producer never blocks on a full queue
+            # (the sentinel of close() may already have been taken)
+            if not got_sentinel:
+                while self._queue.get() is not None:
+                    pass
+
+    def _flush(self, chunk):
+        start_time = time.time()
+        entries = self.write_chunk([(name, features) for name, features, _ in chunk])
+        with open(self.manifest_file, "a", encoding="utf-8") as fp:
+            for entry, (_, _, index) in zip(entries, chunk):
+                entry["index"] = index
+                fp.write(json.dumps(entry) + "\n")
+                self.manifest[entry["name"]] = entry
+        self.write_time += time.time() - start_time
+        self.num_written += len(entries)
+
+    def write_chunk(self, chunk):
+        """
+        Writes a list of (name, features) pairs and returns their manifest
+        entries, in the same order, once the data is on disk.
+        """
+        raise NotImplementedError
+
+    def _finalize(self):
+        pass
+
+
+class NpyFeatureSink(FeatureSink):
+    def write_chunk(self, chunk):
+        entries = []
+        for name, features in chunk:
+            np.save(os.path.join(self.save_dir, name) + ".npy", features)
+            entries.append({"name": name, "num_boxes": features.shape[0]})
+        return entries
+
+
+class HDF5FeatureSink(FeatureSink):
+    """
+    Appends to "features_rank<r>_<shard>.hdf5" and starts a new shard every
+    shard_size images. A resumed run starts after the last shard of the
+    manifest, so the shards of the images already recorded are never
+    reopened for writing.
+    """
+
+    def __init__(self, save_dir, shard_size=10000, compression="gzip", **kwargs):
+        self.shard_size = shard_size
+        self.compression = compression if compression else None
+        super(HDF5FeatureSink, self).__init__(save_dir, **kwargs)
+        shards = [entry["shard"] for entry in self.manifest.values()]
+        self._shard = max(shards) + 1 if shards else 0
+        self._shard_count = 0
+        self._file = None
+
+    def _open_shard(self):
+        path = os.path.join(
+            self.save_dir,
+            "features_{}rank{}_{:03d}.hdf5".format(self.prefix, self.rank, self._shard),
+        )
+        self._file = h5py.File(path, "w")
+        self._shard_count = 0
+
+    def write_chunk(self, chunk):
+        entries = []
+        for name, features in chunk:
+            if self._file is None:
+                self._open_shard()
+            if name in self._file:
+                del self._file[name]
+            group = self._file.create_group(name)
+            group.create_dataset(
+                "feature",
+                data=features,
+                chunks=features.shape if features.size > 0 else None,
+                compression=self.compression,
+            )
+            entries.append(
+                {"name": name, "num_boxes": features.shape[0], "shard": self._shard}
+            )
+            self._shard_count += 1
+            if self._shard_count >= self.shard_size:
+                self._file.close()
+                self._file = None
+                self._shard += 1
+        if self._file is not None:
+            self._file.flush()
+        return entries
+
+    def _finalize(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class LMDBFeatureSink(FeatureSink):
+    """
+    Writes "features_rank<r>.lmdb", one compressed npz record ("feature") per
+    image name, committing one transaction per chunk.
+    """
+
+    def __init__(self, save_dir, map_size=1024 ** 4, **kwargs):
+        super(LMDBFeatureSink, self).__init__(save_dir, **kwargs)
+        path = os.path.join(
+            self.save_dir, "features_{}rank{}.lmdb".format(self.prefix, self.rank)
+        )
+        self._env = lmdb.open(path, map_size=map_size)
+
+    def write_chunk(self, chunk):
+        entries = []
+        with self._env.begin(write=True) as txn:
+            for name, features in chunk:
+                buffer = io.BytesIO()
+                np.savez_compressed(buffer, feature=features)
+                txn.put(name.encode("utf-8"), buffer.getvalue())
+                entries.append({"name": name, "num_boxes": features.shape[0]})
+        return entries
+
+    def _finalize(self):
+        self._env.sync()
+        self._env.close()
+
+
+_FEATURE_SINKS = {
+    "npy": NpyFeatureSink,
+    "hdf5": HDF5FeatureSink,
+    "lmdb": LMDBFeatureSink,
+}
+
+
+def make_feature_sink(cfg, dataset_name=None, rank=None):
+    if not cfg.FEATURE_SINK:
+        return None
+    assert cfg.FEATURE_SINK in _FEATURE_SINKS, \
+        "Unknown feature sink {}, expected one of {}".format(
+            cfg.FEATURE_SINK, list(_FEATURE_SINKS.keys()))
+
+    id2img_name = None
+    if cfg.ID2IMG_NAME_FILE:
+        with open(cfg.ID2IMG_NAME_FILE, "r", encoding="utf-8") as fp:
+            id2img_name = json.load(fp)
+
+    kwargs = dict(
+        chunk_size=cfg.FEATURE_SINK_CHUNK_SIZE,
+        queue_size=cfg.FEATURE_SINK_QUEUE_SIZE,
+        id2img_name=id2img_name,
+        dataset_name=dataset_name,
+        rank=rank,
+    )
+    if cfg.FEATURE_SINK == "hdf5":
+        kwargs.update(
+            shard_size=cfg.FEATURE_SINK_SHARD_SIZE,
+            compression=cfg.FEATURE_SINK_COMPRESSION,
+        )
+    return _FEATURE_SINKS[cfg.FEATURE_SINK](cfg.FEATURE_SAVE_PATH + "_gt", **kwargs)
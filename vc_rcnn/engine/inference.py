@@ -13,20 +13,17 @@ from ..utils.comm import all_gather
 from ..utils.comm import synchronize
 from ..utils.timer import Timer, get_time_str
 from .bbox_aug import im_detect_bbox_aug
-import numpy as np
+from .confounder import make_confounder_statistics
+from .feature_sink import make_feature_sink
 
-def compute_on_dataset(model, data_loader, device, timer=None):
+def compute_on_dataset(
+        model, data_loader, device, timer=None,
+        confounder_stats=None, feature_sink=None, keep_predictions=True,
+):
     model.eval()
     results_dict = {}
-    cpu_device = torch.device("cpu");i=0
-    ### build confounder dictionary
-    confounder_dictionary = np.zeros((1601, 1024))
-    counter = np.zeros(1601)
-    ###
+    cpu_device = torch.device("cpu")
     for _, batch in enumerate(tqdm(data_loader)):
-        ###i+=1
-        ###if i <= 70000:
-        ###   continue
         images, targets, image_ids = batch
         with torch.no_grad():
             if timer:
@@ -39,21 +36,17 @@ def compute_on_dataset(model, data_loader, device, timer=None):
                 if not cfg.MODEL.DEVICE == 'cpu':
                     torch.cuda.synchronize()
                 timer.toc()
+            ### build confounder dictionary
+            if confounder_stats is not None:
+                confounder_stats.update(output)
+            if feature_sink is not None:
+                feature_sink.put_predictions(output)
+            if not keep_predictions:
+                continue
             output = [o.to(cpu_device) for o in output]
         results_dict.update(
             {img_id: result for img_id, result in zip(image_ids, output)}
         )
-    ### build confounder dictionary
-        for i in range(len(output)):
-            for j in range(len(output[i].get_field('labels'))):
-                confounder_dictionary[output[i].get_field('labels')[j]] = confounder_dictionary[output[i].get_field('labels')[j]] + output[i].get_field('features')[j].numpy()
-                counter[output[i].get_field('labels')[j]] += 1
-    prior = counter / np.sum(counter)
-    np.save('./stat_prob_vcr.npy', prior)
-    counter = np.where(counter==0, 1e-6, counter)
-    confounder_dictionary = confounder_dictionary / counter[:, np.newaxis]
-    np.save('./dic_coco_vcr.npy', confounder_dictionary)
-    ###
     return results_dict
 
 
@@ -99,7 +92,16 @@ def inference(
     total_timer = Timer()
     inference_timer = Timer()
     total_timer.tic()
-    predictions = compute_on_dataset(model, data_loader, device, inference_timer)
+    confounder_stats = make_confounder_statistics(cfg)
+    feature_sink = make_feature_sink(cfg)
+    predictions = compute_on_dataset(
+        model, data_loader, device, inference_timer,
+        confounder_stats=confounder_stats,
+        feature_sink=feature_sink,
+        keep_predictions=cfg.TEST.KEEP_PREDICTIONS,
+    )
+    if feature_sink is not None:
+        feature_sink.close()
     # wait for all processes to complete before measuring the time
     synchronize()
     total_time = total_timer.toc()
@@ -118,9 +120,12 @@ def inference(
         )
     )
 
-    print('Not necessary to calculate the prediction score. Stop the Program.')
-    import sys
-    sys.exit()
+    if confounder_stats is not None:
+        confounder_stats.save(cfg.TEST.CONFOUNDER.DIC_FILE, cfg.TEST.CONFOUNDER.PRIOR_FILE)
+
+    if not cfg.TEST.KEEP_PREDICTIONS:
+        logger.info("Predictions are not kept (TEST.KEEP_PREDICTIONS), skip the evaluation.")
+        return
 
     predictions = _accumulate_predictions_from_multiple_gpus(predictions)
     if not is_main_process():
@@ -1,16 +1,14 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import torch
 from torch import nn
-import numpy as np
-import h5py
 from .roi_box_feature_extractors import make_roi_box_feature_extractor
 from .roi_box_predictors import make_roi_box_predictor
 from .inference import make_roi_box_post_processor
 from .loss import make_roi_box_loss_evaluator
 from .roi_box_predictors import make_causal_predictor
 import torch.nn.functional as F
-import os
-import json
+
+
 class ROIBoxHead(torch.nn.Module):
     """
     Generic Box Head class.
@@ -24,9 +22,7 @@ class ROIBoxHead(torch.nn.Module):
         self.post_processor = make_roi_box_post_processor(cfg)
         self.loss_evaluator = make_roi_box_loss_evaluator(cfg)
         self.causal_predictor = make_causal_predictor(cfg, self.feature_extractor.out_channels)
-        self.feature_save_path = cfg.FEATURE_SAVE_PATH
-        self.id2img_name_flag = 0
-        self.id2img_name = {}
+
     def forward(self, features, proposals, targets=None):
         """
         Arguments:
@@ -46,24 +42,16 @@ class ROIBoxHead(torch.nn.Module):
         # extract features that will be fed to the final classifier. The
         # feature_extractor generally corresponds to the pooler + heads
         x = self.feature_extractor(features, proposals)
-        import ipdb;ipdb.set_trace(context=10)
         # self predictor
         class_logits = self.predictor(x)
 
         # context predictor
         class_logits_causal_list = self.causal_predictor(x, proposals)
-        # pdb.set_trace()
 
-        import ipdb;ipdb.set_trace(context=10)
         if not self.training:
-
+            # the object features are saved by the feature sink of the
+            # inference loop (see vc_rcnn/engine/feature_sink.py)
             result = self.post_processor_gt(x, class_logits, proposals)
-            if self.id2img_name_flag == 0:
-                with open('./output/id2img_name.json', 'r', encoding = "utf-8") as fp: # add img_name to vc feature
-                    self.id2img_name_flag = 1
-                    self.id2img_name = json.load(fp)
-            # save object feature
-            self.save_object_feature_gt_bu(x, result, targets, self.id2img_name)
 
             return x, result, {}
 
@@ -91,23 +79,6 @@ class ROIBoxHead(torch.nn.Module):
         return boxes
 
 
-    def save_object_feature_gt_bu(self, x, result, targets, id2img):
-
-        for i, image in enumerate(result):
-            feature_pre_image = image.get_field("features").cpu().numpy()
-            try:
-                assert image.get_field("num_box")[0] == feature_pre_image.shape[0] ### extract vc feature by uniter bbox
-                image_id = str(image.get_field("image_id")[0].cpu().numpy())
-                #image_id = image_id + "_" + str(id2img[image_id])# add img_name to vc feature
-                image_id = str(id2img[image_id]) ### extract vc feaure by uniter bbox
-                path = os.path.join(self.feature_save_path+"_gt", image_id) +'.npy'
-                np.save(path, feature_pre_image)
-            except:
-                print(image)
-
-
-
-
 def build_roi_box_head(cfg, in_channels):
     """
     Constructs a new box head.
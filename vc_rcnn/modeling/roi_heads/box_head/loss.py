@@ -122,7 +122,9 @@ class FastRCNNLossComputation(object):
 
         Arguments:
             class_logits (list[Tensor])
-            box_regression (list[Tensor])
+            causal_logits_list (list[Tensor] or list[tuple[Tensor, Tensor]]):
+                pairwise (N*N, C) logits or factorized (y_logits, z_logits)
+                per image, see CausalPredictor
 
         Returns:
             classification_loss (Tensor)
@@ -141,6 +143,9 @@ class FastRCNNLossComputation(object):
         # context predictor loss
         causal_loss = 0.
         for causal_logit, label in zip(causal_logits_list, labels):
+            if isinstance(causal_logit, tuple):
+                causal_loss += factorized_causal_loss(causal_logit, label)
+                continue
             mask_label = label.unsqueeze(0).repeat(label.size(0), 1)
             mask = 1 - torch.eye(mask_label.size(0)).to(device)
             loss_causal = F.cross_entropy(causal_logit, mask_label.view(-1), reduction='none')
@@ -152,6 +157,39 @@ class FastRCNNLossComputation(object):
         return classification_loss, causal_loss
 
 
+def factorized_causal_loss(causal_logit, label):
+    """
+    Masked pairwise cross entropy computed from the factorized causal logits.
+
+    The logit of the pair (i, j) for class c is y_logits[i, c] + z_logits[j, c]
+    and its target is label[j]. The log-sum-exp over classes factorizes into
+    a matrix product of the exponentiated (max-shifted) terms, so only N x N
+    and N x C tensors are needed. The diagonal pairs are masked out and the
+    mean is taken over all N*N pairs, as in the pairwise loss.
+
+    Arguments:
+        causal_logit (tuple[Tensor, Tensor]): y_logits (N, C), z_logits (N, C)
+        label (Tensor): labels of the N objects
+
+    Returns:
+        causal_loss (Tensor)
+    """
+    y_logits, z_logits = causal_logit
+    length = y_logits.size(0)
+
+    y_max = y_logits.max(1, keepdim=True)[0].detach()
+    z_max = z_logits.max(1, keepdim=True)[0].detach()
+    pair_sum = torch.mm(torch.exp(y_logits - y_max), torch.exp(z_logits - z_max).t())
+    pair_sum = pair_sum.clamp(min=torch.finfo(pair_sum.dtype).tiny)
+    log_normalizer = torch.log(pair_sum) + y_max + z_max.t()
+
+    target_logits = y_logits[:, label] + z_logits.gather(1, label.unsqueeze(1)).t()
+
+    mask = 1 - torch.eye(length, device=y_logits.device, dtype=y_logits.dtype)
+    loss_causal = (log_normalizer - target_logits) * mask
+    return loss_causal.sum() / (length * length)
+
+
 def make_roi_box_loss_evaluator(cfg):
     matcher = Matcher(
         cfg.MODEL.ROI_HEADS.FG_IOU_THRESHOLD,
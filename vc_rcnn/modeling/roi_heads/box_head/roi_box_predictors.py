@@ -1,10 +1,14 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+import logging
+
 from vc_rcnn.modeling import registry
 from torch import nn
 import torch.nn.functional as F
 import torch
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 
 @registry.ROI_BOX_PREDICTOR.register("FastRCNNPredictor")
 class FastRCNNPredictor(nn.Module):
@@ -83,16 +87,34 @@ class CausalPredictor(nn.Module):
         nn.init.constant_(self.causal_score.bias, 0)
 
         self.feature_size = representation_size
+        self.score_mode = cfg.MODEL.ROI_BOX_HEAD.CAUSAL_SCORE
+        assert self.score_mode in ("pairwise", "factorized"), \
+            "Unknown causal score mode {}".format(self.score_mode)
+        self.intervention_mode = cfg.MODEL.ROI_BOX_HEAD.INTERVENTION
+        assert self.intervention_mode in ("dense", "matmul", "topk"), \
+            "Unknown intervention mode {}".format(self.intervention_mode)
+        self.intervention_topk = cfg.MODEL.ROI_BOX_HEAD.INTERVENTION_TOPK
         self.dic = torch.tensor(np.load(cfg.DIC_FILE)[1:], dtype=torch.float)
         self.prior = torch.tensor(np.load(cfg.PRIOR_PROB), dtype=torch.float)
 
     def forward(self, x, proposals):
-        device = x.get_device()
-        dic_z = self.dic.to(device)
-        prior = self.prior.to(device)
+        """
+        Returns:
+            causal_logits_list (list): one entry per image. In "pairwise" mode
+                each entry is the (N*N, C) logits of every (y_i, z_j) pair. In
+                "factorized" mode each entry is a tuple (y_logits, z_logits) of
+                two (N, C) tensors whose broadcast sum
+                y_logits[:, None] + z_logits[None] gives the same pair logits.
+        """
+        dic_z = self.dic.to(x.device)
+        prior = self.prior.to(x.device)
 
         box_size_list = [proposal.bbox.size(0) for proposal in proposals]
         feature_split = x.split(box_size_list)
+
+        if self.score_mode == "factorized":
+            return [self.factorized_score(feature_pre_obj, dic_z, prior) for feature_pre_obj in feature_split]
+
         xzs = [self.z_dic(feature_pre_obj, dic_z, prior) for feature_pre_obj in feature_split]
 
         causal_logits_list = [self.causal_score(xz) for xz in xzs]
@@ -100,6 +122,24 @@ class CausalPredictor(nn.Module):
 
         return causal_logits_list
 
+    def intervention(self, y, dic_z, prior):
+        """
+        Computes the confounder representation z of every object in y by
+        attending over the dictionary and weighting with the prior P(z).
+        """
+        attention = torch.mm(self.Wy(y), self.Wz(dic_z).t()) / (self.embedding_size ** 0.5)
+        if self.intervention_mode == "topk":
+            # softmax over the top-k entries of every object, zero elsewhere
+            k = min(self.intervention_topk, attention.size(1))
+            values, indices = attention.topk(k, dim=1)
+            attention = torch.zeros_like(attention).scatter_(1, indices, F.softmax(values, 1))
+        else:
+            attention = F.softmax(attention, 1)
+        if self.intervention_mode == "dense":
+            z_hat = attention.unsqueeze(2) * dic_z.unsqueeze(0)
+            return torch.matmul(prior.unsqueeze(0), z_hat).squeeze(1)
+        # sum_k P(z_k) a_ik z_k without the N x K x D intermediate
+        return torch.mm(attention * prior.unsqueeze(0), dic_z)
 
     def z_dic(self, y, dic_z, prior):
         """
@@ -108,10 +148,7 @@ class CausalPredictor(nn.Module):
         length = y.size(0)
         if length == 1:
             print('debug')
-        attention = torch.mm(self.Wy(y), self.Wz(dic_z).t()) / (self.embedding_size ** 0.5)
-        attention = F.softmax(attention, 1)
-        z_hat = attention.unsqueeze(2) * dic_z.unsqueeze(0)
-        z = torch.matmul(prior.unsqueeze(0), z_hat).squeeze(1)
+        z = self.intervention(y, dic_z, prior)
         xz = torch.cat((y.unsqueeze(1).repeat(1, length, 1), z.unsqueeze(0).repeat(length, 1, 1)), 2).view(-1, 2*y.size(1))
 
         # detect if encounter nan
@@ -119,6 +156,22 @@ class CausalPredictor(nn.Module):
             print(xz)
         return xz
 
+    def factorized_score(self, y, dic_z, prior):
+        """
+        Same logits as causal_score(z_dic(y, dic_z, prior)) without building
+        the N*N x 2D pair features: causal_score is linear, so the logit of
+        the pair (y_i, z_j) is W_y.y_i + W_z.z_j + b.
+        """
+        z = self.intervention(y, dic_z, prior)
+        if torch.isnan(z).any():
+            logger.warning("NaN in the confounder representation of {} objects".format(
+                int(torch.isnan(z).any(dim=1).sum())))
+
+        weight_y, weight_z = self.causal_score.weight.split(self.feature_size, dim=1)
+        y_logits = F.linear(y, weight_y)
+        z_logits = F.linear(z, weight_z, self.causal_score.bias)
+        return y_logits, z_logits
+
 def make_causal_predictor(cfg, in_channels):
     func = registry.ROI_BOX_PREDICTOR["CausalPredictor"]
     return func(cfg, in_channels)
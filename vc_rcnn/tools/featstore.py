@@ -0,0 +1,556 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+"""
+Conversion, merge and verification of the extracted feature stores.
+
+Supported formats (a record is a dict of arrays, "features" being the
+N x D box features of one image):
+
+    npy:   a directory of <name>.npy (features only) or <name>.npz files
+           ("feature" and "feat", as written by the captioning models, are
+           read as "features")
+    hdf5:  one or more HDF5 files with a "<name>/<array>" dataset per record
+           ("feature" is read as "features", as written by the VC extraction)
+    lmdb:  the UNITER DetectFeatLmdb format, name -> npz (compressed) or
+           msgpack record, the list of names under "__keys__"
+    flat:  a directory with all the box features concatenated in one
+           memory-mappable "features.bin", an int64 (offset, count) row per
+           image in "index.npy", the image names in "names.json" and the
+           dtype / feature size in "meta.json"; the other per-box arrays of
+           the records (e.g. "norm_bb", "conf") go to "<name>.bin" files
+           sharing the same index
+
+Each source is opened once. The records are read by a pool of processes and
+written by a single writer in the main process.
+
+Examples:
+
+    python -m vc_rcnn.tools.featstore convert output/vc_feature_gt coco_vc.hdf5 \\
+        --dst-format hdf5 --compression gzip --workers 8
+    python -m vc_rcnn.tools.featstore merge coco_vc_0.hdf5 coco_vc_1.hdf5 \\
+        coco_vc_flat --dst-format flat --fp16
+    python -m vc_rcnn.tools.featstore verify coco_vc_flat --against coco_vc.hdf5
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import multiprocessing as mp
+import os
+import sys
+
+import h5py
+import lmdb
+import numpy as np
+from tqdm import tqdm
+
+FORMATS = ("npy", "hdf5", "lmdb", "flat")
+
+
+def detect_format(path):
+    if os.path.isfile(path):
+        if path.endswith((".h5", ".hdf5")):
+            return "hdf5"
+        raise ValueError("Cannot detect the feature store format of {}".format(path))
+    if os.path.exists(os.path.join(path, "features.bin")):
+        return "flat"
+    if os.path.exists(os.path.join(path, "data.mdb")):
+        return "lmdb"
+    if glob.glob(os.path.join(path, "*.h5")) or glob.glob(os.path.join(path, "*.hdf5")):
+        return "hdf5"
+    return "npy"
+
+
+# keys the box features are stored under by the other tools
+FEATURE_ALIASES = ("feature", "feat")
+
+
+def rename_features(record, feature_key=None):
+    """
+    Renames the box features of a record to "features": from `feature_key`
+    if given, else from the first alias found.
+    """
+    if feature_key is not None and feature_key != "features":
+        if feature_key not in record:
+            raise KeyError("no {!r} array in the record (keys: {})".format(
+                feature_key, sorted(record.keys())))
+        record["features"] = record.pop(feature_key)
+    elif "features" not in record:
+        for key in FEATURE_ALIASES:
+            if key in record:
+                record["features"] = record.pop(key)
+                break
+    return record
+
+
+# ---------------------------------------------------------------------------- #
+# Readers
+# ---------------------------------------------------------------------------- #
+class NpyReader(object):
+    def __init__(self, path):
+        self.path = path
+        self._files = {}
+        for fname in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(fname)
+            if ext in (".npy", ".npz"):
+                self._files[name] = os.path.join(path, fname)
+
+    def keys(self):
+        return list(self._files.keys())
+
+    def __getitem__(self, name):
+        fname = self._files[name]
+        if fname.endswith(".npy"):
+            return {"features": np.load(fname)}
+        with np.load(fname, allow_pickle=True) as npz:
+            return rename_features({k: npz[k] for k in npz.files})
+
+    def close(self):
+        pass
+
+
+class HDF5Reader(object):
+    def __init__(self, path):
+        if os.path.isdir(path):
+            paths = sorted(glob.glob(os.path.join(path, "*.h5")) +
+                           glob.glob(os.path.join(path, "*.hdf5")))
+        else:
+            paths = [path]
+        self.files = [h5py.File(p, "r") for p in paths]
+        self._index = {}
+        for f in self.files:
+            for name in f.keys():
+                self._index.setdefault(name, f)
+
+    def keys(self):
+        return list(self._index.keys())
+
+    def __getitem__(self, name):
+        node = self._index[name]
+        node = node[name]
+        if isinstance(node, h5py.Dataset):
+            return {"features": node[()]}
+        record = {}
+        for key in node.keys():
+            record["features" if key == "feature" else key] = node[key][()]
+        return record
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def _loads_lmdb_record(dump):
+    dump = bytes(dump)
+    if dump[:2] == b"PK":
+        with io.BytesIO(dump) as reader:
+            npz = np.load(reader, allow_pickle=True)
+            return {k: npz[k] for k in npz.files}
+    import msgpack
+    import msgpack_numpy
+    return msgpack.loads(dump, raw=False, object_hook=msgpack_numpy.decode)
+
+
+class LmdbReader(object):
+    def __init__(self, path):
+        self.env = lmdb.open(path, readonly=True, create=False, lock=False,
+                             readahead=False)
+        self.txn = self.env.begin(buffers=True)
+
+    def keys(self):
+        keys = self.txn.get(b"__keys__")
+        if keys is not None:
+            return json.loads(bytes(keys).decode("utf-8"))
+        with self.txn.cursor() as cursor:
+            return [bytes(k).decode("utf-8") for k in cursor.iternext(values=False)]
+
+    def __getitem__(self, name):
+        dump = self.txn.get(name.encode("utf-8"))
+        if dump is None:
+            raise KeyError(name)
+        return _loads_lmdb_record(dump)
+
+    def close(self):
+        self.env.close()
+
+
+class FlatReader(object):
+    """
+    Zero-copy reader of the flat format, __getitem__ returns views of the
+    memory-mapped arrays.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        with open(os.path.join(path, "names.json"), "r") as f:
+            self.names = json.load(f)
+        self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r")
+        self.name2idx = {name: i for i, name in enumerate(self.names)}
+        num_boxes = int(self.index[:, 1].sum()) if len(self.names) else 0
+        fields = {"features": {"dtype": meta["dtype"], "shape": [meta["dim"]]}}
+        fields.update(meta.get("fields", {}))
+        self.arrays = {}
+        for key, field in fields.items():
+            shape = (num_boxes,) + tuple(field["shape"])
+            self.arrays[key] = np.memmap(
+                os.path.join(path, key + ".bin"), dtype=np.dtype(field["dtype"]),
+                mode="r", shape=shape,
+            ) if num_boxes else np.zeros(shape, dtype=field["dtype"])
+        self.features = self.arrays["features"]
+
+    def keys(self):
+        return list(self.names)
+
+    def __getitem__(self, name):
+        offset, count = self.index[self.name2idx[name]]
+        return {key: arr[offset:offset + count] for key, arr in self.arrays.items()}
+
+    def close(self):
+        pass
+
+
+READERS = {
+    "npy": NpyReader,
+    "hdf5": HDF5Reader,
+    "lmdb": LmdbReader,
+    "flat": FlatReader,
+}
+
+
+def open_reader(path, fmt=None):
+    return READERS[fmt or detect_format(path)](path)
+
+
+# ---------------------------------------------------------------------------- #
+# Writers
+# ---------------------------------------------------------------------------- #
+class NpyWriter(object):
+    def __init__(self, path, **kwargs):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, name, record):
+        if list(record.keys()) == ["features"]:
+            np.save(os.path.join(self.path, name + ".npy"), record["features"])
+        else:
+            np.savez(os.path.join(self.path, name + ".npz"), **record)
+
+    def close(self):
+        pass
+
+
+class HDF5Writer(object):
+    def __init__(self, path, compression=None, compression_opts=None, chunk_rows=0, **kwargs):
+        self.file = h5py.File(path, "w")
+        self.compression = compression or None
+        self.compression_opts = compression_opts if self.compression == "gzip" else None
+        self.chunk_rows = chunk_rows
+
+    def write(self, name, record):
+        group = self.file.create_group(name)
+        for key, arr in record.items():
+            chunks = None
+            if arr.ndim > 0 and arr.size > 0 and (self.compression or self.chunk_rows):
+                rows = min(self.chunk_rows, arr.shape[0]) if self.chunk_rows else arr.shape[0]
+                chunks = (rows,) + arr.shape[1:]
+            group.create_dataset(
+                "feature" if key == "features" else key,
+                data=arr,
+                chunks=chunks,
+                compression=self.compression if arr.ndim > 0 else None,
+                compression_opts=self.compression_opts if arr.ndim > 0 else None,
+            )
+
+    def close(self):
+        self.file.close()
+
+
+class LmdbWriter(object):
+    def __init__(self, path, lmdb_compress=True, commit_every=1000, map_size=1024 ** 4, **kwargs):
+        os.makedirs(path, exist_ok=True)
+        self.env = lmdb.open(path, map_size=map_size)
+        self.txn = self.env.begin(write=True)
+        self.compress = lmdb_compress
+        self.commit_every = commit_every
+        self.names = []
+
+    def write(self, name, record):
+        if self.compress:
+            with io.BytesIO() as writer:
+                np.savez_compressed(writer, **record)
+                dump = writer.getvalue()
+        else:
+            import msgpack
+            import msgpack_numpy
+            dump = msgpack.dumps(record, use_bin_type=True, default=msgpack_numpy.encode)
+        self.txn.put(name.encode("utf-8"), dump)
+        self.names.append(name)
+        if len(self.names) % self.commit_every == 0:
+            self.txn.commit()
+            self.txn = self.env.begin(write=True)
+
+    def close(self):
+        self.txn.put(b"__keys__", json.dumps(self.names).encode("utf-8"))
+        self.txn.commit()
+        self.env.close()
+
+
+class FlatWriter(object):
+    """
+    Appends every record to the flat store. The arrays with one row per box
+    are kept (each in its own .bin file), the other ones (e.g. the image
+    size) are dropped.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.bins = {}
+        self.fields = None
+        self.names = []
+        self.index = []
+        self.offset = 0
+
+    def _open(self, record):
+        if "features" not in record:
+            raise KeyError("no box features in the record (keys: {}), use "
+                           "--feature-key to name them".format(sorted(record.keys())))
+        num_boxes = record["features"].shape[0]
+        self.fields = {}
+        for key, arr in record.items():
+            arr = np.asarray(arr)
+            if key == "features" or arr.ndim > 0 and arr.shape[0] == num_boxes:
+                self.fields[key] = {"dtype": arr.dtype.name, "shape": list(arr.shape[1:])}
+                self.bins[key] = open(os.path.join(self.path, key + ".bin"), "wb")
+
+    def write(self, name, record):
+        if self.fields is None:
+            self._open(record)
+        num_boxes = record["features"].shape[0]
+        for key, field in self.fields.items():
+            arr = np.ascontiguousarray(record[key])
+            assert arr.dtype.name == field["dtype"] and \
+                arr.shape == (num_boxes,) + tuple(field["shape"]), \
+                "{}: {} {} {} does not match the store ({} {})".format(
+                    name, key, arr.dtype, arr.shape, field["dtype"], field["shape"])
+            self.bins[key].write(arr.tobytes())
+        self.names.append(name)
+        self.index.append((self.offset, num_boxes))
+        self.offset += num_boxes
+
+    def close(self):
+        if self.fields is None:
+            open(os.path.join(self.path, "features.bin"), "wb").close()
+            self.fields = {"features": {"dtype": "float32", "shape": [0]}}
+        for f in self.bins.values():
+            f.close()
+        index = np.array(self.index, dtype=np.int64).reshape(-1, 2)
+        np.save(os.path.join(self.path, "index.npy"), index)
+        with open(os.path.join(self.path, "names.json"), "w") as f:
+            json.dump(self.names, f)
+        fields = dict(self.fields)
+        features = fields.pop("features")
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({
+                "dtype": features["dtype"],
+                "dim": features["shape"][0] if features["shape"] else 0,
+                "fields": fields,
+                "num_images": len(self.names),
+                "num_boxes": self.offset,
+            }, f)
+
+
+WRITERS = {
+    "npy": NpyWriter,
+    "hdf5": HDF5Writer,
+    "lmdb": LmdbWriter,
+    "flat": FlatWriter,
+}
+
+
+# ---------------------------------------------------------------------------- #
+# Parallel reading
+# ---------------------------------------------------------------------------- #
+_worker_readers = None
+
+
+def _init_worker(sources):
+    global _worker_readers
+    _worker_readers = [open_reader(path, fmt) for path, fmt in sources]
+
+
+def _load_record(task):
+    source_idx, name, fp16, feature_key = task
+    record = rename_features(dict(_worker_readers[source_idx][name]), feature_key)
+    out = {}
+    for key, arr in record.items():
+        arr = np.asarray(arr)
+        if fp16 and arr.dtype == np.float32:
+            arr = arr.astype(np.float16)
+        out[key] = arr
+    return name, out
+
+
+def iter_records(sources, fp16=False, workers=0, chunksize=64, feature_key=None):
+    """
+    Yields the (name, record) of every source, in order, the first source
+    having a name winning. Reads with a pool of `workers` processes, each of
+    them opening every source once. The box features of the records are
+    renamed to "features" (see rename_features).
+    """
+    readers = [open_reader(path, fmt) for path, fmt in sources]
+    seen = set()
+    tasks = []
+    for source_idx, reader in enumerate(readers):
+        for name in reader.keys():
+            if name in seen:
+                continue
+            seen.add(name)
+            tasks.append((source_idx, name, fp16, feature_key))
+
+    if workers > 0:
+        for reader in readers:
+            reader.close()
+        with mp.Pool(workers, initializer=_init_worker, initargs=(sources,)) as pool:
+            for item in pool.imap(_load_record, tasks, chunksize=chunksize):
+                yield item
+    else:
+        global _worker_readers
+        _worker_readers = readers
+        try:
+            for task in tasks:
+                yield _load_record(task)
+        finally:
+            for reader in readers:
+                reader.close()
+            _worker_readers = None
+
+
+def convert(sources, dst, dst_format, fp16=False, workers=0, feature_key=None,
+            **writer_kwargs):
+    writer = WRITERS[dst_format](dst, **writer_kwargs)
+    num = 0
+    try:
+        for name, record in tqdm(iter_records(sources, fp16, workers, feature_key=feature_key),
+                                 desc="converting"):
+            writer.write(name, record)
+            num += 1
+    finally:
+        writer.close()
+    return num
+
+
+def verify(path, fmt=None, against=None, against_format=None, atol=1e-2):
+    """
+    Reads every record of a store and checks that the features are finite
+    and 2-d with a consistent feature size, and optionally that they match
+    (same names, shapes and values up to atol) another store.
+
+    Returns:
+        errors (list[str])
+    """
+    errors = []
+    reader = open_reader(path, fmt)
+    other = open_reader(against, against_format) if against else None
+    dim = None
+    names = reader.keys()
+    for name in tqdm(names, desc="verifying"):
+        try:
+            features = np.asarray(reader[name]["features"])
+        except Exception as e:
+            errors.append("{}: unreadable ({})".format(name, e))
+            continue
+        if features.ndim != 2:
+            errors.append("{}: features of shape {}".format(name, features.shape))
+            continue
+        if dim is None:
+            dim = features.shape[1]
+        if features.shape[1] != dim:
+            errors.append("{}: feature size {} != {}".format(name, features.shape[1], dim))
+        if not np.isfinite(features).all():
+            errors.append("{}: non finite features".format(name))
+        if other is not None:
+            try:
+                expected = np.asarray(other[name]["features"])
+            except KeyError:
+                errors.append("{}: missing from {}".format(name, against))
+                continue
+            if expected.shape != features.shape or not np.allclose(
+                    features.astype(np.float32), expected.astype(np.float32), atol=atol):
+                errors.append("{}: differs from {}".format(name, against))
+    if other is not None:
+        missing = set(other.keys()) - set(names)
+        errors.extend("{}: missing from {}".format(name, path) for name in sorted(missing))
+        other.close()
+    reader.close()
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VC feature store toolkit")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    def add_write_args(p):
+        p.add_argument("--src-format", choices=FORMATS, default=None,
+                       help="format of the sources (detected by default)")
+        p.add_argument("--dst-format", choices=FORMATS, required=True)
+        p.add_argument("--workers", type=int, default=8,
+                       help="reader processes (0 reads in the main process)")
+        p.add_argument("--fp16", action="store_true",
+                       help="down-cast the float32 arrays to float16")
+        p.add_argument("--feature-key", default=None,
+                       help="array holding the box features in the sources "
+                            "(default: features, feature or feat)")
+        p.add_argument("--compression", default=None, choices=["gzip", "lzf"],
+                       help="HDF5 compression filter")
+        p.add_argument("--compression-level", type=int, default=4,
+                       help="gzip level of the HDF5 compression")
+        p.add_argument("--chunk-rows", type=int, default=0,
+                       help="boxes per HDF5 chunk (0: one chunk per image)")
+        p.add_argument("--no-lmdb-compress", action="store_true",
+                       help="store msgpack instead of compressed npz records in LMDB")
+
+    p = subparsers.add_parser("convert", help="convert a feature store")
+    p.add_argument("src")
+    p.add_argument("dst")
+    add_write_args(p)
+
+    p = subparsers.add_parser("merge", help="merge shards into one store")
+    p.add_argument("srcs", nargs="+")
+    p.add_argument("dst")
+    add_write_args(p)
+
+    p = subparsers.add_parser("verify", help="check the integrity of a store")
+    p.add_argument("src")
+    p.add_argument("--src-format", choices=FORMATS, default=None)
+    p.add_argument("--against", default=None, help="store to compare with")
+    p.add_argument("--against-format", choices=FORMATS, default=None)
+    p.add_argument("--atol", type=float, default=1e-2)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("vc_rcnn.featstore")
+
+    if args.command == "verify":
+        errors = verify(args.src, args.src_format, args.against, args.against_format, args.atol)
+        for error in errors:
+            logger.error(error)
+        logger.info("{} error(s)".format(len(errors)))
+        return 1 if errors else 0
+
+    srcs = [args.src] if args.command == "convert" else args.srcs
+    sources = [(src, args.src_format or detect_format(src)) for src in srcs]
+    num = convert(
+        sources, args.dst, args.dst_format, fp16=args.fp16, workers=args.workers,
+        feature_key=args.feature_key,
+        compression=args.compression, compression_opts=args.compression_level,
+        chunk_rows=args.chunk_rows, lmdb_compress=not args.no_lmdb_compress,
+    )
+    logger.info("Wrote {} images to {}".format(num, args.dst))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
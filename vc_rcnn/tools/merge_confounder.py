@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+"""
+Merges the confounder statistics of the extraction jobs.
+
+With TEST.EXTRACTION.NUM_JOBS > 1 every job only accumulates the confounder
+dictionary and prior of its own shards, and writes them to the _job<k> files.
+The partial sums of every process are kept in the confounder checkpoints of
+the extraction directory (confounder_<dataset>_job<k>_rank<r>.pth); this
+sums them and writes the dictionary and prior of the whole dataset.
+
+Example:
+
+    python -m vc_rcnn.tools.merge_confounder \\
+        output/vc_feature/confounder_coco_2014_train_job*_rank*.pth \\
+        --dic-file ./dic_coco_vcr.npy --prior-file ./stat_prob_vcr.npy
+"""
+import argparse
+import glob
+import logging
+import sys
+
+import torch
+
+from vc_rcnn.engine.confounder import ConfounderStatistics
+
+
+def merge_checkpoints(checkpoint_files):
+    """
+    Sums the feature sums and counts of the checkpoints (the processes
+    accumulate disjoint images, the checkpoints hold partial sums).
+
+    Returns:
+        stats (ConfounderStatistics)
+    """
+    stats = None
+    for checkpoint_file in checkpoint_files:
+        state_dict = torch.load(checkpoint_file, map_location="cpu")
+        feature_sum = state_dict["feature_sum"]
+        if stats is None:
+            stats = ConfounderStatistics(feature_sum.size(0), feature_sum.size(1))
+        if feature_sum.shape != stats.feature_sum.shape:
+            raise ValueError("{}: statistics of shape {}, expected {}".format(
+                checkpoint_file, tuple(feature_sum.shape), tuple(stats.feature_sum.shape)))
+        stats.feature_sum += feature_sum.to(stats.feature_sum)
+        stats.counter += state_dict["counter"].to(stats.counter)
+        stats.indices.update(state_dict["indices"])
+    if stats is None:
+        raise ValueError("No confounder checkpoint to merge")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the confounder statistics of the extraction jobs")
+    parser.add_argument("checkpoints", nargs="+",
+                        help="confounder checkpoints of all the jobs (glob patterns are expanded)")
+    parser.add_argument("--dic-file", required=True, help="output dictionary (.npy)")
+    parser.add_argument("--prior-file", required=True, help="output prior (.npy)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("vc_rcnn.merge_confounder")
+
+    checkpoint_files = sorted(set(
+        path for pattern in args.checkpoints for path in (glob.glob(pattern) or [pattern])))
+    stats = merge_checkpoints(checkpoint_files)
+    logger.info("Merged {} checkpoints ({} images)".format(len(checkpoint_files), len(stats.indices)))
+    stats.save(args.dic_file, args.prior_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())